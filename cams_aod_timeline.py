@@ -5,30 +5,154 @@ CAMS AOD timeline plot
 
 Purpose : plots AOD for either 5-species or 7-species aerosols datasets produced by 'cams_extract_aod.py'
 
+v0.4.2 : in --batch mode, site names are the file names stripped of the prefix they share and of their '_5'/'_7'
+    suffix, instead of their third '_'-separated field, and two files rendered to the same PNG stop the batch. Workers
+    render sites in batches and close their figure at the end of each batch.
+
+v0.4.1 : --profile prints the time spent opening, reading, computing ratios, plotting and saving figures, files opened,
+    bytes read and peak memory at exit, workers included (see cams_instrument).
+
+v0.4.0 : --batch renders every site file matching a glob pattern or in a directory, over a process pool with --workers
+    using the Agg backend. Each process reuses a single figure, and rendering time is reported per site. The single
+    file mode now closes its figure.
+
+v0.3.0 : --merge plots the 5-species and 7-species files of a site as one continuous timeline, nitrate and ammonium
+    being missing before the shift to 7 species.
+
+v0.2.1 : Zarr stores produced by cams_extract_aod can be plotted. With Dask installed, files are opened as Dask arrays so
+    that a time window only reads the chunks it needs.
+
+v0.2.0 : site files are opened lazily, --start/--end restrict the plot to a time window and --resample plots daily or
+    monthly means computed in xarray, only the reduced series is converted to plotting arrays.
+
+v0.1.2 : species are discovered from the dataset and ratios computed with a single array operation, for any number of
+    species. get_ratios no longer modifies its input.
+
 v0.0.0 : initial release, tested with both 5/7 species files
 """
 
 __author__ = "jerome.colin'at'cesbio.cnes.fr"
 __license__ = "MIT"
-__version__ = "0.1.1"
+__version__ = "0.4.2"
 
-import sys, argparse
+import sys, os, argparse, glob, time
+import importlib.util
+import functools
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
 import xarray as xr
 import matplotlib.pyplot as pl
+import cams_catalog
+import cams_instrument
+
+# Files are opened as Dask arrays when Dask is installed
+CHUNKS = {} if importlib.util.find_spec("dask") else None
 
+# CAMS AOD species, in the order of the 7-species products
+SPECIES = ['duaod550', 'omaod550', 'bcaod550', 'suaod550', 'ssaod550', 'niaod550', 'amaod550']
 
-def get_df(filename):
+SPECIES_LABELS = {'duaod550': 'dust', 'omaod550': 'organic matter', 'bcaod550': 'black carbon',
+                  'suaod550': 'sufate', 'ssaod550': 'sea salt', 'niaod550': 'nitrate', 'amaod550': 'ammonium'}
+
+RESAMPLE = {'daily': '1D', 'monthly': '1MS'}
+
+SPECIES_COLORS = {'duaod550': 'tab:orange', 'omaod550': 'tab:green', 'bcaod550': 'tab:grey',
+                  'suaod550': 'tab:red', 'ssaod550': 'tab:blue', 'niaod550': 'tab:cyan', 'amaod550': 'tab:olive'}
+
+
+def open_dataset(filename):
     """
-    Convert netCDF to Pandas dataframe
-    :param filename: netCDF AOD file
+    Open a site time series lazily, either a netCDF file or a Zarr store. With Dask installed, data is opened as Dask
+    arrays following the chunks of the file, so that only the chunks overlapping a time window are read.
+    :param filename: netCDF AOD file or Zarr store
+    :return: an xarray dataset with a single 'time' dimension
+    """
+    cams_instrument.opened(filename)
+    if filename.rstrip("/").endswith(".zarr"):
+        dataset = xr.open_zarr(filename, consolidated=True, chunks=CHUNKS)
+    else:
+        dataset = xr.open_dataset(filename, chunks=CHUNKS)
+
+    return dataset.drop_vars([c for c in ('latitude', 'longitude') if c in dataset.variables])
+
+
+def merge_species(datasets):
+    """
+    Concatenate datasets along time on the union of their species, species missing from a dataset (eg. nitrate and
+    ammonium before the shift to 7 species) are filled as missing values
+    :param datasets: list of lazily opened site datasets, in time order
+    :return: an xarray dataset
+    """
+    # Species outside the usual CAMS order keep the order they are first met in, from one run to the next
+    species = get_species(dict.fromkeys(name for dataset in datasets for name in dataset.data_vars))
+
+    aligned = []
+    for dataset in datasets:
+        template = dataset[list(dataset.data_vars)[0]]
+        missing = {s: xr.full_like(template, np.nan) for s in species if s not in dataset.data_vars}
+        aligned.append(dataset.assign(missing)[species])
+
+    return xr.concat(aligned, dim='time')
+
+
+def open_site(filename, start=None, end=None, resample=None):
+    """
+    Open a site time series lazily, restricted to a time window and optionally resampled. Only the time coordinate is
+    read here, data of the window is read when the result is used.
+    :param filename: netCDF AOD file or Zarr store, or a list of them to merge along time
+    :param start: first time step as datetime, None for no lower bound
+    :param end: last time step as datetime (included), None for no upper bound
+    :param resample: None, 'daily' or 'monthly' mean
+    :return: an xarray dataset with a single 'time' dimension
+    """
+    if isinstance(filename, list):
+        dataset = merge_species([open_dataset(f) for f in filename])
+    else:
+        dataset = open_dataset(filename)
+
+    if not dataset.indexes['time'].is_monotonic_increasing:
+        dataset = dataset.sortby('time')
+
+    dataset = dataset.sel(time=slice(start, end))
+
+    if resample is not None:
+        dataset = dataset.resample(time=RESAMPLE[resample]).mean()
+
+    return dataset
+
+
+def get_merged_files(filename):
+    """
+    Return the existing 5-species and 7-species files of the site of filename
+    :param filename: either the '_5' or the '_7' file of a site
+    :return: list of filenames, in time order
+    """
+    root, extension = os.path.splitext(filename.rstrip("/"))
+    filenames = [f for f in ("%s_5%s" % (root[:-2], extension), "%s_7%s" % (root[:-2], extension))
+                 if os.path.exists(f)]
+
+    if len(filenames) == 0:
+        print("ERROR: no 5 or 7 species file matching %s" % filename)
+        sys.exit(1)
+
+    return filenames
+
+
+def get_df(filename, start=None, end=None, resample=None):
+    """
+    Convert netCDF to Pandas dataframe, only reading the requested time window
+    :param filename: netCDF AOD file or Zarr store, or a list of them to merge along time
+    :param start: first time step as datetime, None for no lower bound
+    :param end: last time step as datetime (included), None for no upper bound
+    :param resample: None, 'daily' or 'monthly' mean
     :return: a Pandas dataframe
     """
-    dataset = xr.open_dataset(filename)  # , engine='netcdf4').to_dataframe()
-    df = dataset.to_dataframe()
-    df.pop('latitude')
-    df.pop('longitude')
-    df = df.sort_index()
-    # df.reset_index(inplace=True)
+    with cams_instrument.stage("open"):
+        dataset = open_site(filename, start=start, end=end, resample=resample)
+    with cams_instrument.stage("read"):
+        df = pd.DataFrame({v: dataset[v].values for v in dataset.data_vars}, index=dataset.indexes['time'])
+    dataset.close()
 
     return df
 
@@ -39,92 +163,287 @@ def get_mode(filename):
     :param filename:
     :return: 5 or 7
     """
-    if (filename.split(".")[0][-2:]) == "_5":
+    suffix = os.path.splitext(filename.rstrip("/"))[0][-2:]
+    if suffix == "_5":
         return 5
-    if (filename.split(".")[0][-2:]) == "_7":
+    if suffix == "_7":
         return 7
     else:
         print("ERROR: no mode matching filename")
         sys.exit(1)
 
 
-def get_ratios(df_i, mode=5):
-    """
-    Get ratios from AODs
-    :param df_i:
-    :param mode:
-    :return: a dataframe
-    """
-    # deep copy, preserves original df
-    df = df_i.copy(deep=True)
-
-    if mode == 5:
-        species = ['duaod550', 'omaod550', 'bcaod550', 'suaod550', 'ssaod550']
-        df['Total'] = df['duaod550'] + df['omaod550'] + df['bcaod550'] + df['suaod550'] + df['ssaod550']
-        df['rduaod550'] = df['duaod550'] / df['Total']
-        df['romaod550'] = df['omaod550'] / df['Total']
-        df['rbcaod550'] = df['bcaod550'] / df['Total']
-        df['rsuaod550'] = df['suaod550'] / df['Total']
-        df['rssaod550'] = df['ssaod550'] / df['Total']
-        df = df.drop(['duaod550', 'omaod550', 'bcaod550', 'suaod550', 'ssaod550', 'Total'], axis=1)
-        df_i.columns = ['dust', 'organic matter', 'black carbon', 'sufate', 'sea salt']
-        df.columns = ['dust', 'organic matter', 'black carbon', 'sufate', 'sea salt']
-
-    elif mode == 7:
-        species = ['duaod550', 'omaod550', 'bcaod550', 'suaod550', 'ssaod550']
-        df['Total'] = df['duaod550'] + df['omaod550'] + df['bcaod550'] + df['suaod550'] + df['ssaod550'] \
-                      + df['niaod550'] + df['amaod550']
-        df['rduaod550'] = df['duaod550'] / df['Total']
-        df['romaod550'] = df['omaod550'] / df['Total']
-        df['rbcaod550'] = df['bcaod550'] / df['Total']
-        df['rsuaod550'] = df['suaod550'] / df['Total']
-        df['rssaod550'] = df['ssaod550'] / df['Total']
-        df['rniaod550'] = df['niaod550'] / df['Total']
-        df['ramaod550'] = df['amaod550'] / df['Total']
-        df = df.drop(['duaod550', 'omaod550', 'bcaod550', 'suaod550', 'ssaod550', 'niaod550', 'amaod550', 'Total'],
-                     axis=1)
-        df_i.columns = ['dust', 'organic matter', 'black carbon', 'sufate', 'sea salt', 'nitrate', 'ammonium']
-        df.columns = ['dust', 'organic matter', 'black carbon', 'sufate', 'sea salt', 'nitrate', 'ammonium']
+def get_species(df):
+    """
+    Discover AOD species from the columns of a dataframe, in the usual CAMS order
+    :param df: a dataframe of AODs, or any iterable of variable names
+    :return: list of species column names
+    """
+    species = [c for c in getattr(df, "columns", df) if c.endswith("aod550")]
+
+    return sorted(species, key=lambda s: SPECIES.index(s) if s in SPECIES else len(SPECIES))
+
+
+def get_site_stem(filename):
+    """
+    Return the name of a site file without its directory, extension and '_5'/'_7' suffix
+    :param filename: site file, eg. 'ncfiles/cams_aod_toulouse_5.nc'
+    :return: eg. 'cams_aod_toulouse'
+    """
+    root = os.path.splitext(os.path.basename(filename.rstrip("/")))[0]
+
+    return root[:-2] if root[-2:] in ("_5", "_7") else root
+
+
+def get_site_prefix(files):
+    """
+    Return the name prefix shared by the site files of a batch, ie. the output name given to cams_extract_aod
+    :param files: list of site files
+    :return: prefix up to its last '_', None if the files belong to a single site
+    """
+    stems = sorted(set(get_site_stem(f) for f in files))
+    if len(stems) < 2:
+        return None
+
+    prefix = os.path.commonprefix(stems)
+
+    return prefix[:prefix.rfind("_") + 1]
+
+
+def guess_sitename(filename, prefix=None):
+    """
+    Guess the site name of a site file '<prefix><site>_5.nc'
+    :param filename: site file
+    :param prefix: name prefix of the site files of a batch (see get_site_prefix), None to take the third '_'-separated
+        field of the name (eg. 'cams_aod_toulouse_5.nc'), or its last field if it has fewer
+    :return: site name
+    """
+    stem = get_site_stem(filename)
+    if prefix is not None and stem.startswith(prefix) and len(stem) > len(prefix):
+        return stem[len(prefix):]
+
+    fields = stem.split("_")
+
+    return fields[2] if len(fields) > 2 else fields[-1]
 
-    return df
 
+def get_png_name(outdir, sitename, mode):
+    """
+    :param outdir: path to output PNG
+    :param sitename: site name
+    :param mode: 5, 7 or 'merged'
+    :return: PNG filename of a site timeline
+    """
+    return "%s/%s_%s.png" % (outdir, sitename, mode)
 
-def plot_aod(filename, sitename, outdir):
+
+def get_ratios(df_i):
+    """
+    Get ratios from AODs, for any number of species found in the dataframe. The input dataframe is left untouched.
+    Missing species (eg. nitrate and ammonium before the shift to 7 species) do not contribute to the total.
+    :param df_i: a dataframe of AODs
+    :return: a dataframe of species contribution to total AOD, with species labels as columns
+    """
+    species = get_species(df_i)
+
+    aod = df_i[species].to_numpy()
+    ratios = aod / np.nansum(aod, axis=1, keepdims=True)
+
+    return pd.DataFrame(ratios, index=df_i.index, columns=[SPECIES_LABELS.get(s, s) for s in species])
+
+
+def plot_aod(filename, sitename, outdir, start=None, end=None, resample=None, merge=False, fig=None):
     """
     Plot routine
     :param filename:
     :param sitename:
-    :return: a PNG file
+    :param outdir:
+    :param start: first time step as datetime, None for no lower bound
+    :param end: last time step as datetime (included), None for no upper bound
+    :param resample: None, 'daily' or 'monthly' mean
+    :param merge: if True, plot the 5-species and 7-species files of the site as a single timeline
+    :param fig: optional figure to reuse, it is cleared but not closed. Otherwise a new figure is closed after saving.
+    :return: PNG filename
     """
-    mode = get_mode(filename)
+    if merge:
+        filename = get_merged_files(filename)
+        mode = "merged"
+        label = "5/7"
+    else:
+        mode = get_mode(filename)
 
     if sitename=="guess":
-        sitename = filename.split("/")[-1].split("_")[2]
+        sitename = guess_sitename(filename[0] if merge else filename)
 
-    df_aod = get_df(filename)
-    df_aod_ratio = get_ratios(df_aod, mode)
+    df_aod = get_df(filename, start=start, end=end, resample=resample)
+    species = get_species(df_aod)
+    with cams_instrument.stage("ratios"):
+        df_aod_ratio = get_ratios(df_aod)
 
-    fig, (ax1, ax2) = pl.subplots(2)
+    df_aod = df_aod[species]
+    df_aod.columns = [SPECIES_LABELS.get(s, s) for s in species]
+    colors = [SPECIES_COLORS.get(s) for s in species]
+    if not merge:
+        label = "%i" % len(species)
 
-    if mode == 5:
-        colors = ['tab:orange', 'tab:green', 'tab:grey', 'tab:red', 'tab:blue']
+    close = fig is None
+    with cams_instrument.stage("plot"):
+        if fig is None:
+            fig = pl.figure()
+        else:
+            fig.clear()
+        ax1, ax2 = fig.subplots(2)
 
-        df_aod.plot.area(stacked=True, ax=ax1, title=("CAMS AOD over %s (5-species)" % sitename), ylabel="AOD(550nm)",
-                         figsize=(16, 8), color=colors).legend(loc='center left', bbox_to_anchor=(1.0, 0.5))
+        df_aod.plot.area(stacked=True, ax=ax1, title=("CAMS AOD over %s (%s-species)" % (sitename, label)),
+                         ylabel="AOD(550nm)", figsize=(16, 8), color=colors).legend(loc='center left',
+                                                                                    bbox_to_anchor=(1.0, 0.5))
         df_aod_ratio.plot.area(stacked=True, ylim=(0, 1), ax=ax2, ylabel="Contribution to AOD(550nm) in %",
                                figsize=(16, 8),
                                color=colors).legend(loc='center left', bbox_to_anchor=(1.0, 0.5))
 
-    elif mode == 7:
-        colors = ['tab:orange', 'tab:green', 'tab:grey', 'tab:red', 'tab:blue', 'tab:cyan', 'tab:olive']
+    png = get_png_name(outdir, sitename, mode)
+    with cams_instrument.stage("savefig"):
+        fig.savefig(png)
+    if close:
+        pl.close(fig)
 
-        df_aod.plot.area(stacked=True, ax=ax1, title=("CAMS AOD over %s (7-species)" % sitename), ylabel="AOD(550nm)",
-                         figsize=(16, 8), color=colors).legend(loc='center left', bbox_to_anchor=(1.0, 0.5))
-        df_aod_ratio.plot.area(stacked=True, ylim=(0, 1), ax=ax2, ylabel="Contribution to AOD(550nm) in %",
-                               figsize=(16, 8),
-                               color=colors).legend(loc='center left', bbox_to_anchor=(1.0, 0.5))
+    return png
+
+
+def list_site_files(pattern, merge=False):
+    """
+    List the site files matching a glob pattern, or the '_5'/'_7' files of a directory
+    :param pattern: glob pattern or directory
+    :param merge: if True, keep a single file per site
+    :return: sorted list of filenames
+    """
+    if os.path.isdir(pattern) and not pattern.rstrip("/").endswith(".zarr"):
+        files = glob.glob(os.path.join(pattern, "*_[57].nc")) + glob.glob(os.path.join(pattern, "*_[57].zarr"))
+    else:
+        files = glob.glob(pattern)
+    files = sorted(f.rstrip("/") for f in files)
 
-    pl.savefig("%s/%s_%s.png" % (outdir, sitename, mode))
+    if merge:
+        sites = {}
+        for f in files:
+            sites.setdefault(os.path.splitext(f)[0][:-2], f)
+        files = sorted(sites.values())
+
+    return files
+
+
+# Figure reused by all the sites rendered in a process
+_figure = None
+
+
+def close_figure():
+    """
+    Close the figure reused by the sites rendered in this process
+    :return: None
+    """
+    global _figure
+
+    if _figure is not None:
+        pl.close(_figure)
+        _figure = None
+
+
+def _init_render_worker():
+    pl.switch_backend("Agg")
+
+
+def render_site(site, outdir, start=None, end=None, resample=None, merge=False):
+    """
+    Render the timeline of a site on the figure of the current process
+    :param site: (2) site file, site name
+    :param outdir: path to output PNG
+    :param start: first time step as datetime, None for no lower bound
+    :param end: last time step as datetime (included), None for no upper bound
+    :param resample: None, 'daily' or 'monthly' mean
+    :param merge: if True, plot the 5-species and 7-species files of the site as a single timeline
+    :return: (3) filename, PNG filename, rendering time in seconds
+    """
+    global _figure
+
+    filename, sitename = site
+    if _figure is None:
+        _figure = pl.figure()
+
+    t0 = time.perf_counter()
+    png = plot_aod(filename, sitename, outdir, start=start, end=end, resample=resample, merge=merge, fig=_figure)
+
+    return filename, png, time.perf_counter() - t0
+
+
+def render_batch(batch, renderer):
+    """
+    Render a batch of sites in a worker process, reusing the figure from one site to the next and closing it once the
+    batch is rendered
+    :param batch: list of (site file, site name)
+    :param renderer: picklable function of a (site file, site name) returning (filename, PNG, time), eg. render_site
+    :return: list of (filename, PNG filename, rendering time in seconds)
+    """
+    try:
+        return [renderer(site) for site in batch]
+    finally:
+        close_figure()
+
+
+def plot_batch(pattern, outdir, start=None, end=None, resample=None, merge=False, workers=1):
+    """
+    Render the timelines of all the site files matching pattern, over a process pool. Each process creates its figure
+    once and reuses it for every site it renders. Site names are the file names stripped of their common prefix and
+    '_5'/'_7' suffix, two files that would be rendered to the same PNG are an error.
+    :param pattern: glob pattern or directory of site files
+    :param outdir: path to output PNG
+    :param start: first time step as datetime, None for no lower bound
+    :param end: last time step as datetime (included), None for no upper bound
+    :param resample: None, 'daily' or 'monthly' mean
+    :param merge: if True, plot the 5-species and 7-species files of each site as a single timeline
+    :param workers: number of worker processes, 1 renders in the current process
+    :return: list of PNG filenames
+    """
+    files = list_site_files(pattern, merge=merge)
+    prefix = get_site_prefix(files)
+    sites = [(filename, guess_sitename(filename, prefix=prefix)) for filename in files]
+
+    # Sites rendered to the same PNG would silently overwrite each other
+    rendered = {}
+    for filename, sitename in sites:
+        png = get_png_name(outdir, sitename, "merged" if merge else get_mode(filename))
+        if png in rendered:
+            print("ERROR: %s and %s would both be rendered to %s" % (rendered[png], filename, png))
+            sys.exit(1)
+        rendered[png] = filename
+
+    print("INFO: rendering %i site files with %i worker(s)" % (len(files), workers))
+
+    renderer = functools.partial(render_site, outdir=outdir, start=start, end=end, resample=resample, merge=merge)
+
+    t0 = time.perf_counter()
+    pngs = []
+
+    if workers > 1:
+        size = max(1, min(16, len(sites) // (workers * 4)))
+        batches = [sites[i:i + size] for i in range(0, len(sites), size)]
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_render_worker) as executor:
+            batch_renderer = functools.partial(render_batch, renderer=renderer)
+            for batch in cams_instrument.pool_imap(executor, batch_renderer, batches, window=workers * 2):
+                for filename, png, elapsed in batch:
+                    print("INFO: %s rendered to %s in %.2f s" % (filename, png, elapsed))
+                    pngs.append(png)
+    else:
+        _init_render_worker()
+        try:
+            for filename, png, elapsed in map(renderer, sites):
+                print("INFO: %s rendered to %s in %.2f s" % (filename, png, elapsed))
+                pngs.append(png)
+        finally:
+            close_figure()
+
+    print("INFO: %i sites rendered in %.2f s" % (len(pngs), time.perf_counter() - t0))
+
+    return pngs
 
 
 def main():
@@ -134,12 +453,33 @@ def main():
     """
     # Argument parser
     parser = argparse.ArgumentParser()
-    parser.add_argument("filename", help="netCDF file produced by cams_extract_aod")
+    parser.add_argument("filename", help="netCDF file or Zarr store produced by cams_extract_aod, or with --batch a glob "
+                                         "pattern or a directory of such files")
     parser.add_argument("--sitename", help="Name of the location (for plot title)", default="guess")
     parser.add_argument("--outdir", help="Path to output PNG", default=".")
+    parser.add_argument("--start", help="Plot from this date (YYYY-MM-DD[THH:MM])", type=cams_catalog.parse_date)
+    parser.add_argument("--end", help="Plot up to this date (YYYY-MM-DD[THH:MM])", type=cams_catalog.parse_date)
+    parser.add_argument("--resample", help="Plot daily or monthly means", choices=sorted(RESAMPLE))
+    parser.add_argument("--merge", help="Plot the _5 and _7 files of the site as a single timeline",
+                        action="store_true")
+    parser.add_argument("--batch", help="Plot every site file matching filename (glob pattern or directory)",
+                        action="store_true")
+    parser.add_argument("--workers", help="Number of worker processes rendering plots in batch mode, defaults to 1",
+                        type=int, default=1)
+    parser.add_argument("--profile", help="Print stage timings, files opened, bytes read and peak memory at exit, as a "
+                                          "table (default) or JSON, 'log' also prints a JSON record per stage call",
+                        nargs="?", const="table", choices=cams_instrument.FORMATS)
     args = parser.parse_args()
 
-    plot_aod(args.filename, args.sitename, args.outdir)
+    if args.profile is not None:
+        cams_instrument.start(args.profile)
+
+    if args.batch:
+        plot_batch(args.filename, args.outdir, start=args.start, end=args.end, resample=args.resample,
+                   merge=args.merge, workers=args.workers)
+    else:
+        plot_aod(args.filename, args.sitename, args.outdir, start=args.start, end=args.end, resample=args.resample,
+                 merge=args.merge)
 
     sys.exit(0)
 
@@ -0,0 +1,272 @@
+#! /usr/bin/env python
+
+"""
+CAMS tools benchmark
+
+Purpose : time the main code paths of the tools on a synthetic collection written by cams_synthetic, entirely offline.
+    Scenarios are the extraction of a list of sites (serial, and over a process pool with --workers), the timeline
+    plots of the extracted files, the synthesis plots of the collection and the computation of AOD ratios. Each
+    scenario is run --repeat times and timings are written to a JSON file that can be compared with a previous run
+    (--compare) to catch regressions.
+
+v0.0.0 : initial release
+"""
+
+__author__ = "jerome.colin'at'cesbio.cnes.fr"
+__license__ = "MIT"
+__version__ = "0.0.0"
+
+import argparse, sys, os, io, json, time, shutil, tempfile, platform, contextlib
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import xarray as xr
+import matplotlib
+matplotlib.use("Agg")
+import cams_synthetic
+import cams_extract_aod
+import cams_aod_timeline
+import cams_visu
+
+SIZES = {
+    "small": {"products": 16, "resolution": 3.},
+    "medium": {"products": 64, "resolution": 1.5},
+    "large": {"products": 256, "resolution": 0.75},
+}
+
+SITES = (["Lille", "Calcuta", "Dakar", "Beijing", "Lima"], [50.5, 22.5, 14.7, 39.9, -12.0],
+         [3.2, 88.3, -17.4, 116.4, -77.0])
+
+SCENARIOS = ("generate", "extract", "extract_parallel", "timeline", "synthesis", "get_ratios")
+
+
+def run_scenario(name, function, repeat=3, items=None, verbose=False):
+    """
+    Time a scenario
+    :param name: scenario name
+    :param function: function without argument running the scenario once
+    :param repeat: number of runs
+    :param items: number of items (products, plots, rows) processed by a run, to report a throughput
+    :param verbose: if False, messages printed by the scenario are discarded
+    :return: a dict of timings in seconds
+    """
+    seconds = []
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        if verbose:
+            function()
+        else:
+            with contextlib.redirect_stdout(io.StringIO()):
+                function()
+        seconds.append(time.perf_counter() - t0)
+
+    result = {"seconds": seconds, "min": min(seconds), "median": float(np.median(seconds)), "items": items}
+    if items is not None:
+        result["throughput"] = items / result["min"]
+
+    print("INFO: %-16s min %8.3f s, median %8.3f s%s" % (name, result["min"], result["median"],
+                                                         "" if items is None else
+                                                         ", %.1f items/s" % result["throughput"]))
+
+    return result
+
+
+def get_ratios_frame(rows, seed=0):
+    """
+    Build a dataframe of 7 species AODs, with nitrate and ammonium missing in the first half of the rows
+    :param rows: number of rows
+    :param seed: seed of the random values
+    :return: a Pandas dataframe
+    """
+    rng = np.random.default_rng(seed)
+    data = {s: (rng.random(rows) * 0.1).astype(np.float32) for s in cams_aod_timeline.SPECIES}
+    for s in ("niaod550", "amaod550"):
+        data[s][:rows // 2] = np.nan
+
+    return pd.DataFrame(data, index=pd.date_range("2017-01-01", periods=rows, freq="3h"))
+
+
+def bench(workdir, products, resolution, repeat=3, workers=4, synthesis_products=8, rows=100000, scenarios=SCENARIOS,
+          verbose=False):
+    """
+    Run the benchmark scenarios
+    :param workdir: working directory for the collection and outputs
+    :param products: number of products of the synthetic collection
+    :param resolution: grid step in degrees
+    :param repeat: number of runs of each scenario
+    :param workers: number of worker processes of the parallel scenario
+    :param synthesis_products: number of products plotted by the synthesis scenario
+    :param rows: number of rows of the get_ratios scenario
+    :param scenarios: scenarios to run
+    :param verbose: if True, messages printed by the tools are kept
+    :return: a dict of results per scenario
+    """
+    collection = os.path.join(workdir, "collection")
+    outputs = os.path.join(workdir, "outputs")
+    figures = os.path.join(workdir, "figures")
+    names, lats, lons = SITES
+    results = {}
+
+    def generate():
+        shutil.rmtree(collection, ignore_errors=True)
+        cams_synthetic.make_collection(collection, products, resolution=resolution)
+
+    # The collection is needed by every other scenario, write it once even if its timing is not requested
+    if "generate" in scenarios:
+        results["generate"] = run_scenario("generate", generate, repeat=1, items=products, verbose=verbose)
+    else:
+        with contextlib.redirect_stdout(io.StringIO()):
+            generate()
+
+    for directory in (outputs, figures):
+        os.makedirs(directory, exist_ok=True)
+
+    output = os.path.join(outputs, "cams_aod.nc")
+
+    def extract(n_workers):
+        return lambda: cams_extract_aod.extract(collection, output, lats, lons, names=names, workers=n_workers)
+
+    # The timeline scenario plots the outputs of the extraction
+    if "extract" in scenarios or "timeline" in scenarios:
+        results["extract"] = run_scenario("extract", extract(1), repeat=repeat, items=products, verbose=verbose)
+
+    if "extract_parallel" in scenarios and workers > 1:
+        results["extract_parallel"] = run_scenario("extract_parallel", extract(workers), repeat=repeat,
+                                                   items=products, verbose=verbose)
+
+    if "timeline" in scenarios:
+        files = cams_aod_timeline.list_site_files(outputs)
+        results["timeline"] = run_scenario("timeline",
+                                           lambda: cams_aod_timeline.plot_batch(outputs, figures, workers=1),
+                                           repeat=repeat, items=len(files), verbose=verbose)
+
+    if "synthesis" in scenarios:
+        subset = [cams_visu.get_products(p) for p in cams_visu.get_collection(collection)][:synthesis_products]
+
+        def synthesis():
+            cwd = os.getcwd()
+            os.chdir(figures)
+            try:
+                cams_visu.render_collection(subset, lats[0], lons[0], site_name=names[0])
+            finally:
+                os.chdir(cwd)
+
+        results["synthesis"] = run_scenario("synthesis", synthesis, repeat=repeat, items=len(subset),
+                                            verbose=verbose)
+
+    if "get_ratios" in scenarios:
+        df = get_ratios_frame(rows)
+        results["get_ratios"] = run_scenario("get_ratios", lambda: cams_aod_timeline.get_ratios(df), repeat=repeat,
+                                             items=rows, verbose=verbose)
+
+    return results
+
+
+def get_environment():
+    """
+    Describe the environment of a benchmark run
+    :return: a dict of versions
+    """
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "xarray": xr.__version__,
+        "matplotlib": matplotlib.__version__,
+        "cams_extract_aod": cams_extract_aod.__version__,
+        "cams_aod_timeline": cams_aod_timeline.__version__,
+        "cams_visu": cams_visu.__version__,
+    }
+
+
+def compare(report, reference_file):
+    """
+    Print the ratio of the best timings of a run to the ones of a previous run
+    :param report: dict of the run, with its config and results
+    :param reference_file: JSON file written by a previous run
+    :return: None
+    """
+    try:
+        with open(reference_file) as f:
+            reference = json.load(f)
+    except FileNotFoundError as e:
+        print(e)
+        sys.exit(1)
+
+    if reference["config"] != report["config"]:
+        print("WARNING: configuration differs from the one of %s, timings may not be comparable" % reference_file)
+
+    results = report["results"]
+    reference = reference["results"]
+
+    for name, result in results.items():
+        if name not in reference:
+            continue
+        ratio = result["min"] / reference[name]["min"]
+        print("INFO: %-16s %8.3f s -> %8.3f s (x%.2f)%s" % (name, reference[name]["min"], result["min"], ratio,
+                                                             "  WARNING: slower" if ratio > 1.1 else ""))
+
+
+def main():
+    """
+    Write a synthetic collection, time the scenarios and output their timings
+    :return: a JSON file
+    """
+    # Argument parser
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", help="Size of the synthetic collection, defaults to small", choices=sorted(SIZES),
+                        default="small")
+    parser.add_argument("--products", help="Number of products, overrides --size", type=int)
+    parser.add_argument("--resolution", help="Grid step in degrees, overrides --size", type=float)
+    parser.add_argument("--repeat", help="Number of runs of each scenario, defaults to 3", type=int, default=3)
+    parser.add_argument("--workers", help="Number of worker processes of the parallel extraction, defaults to 4",
+                        type=int, default=4)
+    parser.add_argument("--synthesis-products", help="Number of products plotted by the synthesis scenario, "
+                                                     "defaults to 8", type=int, default=8)
+    parser.add_argument("--rows", help="Number of rows of the get_ratios scenario, defaults to 100000", type=int,
+                        default=100000)
+    parser.add_argument("--scenarios", help="Scenarios to run, defaults to all", nargs="+", choices=SCENARIOS,
+                        default=list(SCENARIOS))
+    parser.add_argument("--workdir", help="Working directory, defaults to a temporary directory removed at exit")
+    parser.add_argument("--output", help="JSON file of the results")
+    parser.add_argument("--compare", help="JSON file of a previous run to compare with")
+    parser.add_argument("--verbose", help="Keep the messages of the tools", action="store_true")
+    args = parser.parse_args()
+
+    products = args.products or SIZES[args.size]["products"]
+    resolution = args.resolution or SIZES[args.size]["resolution"]
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="cams_bench_")
+    print("INFO: benchmark of %i products on a %g deg grid in %s" % (products, resolution, workdir))
+
+    try:
+        results = bench(workdir, products, resolution, repeat=args.repeat, workers=args.workers,
+                        synthesis_products=args.synthesis_products, rows=args.rows, scenarios=args.scenarios,
+                        verbose=args.verbose)
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "config": {"products": products, "resolution": resolution, "repeat": args.repeat, "workers": args.workers,
+                   "synthesis_products": args.synthesis_products, "rows": args.rows},
+        "environment": get_environment(),
+        "results": results,
+    }
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print("INFO: results written to %s" % args.output)
+
+    if args.compare is not None:
+        compare(report, args.compare)
+
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
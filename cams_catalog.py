@@ -0,0 +1,290 @@
+#! /usr/bin/env python
+
+"""
+CAMS collection catalog
+
+Purpose : index a collection of CAMS products (AOT, MR and RH netCDF files in StartMaja .DIR directories) in a small
+    SQLite catalog, so that tools can query products by kind and time range instead of walking the collection on every
+    run. For each product, the catalog records its kind, timestamp, species count, level count and grid fingerprint.
+
+    The catalog is refreshed incrementally: directories whose modification time did not change since the last refresh
+    are not listed again, and only new or modified files are opened.
+
+v0.0.1 : queries are restricted to the products under the collection path, so that a catalog shared by several
+    collections only returns the products of the one queried (--list included), and get_collection refreshes the
+    catalog on every call. Directories holding a product that could not be registered are checked again on the next
+    refresh instead of being skipped until --full.
+
+v0.0.0 : initial release
+"""
+
+__author__ = "jerome.colin'at'cesbio.cnes.fr"
+__license__ = "MIT"
+__version__ = "0.0.1"
+
+import argparse, sys, os
+import sqlite3
+from datetime import datetime
+import netCDF4 as nc
+import cams_grid
+
+KINDS = ("AOT", "MR", "RH")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS products (
+    path TEXT PRIMARY KEY,
+    directory TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    mtime REAL NOT NULL,
+    n_species INTEGER,
+    n_levels INTEGER,
+    grid TEXT
+);
+CREATE INDEX IF NOT EXISTS products_kind_timestamp ON products (kind, timestamp);
+CREATE TABLE IF NOT EXISTS directories (
+    path TEXT PRIMARY KEY,
+    mtime REAL NOT NULL,
+    leaf INTEGER NOT NULL
+);
+"""
+
+
+def get_timestamp(file):
+    """
+    Parse filename and returns timestamp
+    :param file: filename
+    :return: timestamp as datetime
+    """
+    ts_str = file.split("/")[-1].split("_")[-1].split(".")[0]
+
+    return datetime(int(ts_str[:4]), int(ts_str[4:6]), int(ts_str[6:8]), int(ts_str[11:13]), int(ts_str[13:15]))
+
+
+def get_kind(file):
+    """
+    Return the kind of a CAMS product from its filename
+    :param file: filename
+    :return: 'AOT', 'MR', 'RH' or None
+    """
+    for kind in KINDS:
+        if "_%s_" % kind in file.split("/")[-1]:
+            return kind
+
+    return None
+
+
+def describe_product(file):
+    """
+    Open a product and return its species count, level count and grid fingerprint
+    :param file: netCDF filename
+    :return: (3) n_species, n_levels, grid fingerprint
+    """
+    with nc.Dataset(file) as dataset:
+        n_species = len([v for v in dataset.variables if v.endswith("aod550") or v.startswith("aermr")])
+        n_levels = len(dataset.dimensions["level"]) if "level" in dataset.dimensions else None
+        grid = cams_grid.grid_fingerprint(dataset["latitude"][:], dataset["longitude"][:])
+
+    return n_species, n_levels, grid
+
+
+def connect(catalog):
+    """
+    Open a catalog, creating its tables if needed
+    :param catalog: SQLite filename
+    :return: sqlite3 connection
+    """
+    connection = sqlite3.connect(catalog)
+    connection.row_factory = sqlite3.Row
+    connection.executescript(SCHEMA)
+
+    return connection
+
+
+def _scan(connection, path, known_dirs, seen_files, stats, full=False):
+    """
+    Recursively scan path, skipping leaf directories whose modification time did not change. The modification time of
+    a directory is not recorded when one of its products could not be registered, so that it is checked again.
+    """
+    mtime = os.stat(path).st_mtime
+    if not full and path in known_dirs and known_dirs[path]["leaf"] and known_dirs[path]["mtime"] == mtime:
+        stats["skipped"] += 1
+        for row in connection.execute("SELECT path FROM products WHERE directory = ?", (path,)):
+            seen_files.add(row["path"])
+        return
+
+    leaf = True
+    complete = True
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                leaf = False
+                _scan(connection, entry.path, known_dirs, seen_files, stats, full=full)
+            elif entry.name.endswith(".nc") and get_kind(entry.name) is not None:
+                seen_files.add(entry.path)
+                complete = _register(connection, entry, path, stats) and complete
+
+    if complete:
+        connection.execute("INSERT OR REPLACE INTO directories VALUES (?, ?, ?)", (path, mtime, int(leaf)))
+    else:
+        connection.execute("DELETE FROM directories WHERE path = ?", (path,))
+
+
+def _register(connection, entry, directory, stats):
+    """
+    Add or update a product in the catalog if it is new or has been modified
+    :return: False if the product could not be registered
+    """
+    mtime = entry.stat().st_mtime
+    row = connection.execute("SELECT mtime FROM products WHERE path = ?", (entry.path,)).fetchone()
+    if row is not None and row["mtime"] == mtime:
+        return True
+
+    try:
+        timestamp = get_timestamp(entry.path)
+        n_species, n_levels, grid = describe_product(entry.path)
+    except (OSError, ValueError, IndexError) as e:
+        print("WARNING: unable to register %s (%s)" % (entry.path, e))
+        return False
+
+    connection.execute("INSERT OR REPLACE INTO products VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                       (entry.path, directory, get_kind(entry.name), timestamp.isoformat(), mtime, n_species,
+                        n_levels, grid))
+    stats["registered"] += 1
+
+    return True
+
+
+def refresh(catalog, path, full=False):
+    """
+    Build or incrementally refresh the catalog of the collection in path. Files rewritten in place do not change the
+    modification time of their directory, use full=True to check every file.
+    :param catalog: SQLite filename
+    :param path: path to a CAMS collection
+    :param full: if True, list every directory even if its modification time did not change
+    :return: number of products in the catalog
+    """
+    path = os.path.abspath(path)
+    connection = connect(catalog)
+    stats = {"registered": 0, "skipped": 0}
+
+    known_dirs = {row["path"]: row for row in connection.execute("SELECT * FROM directories")}
+    seen_files = set()
+
+    with connection:
+        _scan(connection, path, known_dirs, seen_files, stats, full=full)
+
+        # Forget products removed from the collection
+        root = os.path.join(path, "")
+        stale = [row["path"] for row in connection.execute("SELECT path FROM products")
+                 if row["path"].startswith(root) and row["path"] not in seen_files]
+        connection.executemany("DELETE FROM products WHERE path = ?", [(p,) for p in stale])
+
+    count = connection.execute("SELECT COUNT(*) FROM products").fetchone()[0]
+    connection.close()
+
+    print("INFO: catalog %s refreshed, %i products registered, %i removed, %i unchanged directories skipped, "
+          "%i products total" % (catalog, stats["registered"], len(stale), stats["skipped"], count))
+
+    return count
+
+
+def query(catalog, kind=None, start=None, end=None, path=None):
+    """
+    Query products by kind, time range and collection
+    :param catalog: SQLite filename
+    :param kind: 'AOT', 'MR', 'RH' or None for all kinds
+    :param start: first timestamp as datetime, None for no lower bound
+    :param end: last timestamp as datetime (included), None for no upper bound
+    :param path: path to a CAMS collection, None for all the products of the catalog
+    :return: list of products as dict, sorted by timestamp
+    """
+    clauses = []
+    parameters = []
+    if path is not None:
+        # Same prefix as refresh, compared exactly (LIKE is case insensitive and '_' is one of its wildcards)
+        root = os.path.join(os.path.abspath(path), "")
+        clauses.append("substr(path, 1, ?) = ?")
+        parameters.extend([len(root), root])
+    if kind is not None:
+        clauses.append("kind = ?")
+        parameters.append(kind)
+    if start is not None:
+        clauses.append("timestamp >= ?")
+        parameters.append(start.isoformat())
+    if end is not None:
+        clauses.append("timestamp <= ?")
+        parameters.append(end.isoformat())
+
+    sql = "SELECT * FROM products"
+    if len(clauses) > 0:
+        sql += " WHERE " + " AND ".join(clauses)
+    sql += " ORDER BY timestamp, path"
+
+    connection = connect(catalog)
+    products = [dict(row) for row in connection.execute(sql, parameters)]
+    connection.close()
+
+    return products
+
+
+def get_collection(catalog, path, start=None, end=None):
+    """
+    Return the products of a collection grouped by directory, after an incremental refresh of the catalog
+    :param catalog: SQLite filename
+    :param path: path to a CAMS collection
+    :param start: first timestamp as datetime, None for no lower bound
+    :param end: last timestamp as datetime (included), None for no upper bound
+    :return: list of dict {'MR': filename, 'AOT': filename, 'RH': filename} sorted by timestamp
+    """
+    refresh(catalog, path)
+
+    collection = {}
+    for product in query(catalog, start=start, end=end, path=path):
+        collection.setdefault(product["directory"], {})[product["kind"]] = product["path"]
+
+    return [products for products in collection.values() if all(kind in products for kind in KINDS)]
+
+
+def parse_date(value):
+    """
+    Parse a date given on the command line
+    :param value: ISO date, eg. 2019-07-10 or 2019-07-10T12:00
+    :return: datetime
+    """
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid date '%s', expected YYYY-MM-DD[THH:MM]" % value)
+
+
+def main():
+    """
+    Build or refresh the catalog of a CAMS collection, then optionally list products in a time range
+    :return: a SQLite file
+    """
+    # Argument parser
+    parser = argparse.ArgumentParser()
+    parser.add_argument("directory", help="Path to a CAMS collection")
+    parser.add_argument("catalog", help="SQLite catalog file, created if it does not exist")
+    parser.add_argument("--kind", help="Product kind to list", choices=KINDS)
+    parser.add_argument("--start", help="List products from this date (YYYY-MM-DD[THH:MM])", type=parse_date)
+    parser.add_argument("--end", help="List products up to this date (YYYY-MM-DD[THH:MM])", type=parse_date)
+    parser.add_argument("--list", help="List products after refresh", action="store_true")
+    parser.add_argument("--full", help="Check every file, including those in unchanged directories",
+                        action="store_true")
+    args = parser.parse_args()
+
+    refresh(args.catalog, args.directory, full=args.full)
+
+    if args.list:
+        for product in query(args.catalog, kind=args.kind, start=args.start, end=args.end, path=args.directory):
+            print("%s %-3s %s species=%s levels=%s grid=%s" % (product["timestamp"], product["kind"], product["path"],
+                                                               product["n_species"], product["n_levels"],
+                                                               product["grid"]))
+
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -6,6 +6,53 @@ CAMS data extractor
 Purpose : For a given 'path' containing a collection of CAMS products and a given site location (lat/lon in DD), reads
     all the AOT products and combine them to a single site-specific netCDF file.
 
+v0.9.2 : products are submitted to the process pool through a rolling window instead of in batches, workers no
+    longer sit idle while the end of a batch is waited for. The catalog given with --catalog is refreshed on every run
+    and only the products of path are listed from it. The quarantine report is only written when products could not
+    be read, and the report of an earlier run is removed once all its products have been read. --resume retries the
+    quarantined products of the checkpoint. A worker process dying (eg. killed by the OOM killer) no longer aborts the
+    extraction, the product it was reading is quarantined and the pool restarted.
+
+v0.9.1 : extract accepts a custom product reader, so that other per-site extractions (see cams_extract_profiles) share
+    its listing, append, streaming, checkpoint and quarantine logic.
+
+v0.9.0 : fault tolerance. Products that cannot be read no longer abort the extraction, they are skipped and reported in
+    '<output>.quarantine.json' (a later --append run retries them). With --checkpoint N, outputs are flushed and the
+    progress saved to '<output>.checkpoint.json' every N products, and --resume restarts after the last checkpoint.
+
+v0.8.1 : --profile prints the time spent listing, opening, reading, concatenating and writing, files opened, bytes read
+    and peak memory at exit, workers included (see cams_instrument).
+
+v0.8.0 : interpolation. With --interp bilinear, site values are bilinearly interpolated from the four surrounding grid
+    points, weights are computed once per site and grid by cams_grid. With --times, site time series are also linearly
+    interpolated in time to a list of timestamps (eg. satellite overpass times) and written to --times-output.
+
+v0.7.0 : regional statistics. With --bbox or --regions (JSON bounding boxes or GeoJSON polygons), the area-weighted
+    mean, percentiles, maximum and grid cell of the maximum of each species are extracted per region and time step
+    instead of site values, see cams_region.
+
+v0.6.0 : optional chunked outputs. --format netcdf-chunked writes compressed netCDF4 chunked along time, --format zarr
+    writes Zarr stores with consolidated metadata. Chunk size along time is --time-chunk, compression level --complevel.
+
+v0.5.0 : products can be listed from a cams_catalog SQLite catalog (--catalog) instead of a recursive glob, and
+    restricted to a time range with --start/--end.
+
+v0.4.2 : nearest grid points are looked up through the cams_grid index cache, longitudes may be given either in
+    [0:360] or [-180:180].
+
+v0.4.1 : streaming extraction. Site slices are loaded eagerly, source products closed, and buffered slices are flushed
+    to the outputs every --time-chunk time steps, peak memory and open files no longer grow with the collection.
+
+v0.4.0 : incremental mode. With --append, time steps already in existing outputs are read first, products whose
+    timestamp is covered are skipped and only new time steps are appended. Outputs now have an unlimited time dimension.
+
+v0.3.0 : products are read in time order and can be spread over a process pool with --workers. Each worker opens a
+    product, selects the sites and returns the loaded slices, the output is identical to the serial path.
+
+v0.2.0 : multi-site extraction. A list of sites (CSV or JSON of name, lat, lon) can be given with --sites, all sites
+    are picked from each product in one vectorized nearest-neighbour call. Outputs are written per site
+    ('<output>_<site>_5.nc') or to a single file with a 'site' dimension (--single-file).
+
 v0.1.1 : add some INFO messages
 
 v0.1.0 : bugfix for bug01. The timestamp of each product is tested. If any product in 'path' are dated
@@ -20,82 +67,801 @@ v0.0.0 : initial released, passed successfully on a full CAMS collection coverin
 
 __author__ = "jerome.colin'at'cesbio.cnes.fr"
 __license__ = "MIT"
-__version__ = "0.1.1"
+__version__ = "0.9.2"
 
-import argparse, sys, glob
+import argparse, sys, os, glob, csv, json
+import functools
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import netCDF4 as nc
+import numpy as np
+import pandas as pd
 import xarray as xr
-import glob
 from datetime import datetime
+import cams_grid
+import cams_catalog
+import cams_region
+import cams_instrument
+
+TS_SEVEN_SPECIES = datetime(2019, 7, 10, 0, 0)
+
+FORMATS = ("netcdf", "netcdf-chunked", "zarr")
+
+INTERPOLATIONS = cams_grid.INTERPOLATIONS
+
+
+# Product timestamps are parsed by cams_catalog, which cannot import this module
+get_timestamp = cams_catalog.get_timestamp
+
+
+def read_sites(filename):
+    """
+    Read a site list from a CSV file (columns name, lat, lon) or a JSON file (list of {"name", "lat", "lon"})
+    :param filename: CSV or JSON site list
+    :return: (3) names, latitudes, longitudes
+    """
+    try:
+        with open(filename) as f:
+            if filename.endswith(".json"):
+                records = json.load(f)
+            else:
+                records = list(csv.DictReader(f))
+    except FileNotFoundError as e:
+        print(e)
+        sys.exit(1)
+
+    names = [str(r["name"]).strip() for r in records]
+    lats = [float(r["lat"]) for r in records]
+    lons = [float(r["lon"]) for r in records]
+    print("INFO: %i sites read from %s" % (len(names), filename))
 
+    return names, lats, lons
 
-def get_timestamp(file):
+
+def get_output_name(output, mode, site=None, fmt="netcdf"):
+    """
+    Build the name of an output file from the output template
+    :param output: fullpath name of the output netCDF file given by user
+    :param mode: aerosol species count, 5 or 7
+    :param site: optional site name, inserted before the species suffix
+    :param fmt: output format, one of FORMATS
+    :return: filename
+    """
+    root = os.path.splitext(output)[0]
+    extension = "zarr" if fmt == "zarr" else "nc"
+
+    if site is None:
+        return "%s_%i.%s" % (root, mode, extension)
+    return "%s_%s_%i.%s" % (root, site, mode, extension)
+
+
+def select_sites(ds, lats, lons):
     """
-    Parse filename and returns raw and nice timestamps
-    :param file: filename
-    :return: (2) raw, nice
+    Select the closest grid points for a batch of sites in a single vectorized indexing call. Grid indices are taken
+    from the grid index cache, so they are only computed once per grid.
+    :param ds: xarray dataset with latitude and longitude dimensions
+    :param lats: 1D sequence of latitudes in DD
+    :param lons: 1D sequence of longitudes in DD, either [0:360] or [-180:180]
+    :return: a dataset with a 'site' dimension
     """
-    ts_str = file.split("/")[-1].split("_")[-1].split(".")[0]
+    lat_idx, lon_idx = cams_grid.get_grid_indices(lats, lons, ds['latitude'].values, ds['longitude'].values)
 
-    return datetime(int(ts_str[:4]), int(ts_str[4:6]), int(ts_str[6:8]), int(ts_str[11:13]), int(ts_str[13:15]))
+    return ds.isel(latitude=xr.DataArray(lat_idx, dims="site"), longitude=xr.DataArray(lon_idx, dims="site"))
 
 
+def interpolate_sites(ds, lats, lons):
+    """
+    Bilinearly interpolate a dataset to a batch of sites. The four corners of every site are read in a single
+    vectorized indexing call, then weighted with the separable weights taken from the grid index cache.
+    :param ds: xarray dataset with latitude and longitude dimensions
+    :param lats: 1D sequence of latitudes in DD
+    :param lons: 1D sequence of longitudes in DD, either [0:360] or [-180:180]
+    :return: a dataset with a 'site' dimension, site coordinates as latitude and longitude
+    """
+    lat_idx, lon_idx, lat_weights, lon_weights = cams_grid.get_bilinear_weights(lats, lons, ds['latitude'].values,
+                                                                                ds['longitude'].values)
+
+    corners = ds.isel(latitude=xr.DataArray(lat_idx, dims=("site", "corner_lat")),
+                      longitude=xr.DataArray(lon_idx, dims=("site", "corner_lon")))
+    corners = corners.drop_vars(['latitude', 'longitude']).load()
+    weights = xr.DataArray(lat_weights[:, :, None] * lon_weights[:, None, :], dims=("site", "corner_lat", "corner_lon"))
 
-def extract(path, output, lat, lon):
-    list_of_cams_aot_files = glob.glob(path + '/**/*_AOT_*.nc', recursive = True)
+    interpolated = (corners * weights).sum(["corner_lat", "corner_lon"], skipna=False)
+    for name, var in ds.data_vars.items():
+        interpolated[name] = interpolated[name].astype(var.dtype)
+        interpolated[name].attrs = var.attrs
 
-    ts_seven_species = datetime(2019,7,10,0,0)
-    print("INFO: shift to 7 aerosol species set to :", ts_seven_species)
+    return interpolated.assign_coords(latitude=("site", np.asarray(lats, dtype=np.float64)),
+                                      longitude=("site", np.asarray(lons, dtype=np.float64)))
 
-    ds_5 = []
-    ds_7 = []
 
-    for f in list_of_cams_aot_files:
+def read_product(filename, lats, lons, interp="nearest"):
+    """
+    Open an AOT product, select the sites, load them in memory and close the product
+    :param filename: AOT netCDF file
+    :param lats: 1D sequence of latitudes in DD
+    :param lons: 1D sequence of longitudes in DD
+    :param interp: 'nearest' grid point or 'bilinear' interpolation, one of INTERPOLATIONS
+    :return: (2) timestamp, dataset with a 'site' dimension
+    """
+    with cams_instrument.stage("open"):
+        ds_one_product = xr.open_dataset(filename)
+        cams_instrument.opened(filename)
 
+    with ds_one_product, cams_instrument.stage("read"):
+        if interp == "bilinear":
+            ds_one_product_site = interpolate_sites(ds_one_product, lats, lons)
+        else:
+            ds_one_product_site = select_sites(ds_one_product, lats, lons).load()
+
+    return get_timestamp(filename), ds_one_product_site
+
+
+def read_safely(reader, filename):
+    """
+    Read a product, catching any error so that an unreadable product (missing, truncated or corrupted) does not abort
+    the extraction nor break the process pool
+    :param reader: function of a filename returning (timestamp, dataset)
+    :param filename: AOT netCDF file
+    :return: (3) filename, (timestamp, dataset) or None, error message or None
+    """
+    try:
+        return filename, reader(filename), None
+    except Exception as e:
+        return filename, None, "%s: %s" % (type(e).__name__, e)
+
+
+def read_isolated(reader, filename):
+    """
+    Read a product in a worker process of its own, so that the product is quarantined if this process dies
+    :param reader: picklable function of a filename returning (filename, result, error), see read_safely
+    :param filename: AOT netCDF file
+    :return: (3) filename, (timestamp, dataset) or None, error message or None
+    """
+    with ProcessPoolExecutor(max_workers=1) as executor:
         try:
-            ds_one_product = xr.open_dataset(f)
-        except FileNotFoundError as e:
-            print(e)
+            return next(cams_instrument.pool_imap(executor, reader, [filename], window=1))
+        except BrokenProcessPool as e:
+            return filename, None, "%s: worker process died reading the product (%s)" % (type(e).__name__, e)
+
+
+def read_products(files, reader, workers=1):
+    """
+    Read site slices from a list of AOT products, either serially or spread over a process pool. Slices are yielded in
+    the order of files whatever the number of workers, and only a bounded number of them is held in memory.
+    :param files: list of AOT netCDF files
+    :param reader: picklable function of a filename returning (timestamp, dataset), eg. read_product with sites bound
+    :param workers: number of worker processes, 1 reads in the current process
+    :return: a generator of (filename, (timestamp, dataset), error), see read_safely
+    """
+    reader = functools.partial(read_safely, reader)
+
+    if workers <= 1:
+        yield from map(reader, files)
+        return
+
+    done = 0
+    while done < len(files):
+        try:
+            # A rolling window of pending products bounds memory whatever the collection size, and keeps workers busy
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                for result in cams_instrument.pool_imap(executor, reader, files[done:], window=workers * 16):
+                    yield result
+                    done += 1
+        except BrokenProcessPool:
+            # A worker died and every pending product failed with it. The first one is read again alone to tell
+            # whether it killed the worker, then the pool is restarted on the next products.
+            print("WARNING: a worker process died, reading %s again in a process of its own" % files[done])
+            yield read_isolated(reader, files[done])
+            done += 1
+
+
+def get_output_names(output, mode, names=None, single_file=False, fmt="netcdf"):
+    """
+    List the output files written for a given species count
+    :param output: fullpath name of the output netCDF file given by user
+    :param mode: aerosol species count, 5 or 7
+    :param names: site names, None for a single anonymous site
+    :param single_file: if True, all sites share a single file
+    :param fmt: output format, one of FORMATS
+    :return: list of filenames
+    """
+    if names is None or single_file:
+        return [get_output_name(output, mode, fmt=fmt)]
+
+    return [get_output_name(output, mode, site=name, fmt=fmt) for name in names]
+
+
+def split_sites(combined, names=None, single_file=False, dim="site"):
+    """
+    Split a combined dataset into the datasets to write, in the order of get_output_names
+    :param combined: dataset with 'time' and 'site' dimensions
+    :param names: site names, None for a single anonymous site
+    :param single_file: if True, keep the 'site' dimension
+    :param dim: name of the site dimension, 'site' or 'region'
+    :return: a generator of datasets
+    """
+    if names is None:
+        yield combined.isel({dim: 0})
+    elif single_file:
+        yield combined.assign_coords({dim: names})
+    else:
+        for i in range(len(names)):
+            yield combined.isel({dim: i})
+
+
+def open_output(filename):
+    """
+    Open an output lazily, either a netCDF file or a Zarr store
+    :param filename: output filename
+    :return: an xarray dataset
+    """
+    if filename.rstrip("/").endswith(".zarr"):
+        return xr.open_zarr(filename, consolidated=True)
+
+    return xr.open_dataset(filename)
+
+
+def get_zarr_options():
+    """
+    Return the options of to_zarr selecting the Zarr version 2 format, which supports consolidated metadata and
+    fixed-length strings, whatever the version of the zarr library
+    :return: a dict of to_zarr keyword arguments
+    """
+    import zarr
+
+    if int(zarr.__version__.split(".")[0]) >= 3:
+        return {"consolidated": True, "zarr_format": 2}
+
+    return {"consolidated": True}
+
+
+def get_zarr_compressor(complevel):
+    """
+    Return the encoding of a Zstandard compressor for a Zarr version 2 array, whatever the version of the zarr library
+    :param complevel: compression level
+    :return: a dict to merge into a variable encoding
+    """
+    import zarr, numcodecs
+
+    if int(zarr.__version__.split(".")[0]) >= 3:
+        return {"compressors": [numcodecs.Zstd(level=complevel)]}
+
+    return {"compressor": numcodecs.Zstd(level=complevel)}
+
+
+def get_encoding(ds, fmt="netcdf", time_chunk=256, complevel=4):
+    """
+    Return the encoding of an output: time stored as float64 so that it can be appended to, and for chunked formats,
+    data variables chunked along time and compressed
+    :param ds: dataset to write
+    :param fmt: output format, one of FORMATS
+    :param time_chunk: chunk size along time
+    :param complevel: compression level
+    :return: encoding as a dict
+    """
+    encoding = {'time': {'dtype': 'float64'}}
+
+    if fmt == "netcdf":
+        return encoding
+
+    if fmt == "zarr":
+        encoding['time']['chunks'] = (time_chunk,)
+
+    for name, var in ds.data_vars.items():
+        chunks = tuple(time_chunk if dim == 'time' else var.sizes[dim] for dim in var.dims)
+        if fmt == "zarr":
+            encoding[name] = dict(chunks=chunks, **get_zarr_compressor(complevel))
+        else:
+            encoding[name] = {'zlib': True, 'complevel': complevel, 'chunksizes': chunks}
+
+    return encoding
+
+
+def create_output(filename, ds, fmt="netcdf", time_chunk=256, complevel=4):
+    """
+    Create an output that later runs can append to along time
+    :param filename: output filename
+    :param ds: dataset to write
+    :param fmt: output format, one of FORMATS
+    :param time_chunk: chunk size along time for chunked formats
+    :param complevel: compression level for chunked formats
+    :return: None
+    """
+    encoding = get_encoding(ds, fmt=fmt, time_chunk=time_chunk, complevel=complevel)
+
+    if fmt == "zarr":
+        ds.to_zarr(filename, mode='w', encoding=encoding, **get_zarr_options())
+    else:
+        ds.to_netcdf(filename, 'w', format='NETCDF4', unlimited_dims=['time'], encoding=encoding)
+
+
+def append_zarr(filename, ds, dim="site"):
+    """
+    Append the time steps of ds that are not yet in a Zarr store
+    :param filename: existing Zarr store written by cams_extract_aod
+    :param ds: dataset with the same variables as the store
+    :param dim: name of the site dimension, 'site' or 'region'
+    :return: number of time steps appended
+    """
+    with open_output(filename) as existing:
+        if dim in ds.dims and list(existing[dim].values) != list(ds[dim].values):
+            print("ERROR: %s list differs from the one in %s" % (dim, filename))
             sys.exit(1)
+        ds = ds.sel(time=~ds['time'].isin(existing['time'].values))
+
+    if ds.sizes['time'] > 0:
+        ds.to_zarr(filename, append_dim='time', **get_zarr_options())
+
+    return ds.sizes['time']
+
+
+def get_existing_times(filenames):
+    """
+    Return the timestamps covered by all the existing outputs
+    :param filenames: list of output files
+    :return: a set of datetime, empty if any output is missing
+    """
+    covered = None
+    for filename in filenames:
+        if not os.path.exists(filename):
+            return set()
+        with open_output(filename) as ds:
+            times = set(pd.DatetimeIndex(ds['time'].values).to_pydatetime())
+        covered = times if covered is None else covered & times
+
+    return covered or set()
+
+
+def append_netcdf(filename, ds, dim="site"):
+    """
+    Append the time steps of ds that are not yet in filename along its unlimited time dimension
+    :param filename: existing netCDF file written by cams_extract_aod
+    :param ds: dataset with the same variables as filename
+    :param dim: name of the site dimension, 'site' or 'region'
+    :return: number of time steps appended
+    """
+    with nc.Dataset(filename) as dst:
+        unlimited = dst.dimensions['time'].isunlimited()
+
+    if not unlimited:
+        print("WARNING: time is not an unlimited dimension in %s, rewriting file" % filename)
+        with xr.open_dataset(filename) as existing:
+            existing = existing.load()
+        ds = ds.sel(time=~ds['time'].isin(existing['time'].values))
+        xr.concat([existing, ds], dim='time').to_netcdf(filename, 'w', unlimited_dims=['time'],
+                                                       encoding={'time': {'dtype': 'float64'}})
+        return ds.sizes['time']
+
+    with nc.Dataset(filename, 'a') as dst:
+        if dim in ds.dims and list(dst[dim][:]) != list(ds[dim].values):
+            print("ERROR: %s list differs from the one in %s" % (dim, filename))
+            sys.exit(1)
+
+        time_var = dst['time']
+        calendar = getattr(time_var, 'calendar', 'standard')
+        new_times = nc.date2num(list(pd.DatetimeIndex(ds['time'].values).to_pydatetime()), time_var.units,
+                                calendar)
+        is_new = ~np.isin(new_times, time_var[:])
+        ds = ds.isel(time=np.flatnonzero(is_new))
+
+        n = len(dst.dimensions['time'])
+        k = ds.sizes['time']
+        if k == 0:
+            return 0
+
+        time_var[n:n + k] = np.asarray(new_times)[is_new]
+        for name, var in ds.data_vars.items():
+            if 'time' in var.dims:
+                dst[name][n:n + k] = var.transpose(*dst[name].dimensions).values
+
+    return k
+
 
-        ds_one_product_site = ds_one_product.sel(latitude=lat, longitude=lon, method="nearest")
+def write_output(ds_list, output, mode, names=None, single_file=False, append=False, fmt="netcdf", time_chunk=256,
+                 complevel=4, dim="site"):
+    """
+    Concatenate site slices along time and write them either per site or to a single file with a 'site' dimension.
+    Outputs are created with an unlimited time dimension so that later runs can append to them.
+    :param ds_list: list of datasets with a 'site' dimension
+    :param output: fullpath name of the output netCDF file given by user
+    :param mode: aerosol species count, 5 or 7
+    :param names: site names, None for a single anonymous site
+    :param single_file: if True, keep the 'site' dimension in one file
+    :param append: if True, append new time steps to existing outputs instead of overwriting them
+    :param fmt: output format, one of FORMATS
+    :param time_chunk: chunk size along time for chunked formats
+    :param complevel: compression level for chunked formats
+    :param dim: name of the site dimension, 'site' or 'region'
+    :return: None
+    """
+    with cams_instrument.stage("concat"):
+        combined = xr.concat(ds_list, dim='time')
+    filenames = get_output_names(output, mode, names=names, single_file=single_file, fmt=fmt)
+
+    for filename, ds in zip(filenames, split_sites(combined, names=names, single_file=single_file, dim=dim)):
+        with cams_instrument.stage("write"):
+            if append and os.path.exists(filename):
+                if fmt == "zarr":
+                    append_zarr(filename, ds, dim=dim)
+                else:
+                    append_netcdf(filename, ds, dim=dim)
+            else:
+                create_output(filename, ds, fmt=fmt, time_chunk=time_chunk, complevel=complevel)
+
+    if len(filenames) > 1:
+        print("INFO: output %i aerosols datasets for %i %ss to %s" % (mode, len(names), dim,
+                                                                      get_output_name(output, mode, site="*",
+                                                                                      fmt=fmt)))
+    elif names is not None:
+        print("INFO: output %i aerosols dataset for %i %ss to %s" % (mode, len(names), dim, filenames[0]))
+    else:
+        print("INFO: output %i aerosols dataset to %s" % (mode, filenames[0]))
+
+
+def list_products(path, catalog=None, start=None, end=None):
+    """
+    List the AOT products of a collection in time order, either from a catalog or by walking path
+    :param path: path to a CAMS collection
+    :param catalog: optional SQLite catalog of the collection, refreshed incrementally
+    :param start: first timestamp as datetime, None for no lower bound
+    :param end: last timestamp as datetime (included), None for no upper bound
+    :return: list of AOT filenames
+    """
+    if catalog is not None:
+        cams_catalog.refresh(catalog, path)
+        return [product["path"] for product in cams_catalog.query(catalog, kind="AOT", start=start, end=end,
+                                                                  path=path)]
+
+    files = sorted(glob.glob(path + '/**/*_AOT_*.nc', recursive = True), key=get_timestamp)
 
-        ts = get_timestamp(f)
+    return [f for f in files
+            if (start is None or get_timestamp(f) >= start) and (end is None or get_timestamp(f) <= end)]
 
-        if ts >= ts_seven_species:
-            ds_7.append(ds_one_product_site)
+
+def get_checkpoint_name(output):
+    """
+    Return the name of the checkpoint file of an output
+    :param output: fullpath name of the output netCDF file given by user
+    :return: filename
+    """
+    return "%s.checkpoint.json" % os.path.splitext(output)[0]
+
+
+def get_quarantine_name(output):
+    """
+    Return the name of the report of the products that could not be read
+    :param output: fullpath name of the output netCDF file given by user
+    :return: filename
+    """
+    return "%s.quarantine.json" % os.path.splitext(output)[0]
+
+
+def read_checkpoint(filename):
+    """
+    Read a checkpoint
+    :param filename: checkpoint file
+    :return: checkpoint as a dict, None if there is no checkpoint
+    """
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except ValueError as e:
+        print("ERROR: invalid checkpoint %s (%s)" % (filename, e))
+        sys.exit(1)
+
+
+def write_json(filename, content):
+    """
+    Write a JSON file atomically, so that a crash never leaves it half written
+    :param filename: JSON file
+    :param content: JSON serializable content
+    :return: None
+    """
+    tmp_file = "%s.%i.tmp" % (filename, os.getpid())
+    with open(tmp_file, "w") as f:
+        json.dump(content, f, indent=1)
+    os.replace(tmp_file, filename)
+
+
+def get_mode(ts):
+    """
+    Return the aerosol species count of a product from its timestamp
+    :param ts: product timestamp as datetime
+    :return: 5 or 7
+    """
+    return 7 if ts >= TS_SEVEN_SPECIES else 5
+
+
+def extract(path, output, lat, lon, names=None, single_file=False, workers=1, append=False, time_chunk=256,
+            catalog=None, start=None, end=None, fmt="netcdf", complevel=4, regions=None,
+            percentiles=cams_region.PERCENTILES, interp="nearest", checkpoint=0, resume=False, reader=None):
+    """
+    Extract site values, or region statistics, from all AOT products in path. Slices are buffered and flushed to the
+    outputs every time_chunk products, so that memory and open files stay constant whatever the collection size.
+
+    Products that cannot be read are skipped and reported in '<output>.quarantine.json', a later run with append=True
+    retries them. The report of an earlier run is removed when all products were read. With checkpoint > 0, outputs
+    are flushed every checkpoint products and the progress is saved to '<output>.checkpoint.json', a run with
+    resume=True then skips the products up to the last checkpoint, except the quarantined ones which are retried.
+    :param path: path to a CAMS collection
+    :param output: fullpath name of the output netCDF file
+    :param lat: latitude in DD, or a list of latitudes, ignored if regions are given
+    :param lon: longitude in DD, or a list of longitudes, ignored if regions are given
+    :param names: site or region names matching lat/lon or regions lists, None for a single site or region
+    :param single_file: if True, write all sites to a single file with a 'site' dimension
+    :param workers: number of worker processes used to read products
+    :param append: if True, only read products not yet covered by existing outputs and append them
+    :param time_chunk: number of time steps buffered before flushing to the outputs
+    :param catalog: optional SQLite catalog of the collection, used instead of walking path
+    :param start: first product timestamp as datetime, None for no lower bound
+    :param end: last product timestamp as datetime (included), None for no upper bound
+    :param fmt: output format, one of FORMATS
+    :param complevel: compression level for chunked formats
+    :param regions: optional list of regions (see cams_region), area statistics are extracted instead of sites
+    :param percentiles: percentiles computed over regions
+    :param interp: 'nearest' grid point or 'bilinear' interpolation of sites, one of INTERPOLATIONS
+    :param checkpoint: number of products between checkpoints, 0 for no checkpoint
+    :param resume: if True, resume from the last checkpoint and append to outputs
+    :param reader: optional picklable function of an AOT filename returning (timestamp, dataset with a 'site'
+        dimension), read instead of the site values of the AOT product, eg. cams_extract_profiles.read_profiles
+    :return: None
+    """
+    with cams_instrument.stage("list"):
+        list_of_cams_aot_files = list_products(path, catalog=catalog, start=start, end=end)
+
+    if reader is not None:
+        dim = "site"
+    elif regions is not None:
+        reader = functools.partial(cams_region.read_product, regions=regions, percentiles=percentiles)
+        dim = "region"
+    else:
+        reader = functools.partial(read_product, lats=np.atleast_1d(lat), lons=np.atleast_1d(lon), interp=interp)
+        dim = "site"
+
+    print("INFO: shift to 7 aerosol species set to :", TS_SEVEN_SPECIES)
+
+    checkpoint_file = get_checkpoint_name(output)
+    progress = {"output": output, "last_timestamp": None, "products": 0, "quarantined": []}
+
+    if resume:
+        previous = read_checkpoint(checkpoint_file)
+        if previous is None or previous["last_timestamp"] is None:
+            print("INFO: no checkpoint %s, starting from the first product" % checkpoint_file)
         else:
-            ds_5.append(ds_one_product_site)
+            progress = previous
+            last = datetime.fromisoformat(progress["last_timestamp"])
+            retried = set(product["path"] for product in progress["quarantined"])
+            list_of_cams_aot_files = [f for f in list_of_cams_aot_files if get_timestamp(f) > last or f in retried]
+            progress["products"] -= len(progress["quarantined"])
+            progress["quarantined"] = []
+            print("INFO: resuming after %s, %i products already processed, %i quarantined products retried"
+                  % (last, progress["products"], len(retried)))
+        append = True
+
+    if append:
+        covered = {mode: get_existing_times(get_output_names(output, mode, names=names, single_file=single_file,
+                                                             fmt=fmt))
+                   for mode in (5, 7)}
+        list_of_cams_aot_files = [f for f in list_of_cams_aot_files
+                                  if get_timestamp(f) not in covered[get_mode(get_timestamp(f))]]
+        if len(list_of_cams_aot_files) == 0:
+            print("INFO: outputs are up to date")
+
+    # Also printed by the extractors passing their own reader (eg. MR and RH products for cams_extract_profiles)
+    print("INFO: reading %i CAMS products with %i worker(s)" % (len(list_of_cams_aot_files), workers))
+
+    buffers = {5: [], 7: []}
+    started = {5: append, 7: append}
+
+    def flush(mode):
+        write_output(buffers[mode], output, mode, names=names, single_file=single_file, append=started[mode], fmt=fmt,
+                     time_chunk=time_chunk, complevel=complevel, dim=dim)
+        buffers[mode] = []
+        started[mode] = True
+
+    def save_checkpoint():
+        for mode in (5, 7):
+            if len(buffers[mode]) > 0:
+                flush(mode)
+        if checkpoint > 0 or resume:
+            write_json(checkpoint_file, progress)
+
+    since_checkpoint = 0
+    for filename, result, error in read_products(list_of_cams_aot_files, reader, workers=workers):
+        if error is not None:
+            print("WARNING: quarantined %s (%s)" % (filename, error))
+            progress["quarantined"].append({"path": filename, "error": error})
+        else:
+            ts, ds_one_product_site = result
+            mode = get_mode(ts)
+            buffers[mode].append(ds_one_product_site)
+
+            if len(buffers[mode]) >= time_chunk:
+                flush(mode)
+
+        # Retried products are older than the last checkpoint
+        progress["last_timestamp"] = max(progress["last_timestamp"] or "", get_timestamp(filename).isoformat())
+        progress["products"] += 1
+        since_checkpoint += 1
 
-    if len(ds_5) > 0:
-        combined_5 = xr.concat(ds_5, dim='time')
-        combined_5.to_netcdf(output[:-3]+"_5.nc", 'w')
-        print("INFO: output 5 aerosols dataset to %s" % output[:-3]+"_5.nc")
+        if checkpoint > 0 and since_checkpoint >= checkpoint:
+            save_checkpoint()
+            since_checkpoint = 0
 
-    if len(ds_7) > 0:
-        combined_7 = xr.concat(ds_7, dim='time')
-        combined_7.to_netcdf(output[:-3]+"_7.nc", 'w')
-        print("INFO: output 7 aerosols dataset to %s" % output[:-3]+"_7.nc")
+    save_checkpoint()
+
+    quarantine_file = get_quarantine_name(output)
+    if len(progress["quarantined"]) > 0:
+        write_json(quarantine_file, progress["quarantined"])
+        print("WARNING: %i products could not be read, see %s" % (len(progress["quarantined"]), quarantine_file))
+    elif os.path.exists(quarantine_file):
+        # Products reported by an earlier run have since been read
+        os.remove(quarantine_file)
+        print("INFO: all products read, %s removed" % quarantine_file)
 
     print("Done...")
 
 
+def read_times(filename):
+    """
+    Read a list of timestamps, one ISO date per line (eg. 2021-03-01T10:32), lines starting with '#' are ignored
+    :param filename: text file
+    :return: sorted list of datetime
+    """
+    try:
+        with open(filename) as f:
+            lines = [line.strip() for line in f]
+    except FileNotFoundError as e:
+        print(e)
+        sys.exit(1)
+
+    try:
+        times = sorted(datetime.fromisoformat(line) for line in lines if len(line) > 0 and not line.startswith("#"))
+    except ValueError as e:
+        print("ERROR: invalid timestamp in %s (%s)" % (filename, e))
+        sys.exit(1)
+
+    print("INFO: %i timestamps read from %s" % (len(times), filename))
+
+    return times
+
+
+def interpolate_times(output, times, times_output, names=None, single_file=False, fmt="netcdf"):
+    """
+    Linearly interpolate extracted outputs in time to a list of timestamps, eg. satellite overpass times. Timestamps
+    outside the time range of an output are skipped.
+    :param output: fullpath name of the output netCDF file given to extract
+    :param times: list of datetime
+    :param times_output: fullpath name of the interpolated output netCDF file
+    :param names: site names, None for a single anonymous site
+    :param single_file: if True, all sites share a single file
+    :param fmt: output format, one of FORMATS
+    :return: None
+    """
+    times = pd.DatetimeIndex(times)
+
+    for mode in (5, 7):
+        for filename, interpolated_filename in zip(
+                get_output_names(output, mode, names=names, single_file=single_file, fmt=fmt),
+                get_output_names(times_output, mode, names=names, single_file=single_file, fmt=fmt)):
+            if not os.path.exists(filename):
+                continue
+
+            with open_output(filename) as ds, cams_instrument.stage("read"):
+                cams_instrument.opened(filename)
+                ds = ds.load()
+
+            in_range = times[(times >= ds['time'].values.min()) & (times <= ds['time'].values.max())]
+            if len(in_range) == 0:
+                continue
+
+            # Linear weights between the bracketing time steps, computed on times as seconds
+            seconds = ds['time'].values.astype('datetime64[s]').astype(np.float64)
+            before, after, w = cams_grid.bracket_indices(in_range.values.astype('datetime64[s]').astype(np.float64),
+                                                         seconds)
+            w = xr.DataArray(w, dims="time")
+
+            data_vars = [name for name, var in ds.data_vars.items() if 'time' in var.dims]
+            interpolated = (ds[data_vars].isel(time=before).drop_vars('time') * (1 - w)
+                            + ds[data_vars].isel(time=after).drop_vars('time') * w)
+            interpolated = interpolated.assign_coords(time=in_range.values)
+            for name in data_vars:
+                interpolated[name] = interpolated[name].astype(ds[name].dtype)
+                interpolated[name].attrs = ds[name].attrs
+
+            with cams_instrument.stage("write"):
+                create_output(interpolated_filename, interpolated, fmt=fmt)
+            print("INFO: %i time steps interpolated to %s" % (len(in_range), interpolated_filename))
+
+
 def main():
     """
-    For a given PATH, LAT, LON,
+    For a given PATH, LAT, LON (or a SITES list),
     read all cams aot netcdf files in PATH,
-    extract values for (LAT, LON)
-    output site specific values to a new netCDF file in OUTPUT
+    extract values for (LAT, LON) or for every site in SITES in a single pass
+    output site specific values to a new netCDF file in OUTPUT (one file per site, or a single file with --single-file)
     :return: a netCDF file
     """
     # Argument parser
     parser = argparse.ArgumentParser()
     parser.add_argument("directory", help="Path to a CAMS collection")
     parser.add_argument("output", help="Fullpath name of the output netCDF file")
-    parser.add_argument("--lat", help="Latitude in decimal degrees", type=float, required=True)
-    parser.add_argument("--lon", help="Longitude in decimal degrees", type=float, required=True)
+    parser.add_argument("--lat", help="Latitude in decimal degrees", type=float)
+    parser.add_argument("--lon", help="Longitude in decimal degrees", type=float)
+    parser.add_argument("--sites", help="CSV (name,lat,lon) or JSON list of sites to extract in a single pass")
+    parser.add_argument("--interp", help="Site values from the nearest grid point (default) or bilinearly interpolated",
+                        choices=INTERPOLATIONS, default="nearest")
+    parser.add_argument("--times", help="Text file of timestamps (one ISO date per line) to linearly interpolate site "
+                                        "time series to, written to --times-output")
+    parser.add_argument("--times-output", help="Fullpath name of the time-interpolated output, defaults to "
+                                               "<output>_interp.nc")
+    parser.add_argument("--bbox", help="Extract area statistics over a bounding box instead of a site", nargs=4,
+                        type=float, metavar=("LAT_MIN", "LAT_MAX", "LON_MIN", "LON_MAX"))
+    parser.add_argument("--regions", help="JSON list of {name, bbox: [lat_min, lat_max, lon_min, lon_max]} or GeoJSON "
+                                          "FeatureCollection of polygons to extract area statistics from")
+    parser.add_argument("--percentiles", help="Percentiles computed over regions, defaults to 10 50 90", nargs="+",
+                        type=float, default=list(cams_region.PERCENTILES))
+    parser.add_argument("--single-file", help="Write all sites (or regions) to a single file with a 'site' (or "
+                                              "'region') dimension", action="store_true")
+    parser.add_argument("--workers", help="Number of worker processes reading products, defaults to 1", type=int,
+                        default=1)
+    parser.add_argument("--append", help="Only read products not yet in existing outputs and append them",
+                        action="store_true")
+    parser.add_argument("--time-chunk", help="Number of time steps buffered before writing to outputs, also the chunk "
+                                             "size along time of chunked formats, defaults to 256", type=int,
+                        default=256)
+    parser.add_argument("--format", help="Output format: unchunked netCDF4 (default), chunked and compressed netCDF4, "
+                                         "or chunked Zarr store with consolidated metadata", choices=FORMATS,
+                        default="netcdf")
+    parser.add_argument("--complevel", help="Compression level of chunked formats, defaults to 4", type=int, default=4)
+    parser.add_argument("--checkpoint", help="Flush outputs and save progress to <output>.checkpoint.json every N "
+                                             "products, defaults to 0 (no checkpoint)", type=int, default=0)
+    parser.add_argument("--resume", help="Resume from the last checkpoint, appending to existing outputs",
+                        action="store_true")
+    parser.add_argument("--catalog", help="SQLite catalog of the collection (see cams_catalog), refreshed on every run")
+    parser.add_argument("--start", help="Extract products from this date (YYYY-MM-DD[THH:MM])",
+                        type=cams_catalog.parse_date)
+    parser.add_argument("--end", help="Extract products up to this date (YYYY-MM-DD[THH:MM])",
+                        type=cams_catalog.parse_date)
+    parser.add_argument("--profile", help="Print stage timings, files opened, bytes read and peak memory at exit, as a "
+                                          "table (default) or JSON, 'log' also prints a JSON record per stage call",
+                        nargs="?", const="table", choices=cams_instrument.FORMATS)
     args = parser.parse_args()
 
-    extract(args.directory, args.output, args.lat, args.lon)
+    if args.profile is not None:
+        cams_instrument.start(args.profile)
+
+    options = dict(workers=args.workers, append=args.append, time_chunk=args.time_chunk, catalog=args.catalog,
+                   start=args.start, end=args.end, fmt=args.format, complevel=args.complevel,
+                   checkpoint=args.checkpoint, resume=args.resume)
+
+    if args.times is not None and (args.regions is not None or args.bbox is not None):
+        parser.error("--times only applies to sites")
+
+    if args.regions is not None:
+        regions = cams_region.read_regions(args.regions)
+        extract(args.directory, args.output, None, None, names=[r["name"] for r in regions],
+                single_file=args.single_file, regions=regions, percentiles=args.percentiles, **options)
+    elif args.bbox is not None:
+        extract(args.directory, args.output, None, None, regions=[cams_region.get_bbox_region("bbox", args.bbox)],
+                percentiles=args.percentiles, **options)
+    elif args.sites is not None:
+        names, lats, lons = read_sites(args.sites)
+        extract(args.directory, args.output, lats, lons, names=names, single_file=args.single_file, interp=args.interp,
+                **options)
+    elif args.lat is not None and args.lon is not None:
+        names = None
+        extract(args.directory, args.output, args.lat, args.lon, interp=args.interp, **options)
+    else:
+        parser.error("either --lat and --lon, --sites, --bbox or --regions are required")
+
+    if args.times is not None:
+        times_output = args.times_output or "%s_interp.nc" % os.path.splitext(args.output)[0]
+        interpolate_times(args.output, read_times(args.times), times_output, names=names,
+                          single_file=args.single_file, fmt=args.format)
 
     sys.exit(0)
 
@@ -0,0 +1,215 @@
+#! /usr/bin/env python
+
+"""
+CAMS vertical profile extractor
+
+Purpose : For a given 'path' containing a collection of CAMS products and a given site location (lat/lon in DD), or a
+    list of sites, reads the MR and RH products of every '.DIR' and stores the time series of the vertical profiles of
+    each site: a (time, species, level) cube of aerosol mixing ratios, the full level pressures of the model levels
+    and a (time, pressure_level) relative humidity profile. Outputs are written by cams_extract_aod.
+
+v0.0.0 : initial release
+"""
+
+__author__ = "jerome.colin'at'cesbio.cnes.fr"
+__license__ = "MIT"
+__version__ = "0.0.0"
+
+import argparse, sys, os
+import functools
+import numpy as np
+import xarray as xr
+import cams_extract_aod
+import cams_levels
+import cams_catalog
+import cams_instrument
+
+
+def get_product_files(file_aot):
+    """
+    Return the MR and RH products of the '.DIR' of an AOT product
+    :param file_aot: AOT netCDF file
+    :return: (2) MR filename, RH filename
+    """
+    directory, name = os.path.split(file_aot)
+
+    return (os.path.join(directory, name.replace("_AOT_", "_MR_")),
+            os.path.join(directory, name.replace("_AOT_", "_RH_")))
+
+
+def select_columns(ds, lats, lons, interp="nearest"):
+    """
+    Read the columns of a batch of sites, at the closest grid points or bilinearly interpolated
+    :param ds: xarray dataset with latitude and longitude dimensions
+    :param lats: 1D sequence of latitudes in DD
+    :param lons: 1D sequence of longitudes in DD
+    :param interp: 'nearest' grid point or 'bilinear' interpolation, one of cams_extract_aod.INTERPOLATIONS
+    :return: a dataset with a 'site' dimension, loaded in memory
+    """
+    if interp == "bilinear":
+        return cams_extract_aod.interpolate_sites(ds, lats, lons)
+
+    return cams_extract_aod.select_sites(ds, lats, lons).load()
+
+
+def get_surface_pressure(mr_ds, lats, lons, interp="nearest"):
+    """
+    Return the surface pressure of the sites, read from the 'sp' or 'lnsp' variable of a MR product, or the standard
+    surface pressure if it has none
+    :param mr_ds: xarray MR dataset
+    :param lats: 1D sequence of latitudes in DD
+    :param lons: 1D sequence of longitudes in DD
+    :param interp: 'nearest' grid point or 'bilinear' interpolation
+    :return: surface pressure (Pa) as a (time, site) array
+    """
+    name, log = cams_levels.get_surface_pressure_variable(mr_ds.variables)
+    if name is None:
+        return np.full((mr_ds.sizes['time'], len(lats)), cams_levels.STANDARD_SURFACE_PRESSURE)
+
+    # lnsp may be given on a single model level
+    var = mr_ds[name]
+    var = var.isel({dim: 0 for dim in var.dims if dim not in ('time', 'latitude', 'longitude')})
+    column = select_columns(var.to_dataset(), lats, lons, interp=interp)[name]
+
+    return cams_levels.to_surface_pressure(column.transpose('time', 'site').values, log=log)
+
+
+def get_profiles(mr_ds, rh_ds, lats, lons, interp="nearest"):
+    """
+    Build the profiles of a batch of sites from open MR and RH products
+    :param mr_ds: xarray MR dataset
+    :param rh_ds: xarray RH dataset
+    :param lats: 1D sequence of latitudes in DD
+    :param lons: 1D sequence of longitudes in DD
+    :param interp: 'nearest' grid point or 'bilinear' interpolation
+    :return: a dataset of 'mr' (time, site, species, level), 'pressure' (time, site, level) and 'rh' (time, site,
+        pressure_level)
+    """
+    # 5-species products have no nitrate and ammonium
+    species = [name for name in cams_levels.MR_SPECIES if name in mr_ds.data_vars]
+    n_levels = mr_ds.sizes['level']
+
+    mr = select_columns(mr_ds[species], lats, lons, interp=interp)
+    cube = mr.to_dataarray('species').transpose('time', 'site', 'species', 'level')
+    cube.attrs = {'long_name': "Aerosol mixing ratios", 'units': mr_ds[species[0]].attrs.get('units', "kg kg**-1")}
+
+    pressure = cams_levels.get_full_level_pressures(n_levels, get_surface_pressure(mr_ds, lats, lons,
+                                                                                   interp=interp)) / 100.
+
+    rh = select_columns(rh_ds[['r']], lats, lons, interp=interp)['r']
+    rh = rh.rename(level='pressure_level').transpose('time', 'site', 'pressure_level')
+
+    profiles = xr.Dataset({
+        'mr': cube,
+        'pressure': (('time', 'site', 'level'), pressure.astype(np.float32),
+                     {'long_name': "Full level pressure", 'units': "hPa"}),
+        'rh': rh,
+    })
+
+    return profiles.assign_coords(species_long_name=('species', [mr_ds[name].attrs.get('long_name', name)
+                                                                 for name in species]))
+
+
+def read_profiles(filename, lats, lons, interp="nearest"):
+    """
+    Open the MR and RH products of the '.DIR' of an AOT product, read the profiles of the sites and close the products
+    :param filename: AOT netCDF file, only used to locate the MR and RH products and to timestamp them
+    :param lats: 1D sequence of latitudes in DD
+    :param lons: 1D sequence of longitudes in DD
+    :param interp: 'nearest' grid point or 'bilinear' interpolation
+    :return: (2) timestamp, dataset with a 'site' dimension, see get_profiles
+    """
+    file_mixing_ratio, file_relative_humidity = get_product_files(filename)
+
+    with cams_instrument.stage("open"):
+        mr_ds = xr.open_dataset(file_mixing_ratio)
+        rh_ds = xr.open_dataset(file_relative_humidity)
+        for name in (file_mixing_ratio, file_relative_humidity):
+            cams_instrument.opened(name)
+
+    with mr_ds, rh_ds, cams_instrument.stage("read"):
+        profiles = get_profiles(mr_ds, rh_ds, lats, lons, interp=interp)
+
+    return cams_extract_aod.get_timestamp(filename), profiles
+
+
+def extract_profiles(path, output, lat, lon, names=None, interp="nearest", **options):
+    """
+    Extract the vertical profiles of a site, or a list of sites, from all the products in path
+    :param path: path to a CAMS collection
+    :param output: fullpath name of the output file
+    :param lat: latitude in DD, or a list of latitudes
+    :param lon: longitude in DD, or a list of longitudes
+    :param names: site names matching lat/lon lists, None for a single site
+    :param interp: 'nearest' grid point or 'bilinear' interpolation, one of cams_extract_aod.INTERPOLATIONS
+    :param options: keyword arguments of cams_extract_aod.extract (single_file, workers, append, time_chunk,
+        catalog, start, end, fmt, complevel, checkpoint, resume)
+    :return: None
+    """
+    reader = functools.partial(read_profiles, lats=np.atleast_1d(lat), lons=np.atleast_1d(lon), interp=interp)
+
+    cams_extract_aod.extract(path, output, lat, lon, names=names, reader=reader, **options)
+
+
+def main():
+    """
+    For a given PATH, LAT, LON (or a SITES list),
+    read the MR and RH products of every cams product in PATH,
+    output site specific profile time series to OUTPUT (one file per site, or a single file with --single-file)
+    :return: a netCDF file or Zarr store
+    """
+    # Argument parser
+    parser = argparse.ArgumentParser()
+    parser.add_argument("directory", help="Path to a CAMS collection")
+    parser.add_argument("output", help="Fullpath name of the output file")
+    parser.add_argument("--lat", help="Latitude in decimal degrees", type=float)
+    parser.add_argument("--lon", help="Longitude in decimal degrees", type=float)
+    parser.add_argument("--sites", help="CSV (name,lat,lon) or JSON list of sites to extract in a single pass")
+    parser.add_argument("--interp", help="Profiles from the nearest grid point (default) or bilinearly interpolated",
+                        choices=cams_extract_aod.INTERPOLATIONS, default="nearest")
+    parser.add_argument("--single-file", help="Write all sites to a single file with a 'site' dimension",
+                        action="store_true")
+    parser.add_argument("--workers", help="Number of worker processes reading products, defaults to 1", type=int,
+                        default=1)
+    parser.add_argument("--append", help="Only read products not yet in existing outputs and append them",
+                        action="store_true")
+    parser.add_argument("--time-chunk", help="Number of time steps buffered before writing to outputs, also the chunk "
+                                             "size along time of chunked formats, defaults to 64", type=int, default=64)
+    parser.add_argument("--format", help="Output format: chunked and compressed netCDF4 (default), unchunked netCDF4 "
+                                         "or chunked Zarr store with consolidated metadata",
+                        choices=cams_extract_aod.FORMATS, default="netcdf-chunked")
+    parser.add_argument("--complevel", help="Compression level of chunked formats, defaults to 4", type=int, default=4)
+    parser.add_argument("--checkpoint", help="Flush outputs and save progress to <output>.checkpoint.json every N "
+                                             "products, defaults to 0 (no checkpoint)", type=int, default=0)
+    parser.add_argument("--resume", help="Resume from the last checkpoint, appending to existing outputs",
+                        action="store_true")
+    parser.add_argument("--catalog", help="SQLite catalog of the collection (see cams_catalog), refreshed on every run")
+    parser.add_argument("--start", help="Extract products from this date (YYYY-MM-DD[THH:MM])",
+                        type=cams_catalog.parse_date)
+    parser.add_argument("--end", help="Extract products up to this date (YYYY-MM-DD[THH:MM])",
+                        type=cams_catalog.parse_date)
+    parser.add_argument("--profile", help="Print stage timings, files opened, bytes read and peak memory at exit, as a "
+                                          "table (default) or JSON, 'log' also prints a JSON record per stage call",
+                        nargs="?", const="table", choices=cams_instrument.FORMATS)
+    args = parser.parse_args()
+
+    if args.profile is not None:
+        cams_instrument.start(args.profile)
+
+    options = dict(single_file=args.single_file, workers=args.workers, append=args.append, time_chunk=args.time_chunk,
+                   catalog=args.catalog, start=args.start, end=args.end, fmt=args.format, complevel=args.complevel,
+                   checkpoint=args.checkpoint, resume=args.resume)
+
+    if args.sites is not None:
+        names, lats, lons = cams_extract_aod.read_sites(args.sites)
+        extract_profiles(args.directory, args.output, lats, lons, names=names, interp=args.interp, **options)
+    elif args.lat is not None and args.lon is not None:
+        extract_profiles(args.directory, args.output, args.lat, args.lon, interp=args.interp, **options)
+    else:
+        parser.error("either --lat and --lon or --sites are required")
+
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+"""
+CAMS grid index cache
+
+Purpose : nearest grid point lookup shared by all CAMS tools. Indices are computed once per grid, identified by a
+    fingerprint of its latitude and longitude vectors, and cached both in memory and on disk so that every product on the
+    same grid, in this run or in later ones, reuses them.
+
+    The 0-360 versus -180-180 longitude convention is handled here only: site longitudes are converted to the convention
+    of the grid before any lookup, and longitudes are compared modulo 360.
+
+v0.1.1 : INTERPOLATIONS lists the interpolation methods accepted by the tools.
+
+v0.1.0 : bilinear interpolation weights. The two bracketing latitudes and longitudes of each site and their separable
+    weights are computed once per grid and cached along with nearest indices.
+
+v0.0.0 : initial release
+"""
+
+__author__ = "jerome.colin'at'cesbio.cnes.fr"
+__license__ = "MIT"
+__version__ = "0.1.1"
+
+import os, json, hashlib
+import numpy as np
+
+GRID_CACHE = os.environ.get("CAMS_GRID_CACHE",
+                            os.path.join(os.path.expanduser("~"), ".cache", "cams_visu", "grid_index.json"))
+
+# Values at the nearest grid point, or bilinearly interpolated from the four surrounding ones
+INTERPOLATIONS = ("nearest", "bilinear")
+
+_memory_cache = {}
+_disk_loaded = False
+
+
+def grid_fingerprint(grid_lat, grid_lon):
+    """
+    Return a fingerprint of a grid from its shape and coordinates
+    :param grid_lat: 1D latitude vector of the grid
+    :param grid_lon: 1D longitude vector of the grid
+    :return: fingerprint as an hexadecimal string
+    """
+    grid_lat = np.ascontiguousarray(grid_lat, dtype=np.float64)
+    grid_lon = np.ascontiguousarray(grid_lon, dtype=np.float64)
+
+    h = hashlib.sha1(("%i,%i" % (len(grid_lat), len(grid_lon))).encode())
+    h.update(grid_lat.tobytes())
+    h.update(grid_lon.tobytes())
+
+    return h.hexdigest()[:16]
+
+
+def normalize_longitude(lon, grid_lon):
+    """
+    Convert longitudes to the convention of the grid, either [0:360] or [-180:180]
+    :param lon: longitude(s) in DD
+    :param grid_lon: 1D longitude vector of the grid
+    :return: longitude(s) in the grid convention
+    """
+    lon = np.asarray(lon, dtype=np.float64)
+
+    if np.min(grid_lon) >= 0:
+        return np.mod(lon, 360.)
+
+    return np.mod(lon + 180., 360.) - 180.
+
+
+def nearest_indices(targets, vector, period=None):
+    """
+    Return the indices of the vector elements closest to each target with a single searchsorted call. Ties are resolved
+    to the lowest index, as np.argmin does.
+    :param targets: 1D array of target values, eg. latitudes
+    :param vector: 1D coordinate vector, ascending or descending
+    :param period: if set, values are compared modulo period (eg. 360 for longitudes)
+    :return: 1D array of indices
+    """
+    targets = np.atleast_1d(np.asarray(targets, dtype=np.float64))
+    vector = np.asarray(vector, dtype=np.float64)
+
+    order = np.argsort(vector, kind="stable")
+    sorted_vector = vector[order]
+
+    pos = np.searchsorted(sorted_vector, targets)
+    candidates = [order[np.clip(pos - 1, 0, len(vector) - 1)], order[np.clip(pos, 0, len(vector) - 1)]]
+    if period is not None:
+        candidates += [np.full(len(targets), order[0]), np.full(len(targets), order[-1])]
+    candidates = np.stack(candidates)
+
+    distance = vector[candidates] - targets
+    if period is not None:
+        distance = np.mod(distance + period / 2., period) - period / 2.
+    distance = np.abs(distance)
+
+    closest = distance == distance.min(axis=0)
+
+    return np.where(closest, candidates, len(vector)).min(axis=0)
+
+
+def bracket_indices(targets, vector, period=None):
+    """
+    Return the indices of the two vector elements bracketing each target and the linear interpolation weight of the
+    second one. Targets outside the vector range are clamped to its closest end.
+    :param targets: 1D array of target values, eg. latitudes
+    :param vector: 1D coordinate vector, ascending or descending
+    :param period: if set, values are periodic (eg. 360 for longitudes) and targets are bracketed across the wrap
+    :return: (3) first indices, second indices, weights of the second indices in [0:1]
+    """
+    targets = np.atleast_1d(np.asarray(targets, dtype=np.float64))
+    vector = np.asarray(vector, dtype=np.float64)
+    n = len(vector)
+
+    order = np.argsort(vector, kind="stable")
+    sorted_vector = vector[order]
+
+    if period is not None:
+        targets = sorted_vector[0] + np.mod(targets - sorted_vector[0], period)
+
+    pos = np.searchsorted(sorted_vector, targets, side="right")
+    lower = np.clip(pos - 1, 0, n - 1)
+
+    if period is not None:
+        upper = np.mod(pos, n)
+        upper_value = sorted_vector[upper] + np.where(pos == n, period, 0.)
+    else:
+        upper = np.clip(pos, 0, n - 1)
+        upper_value = sorted_vector[upper]
+
+    span = upper_value - sorted_vector[lower]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        weights = np.where(span > 0, (targets - sorted_vector[lower]) / span, 0.)
+
+    return order[lower], order[upper], np.clip(weights, 0., 1.)
+
+
+def _load_disk_cache(cache_file):
+    global _disk_loaded
+
+    if _disk_loaded or not cache_file:
+        return
+    _disk_loaded = True
+
+    try:
+        with open(cache_file) as f:
+            for fingerprint, locations in json.load(f).items():
+                _memory_cache.setdefault(fingerprint, {}).update({k: tuple(v) for k, v in locations.items()})
+    except (FileNotFoundError, ValueError):
+        pass
+
+
+def _save_disk_cache(cache_file):
+    if not cache_file:
+        return
+
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(cache_file)), exist_ok=True)
+        tmp_file = "%s.%i.tmp" % (cache_file, os.getpid())
+        with open(tmp_file, "w") as f:
+            json.dump({fp: {k: list(v) for k, v in locations.items()} for fp, locations in _memory_cache.items()}, f)
+        os.replace(tmp_file, cache_file)
+    except OSError as e:
+        print("WARNING: unable to save grid index cache to %s (%s)" % (cache_file, e))
+
+
+def get_grid_indices(lats, lons, grid_lat, grid_lon, cache_file=GRID_CACHE):
+    """
+    Return the closest latitude and longitude indices of a batch of sites, reusing indices cached for this grid
+    :param lats: latitude(s) in DD [-90:90]
+    :param lons: longitude(s) in DD, either [0:360] or [-180:180]
+    :param grid_lat: 1D latitude vector of the grid
+    :param grid_lon: 1D longitude vector of the grid
+    :param cache_file: JSON file of the on-disk cache, None to keep the cache in memory only
+    :return: (2) latitude indices, longitude indices as 1D arrays
+    """
+    lats = np.atleast_1d(np.asarray(lats, dtype=np.float64))
+    lons = np.atleast_1d(normalize_longitude(lons, grid_lon))
+
+    _load_disk_cache(cache_file)
+    grid_cache = _memory_cache.setdefault(grid_fingerprint(grid_lat, grid_lon), {})
+
+    keys = ["%.6f,%.6f" % (lat, lon) for lat, lon in zip(lats, lons)]
+    missing = [i for i, k in enumerate(keys) if k not in grid_cache]
+
+    if len(missing) > 0:
+        lat_idx = nearest_indices(lats[missing], grid_lat)
+        lon_idx = nearest_indices(lons[missing], grid_lon, period=360.)
+        for i, y, x in zip(missing, lat_idx, lon_idx):
+            grid_cache[keys[i]] = (int(y), int(x))
+        _save_disk_cache(cache_file)
+
+    indices = np.array([grid_cache[k] for k in keys], dtype=int).reshape(-1, 2)
+
+    return indices[:, 0], indices[:, 1]
+
+
+def get_bilinear_weights(lats, lons, grid_lat, grid_lon, cache_file=GRID_CACHE):
+    """
+    Return the corners and separable bilinear weights of a batch of sites, reusing weights cached for this grid. The
+    value at a site is the sum over corners (i, j) of lat_weights[i] * lon_weights[j] * field[lat_idx[i], lon_idx[j]].
+    :param lats: latitude(s) in DD [-90:90]
+    :param lons: longitude(s) in DD, either [0:360] or [-180:180]
+    :param grid_lat: 1D latitude vector of the grid
+    :param grid_lon: 1D longitude vector of the grid
+    :param cache_file: JSON file of the on-disk cache, None to keep the cache in memory only
+    :return: (4) latitude indices, longitude indices, latitude weights, longitude weights as (site, 2) arrays
+    """
+    lats = np.atleast_1d(np.asarray(lats, dtype=np.float64))
+    lons = np.atleast_1d(normalize_longitude(lons, grid_lon))
+
+    _load_disk_cache(cache_file)
+    grid_cache = _memory_cache.setdefault(grid_fingerprint(grid_lat, grid_lon), {})
+
+    keys = ["bilinear,%.6f,%.6f" % (lat, lon) for lat, lon in zip(lats, lons)]
+    missing = [i for i, k in enumerate(keys) if k not in grid_cache]
+
+    if len(missing) > 0:
+        lat0, lat1, wy = bracket_indices(lats[missing], grid_lat)
+        lon0, lon1, wx = bracket_indices(lons[missing], grid_lon, period=360.)
+        for k, i in enumerate(missing):
+            grid_cache[keys[i]] = (int(lat0[k]), int(lat1[k]), float(wy[k]), int(lon0[k]), int(lon1[k]), float(wx[k]))
+        _save_disk_cache(cache_file)
+
+    entries = np.array([grid_cache[k] for k in keys], dtype=np.float64).reshape(-1, 6)
+
+    lat_idx = entries[:, 0:2].astype(int)
+    lon_idx = entries[:, 3:5].astype(int)
+    lat_weights = np.column_stack([1. - entries[:, 2], entries[:, 2]])
+    lon_weights = np.column_stack([1. - entries[:, 5], entries[:, 5]])
+
+    return lat_idx, lon_idx, lat_weights, lon_weights
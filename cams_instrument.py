@@ -0,0 +1,283 @@
+"""
+CAMS tools instrumentation
+
+Purpose : stage-level timing and I/O counters shared by the CLIs, enabled with --profile. Stages are named sections of
+    code (eg. 'open', 'read', 'write', 'savefig') whose calls and elapsed time are accumulated, along with the number
+    of files opened, the bytes read by the process (from /proc/self/io, on Linux only) and the peak resident memory.
+    Work done in worker processes is recorded there and merged into the parent through pool_map or pool_imap. A
+    summary table or JSON is printed at exit.
+
+    When profiling is not enabled, stage() and opened() do nothing and pool_map is a plain executor.map.
+
+v0.0.1 : pool_imap keeps a rolling window of pending calls, a new argument being submitted as soon as the oldest result
+    is consumed, so that workers do not sit idle at batch boundaries. Each stage call is also emitted as a structured
+    DEBUG record of the 'cams_instrument' logger (stage, seconds, pid, end time), printed as JSON lines on stderr with
+    --profile log, workers included.
+
+v0.0.0 : initial release
+"""
+
+__author__ = "jerome.colin'at'cesbio.cnes.fr"
+__license__ = "MIT"
+__version__ = "0.0.1"
+
+import sys, os, time, json, atexit, resource, functools, contextlib, collections
+import logging
+
+FORMATS = ("table", "json", "log")
+
+logger = logging.getLogger("cams_instrument")
+
+_enabled = False
+_start = None
+_io_start = None
+_stats = {"stages": {}, "files_opened": 0, "bytes_read": 0}
+
+
+def get_bytes_read():
+    """
+    Return the bytes read by the process so far, including from the page cache
+    :return: bytes as int, None if /proc/self/io is not available
+    """
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                if line.startswith("rchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+
+    return None
+
+
+def reset():
+    """
+    Clear the stats recorded so far and restart the wall time and bytes read counters
+    :return: None
+    """
+    global _start, _io_start
+
+    _stats["stages"] = {}
+    _stats["files_opened"] = 0
+    _stats["bytes_read"] = 0
+    _start = time.perf_counter()
+    _io_start = get_bytes_read()
+
+
+def enable():
+    """
+    Start recording stats in this process
+    :return: None
+    """
+    global _enabled
+
+    _enabled = True
+    reset()
+
+
+def enabled():
+    """
+    :return: True if stats are recorded
+    """
+    return _enabled
+
+
+def log_stages():
+    """
+    Print a JSON record of every stage call on stderr, through the 'cams_instrument' logger
+    :return: None
+    """
+    if not logger.handlers:
+        handler = logging.StreamHandler(sys.stderr)
+        handler.setFormatter(logging.Formatter("STAGE: %(message)s"))
+        logger.addHandler(handler)
+    logger.setLevel(logging.DEBUG)
+
+
+def start(fmt="table"):
+    """
+    Start recording stats and print their summary when the program exits
+    :param fmt: summary format, one of FORMATS, 'log' also prints a record per stage call and a table summary
+    :return: None
+    """
+    enable()
+    if fmt == "log":
+        log_stages()
+    atexit.register(print_summary, fmt)
+
+
+@contextlib.contextmanager
+def stage(name):
+    """
+    Context manager accumulating the calls and elapsed time of a stage, and emitting a DEBUG record of each call when
+    the 'cams_instrument' logger is enabled for it. The record is a JSON message, its fields are also given as the
+    'stage' attribute of the log record.
+    :param name: stage name
+    """
+    logged = logger.isEnabledFor(logging.DEBUG)
+    if not _enabled and not logged:
+        yield
+        return
+
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - t0
+        if _enabled:
+            calls, seconds = _stats["stages"].get(name, (0, 0.))
+            _stats["stages"][name] = (calls + 1, seconds + elapsed)
+        if logged:
+            record = {"stage": name, "seconds": elapsed, "pid": os.getpid(), "end": time.time()}
+            logger.debug(json.dumps(record), extra={"stage": record})
+
+
+def opened(filename):
+    """
+    Count an opened file
+    :param filename: filename, unused but documents the call site
+    :return: None
+    """
+    if _enabled:
+        _stats["files_opened"] += 1
+
+
+def snapshot():
+    """
+    Return the stats recorded since the last reset
+    :return: a dict of stats
+    """
+    io_now = get_bytes_read()
+
+    return {
+        "stages": {name: list(value) for name, value in _stats["stages"].items()},
+        "files_opened": _stats["files_opened"],
+        "bytes_read": _stats["bytes_read"] + (io_now - _io_start if io_now is not None and _io_start is not None
+                                              else 0),
+    }
+
+
+def merge(stats):
+    """
+    Add stats recorded in another process
+    :param stats: dict returned by snapshot
+    :return: None
+    """
+    for name, (calls, seconds) in stats["stages"].items():
+        total_calls, total_seconds = _stats["stages"].get(name, (0, 0.))
+        _stats["stages"][name] = (total_calls + calls, total_seconds + seconds)
+    _stats["files_opened"] += stats["files_opened"]
+    _stats["bytes_read"] += stats["bytes_read"]
+
+
+def run_collected(function, *args, log=False, **kwargs):
+    """
+    Run a function in a worker process and return its result along with the stats it recorded
+    :param function: function to run
+    :param log: if True, print a record per stage call as the parent does, see log_stages
+    :return: (2) result, dict of stats
+    """
+    enable()
+    if log:
+        log_stages()
+    result = function(*args, **kwargs)
+
+    return result, snapshot()
+
+
+def _merged(results):
+    for result, stats in results:
+        merge(stats)
+        yield result
+
+
+def pool_map(executor, function, iterable, chunksize=1):
+    """
+    Map a function over a process pool like executor.map, merging the stats recorded by the workers when profiling
+    :param executor: a ProcessPoolExecutor
+    :param function: picklable function
+    :param iterable: arguments
+    :param chunksize: number of arguments sent at once to a worker
+    :return: an iterator of results, in the order of iterable
+    """
+    if not _enabled:
+        return executor.map(function, iterable, chunksize=chunksize)
+
+    collector = functools.partial(run_collected, function, log=logger.isEnabledFor(logging.DEBUG))
+
+    return _merged(executor.map(collector, iterable, chunksize=chunksize))
+
+
+def pool_imap(executor, function, iterable, window):
+    """
+    Map a function over a process pool with at most window pending calls, merging the stats recorded by the workers
+    when profiling. A new argument is submitted each time the oldest result is consumed, so that memory stays bounded
+    and the pool stays busy whatever the number of arguments.
+    :param executor: a ProcessPoolExecutor
+    :param function: picklable function
+    :param iterable: arguments
+    :param window: maximum number of pending calls
+    :return: an iterator of results, in the order of iterable
+    """
+    collected = _enabled
+    log = logger.isEnabledFor(logging.DEBUG)
+    pending = collections.deque()
+
+    def result(future):
+        if not collected:
+            return future.result()
+        value, stats = future.result()
+        merge(stats)
+        return value
+
+    for argument in iterable:
+        if collected:
+            pending.append(executor.submit(run_collected, function, argument, log=log))
+        else:
+            pending.append(executor.submit(function, argument))
+        if len(pending) >= window:
+            yield result(pending.popleft())
+
+    while pending:
+        yield result(pending.popleft())
+
+
+def get_summary():
+    """
+    Return the summary of the stats recorded in this process and merged from workers
+    :return: a dict
+    """
+    stats = snapshot()
+    # ru_maxrss is in kilobytes on Linux, in bytes on macOS
+    unit = 1. if sys.platform == "darwin" else 1024.
+
+    return {
+        "wall_time": time.perf_counter() - _start,
+        "stages": {name: {"calls": calls, "seconds": seconds} for name, (calls, seconds) in stats["stages"].items()},
+        "files_opened": stats["files_opened"],
+        "bytes_read": stats["bytes_read"] if _io_start is not None else None,
+        "peak_rss": int(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit),
+        "peak_rss_workers": int(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit),
+    }
+
+
+def print_summary(fmt="table"):
+    """
+    Print the summary of the stats
+    :param fmt: summary format, one of FORMATS
+    :return: None
+    """
+    summary = get_summary()
+
+    if fmt == "json":
+        print(json.dumps(summary))
+        return
+
+    print("PROFILE: %-16s %8s %12s %12s" % ("stage", "calls", "total (s)", "mean (ms)"))
+    for name, stage_stats in sorted(summary["stages"].items(), key=lambda item: -item[1]["seconds"]):
+        print("PROFILE: %-16s %8i %12.3f %12.2f" % (name, stage_stats["calls"], stage_stats["seconds"],
+                                                     1000. * stage_stats["seconds"] / stage_stats["calls"]))
+    print("PROFILE: wall time %.3f s, %i files opened, %s read, peak RSS %.1f MB (workers %.1f MB)" % (
+        summary["wall_time"], summary["files_opened"],
+        "n/a" if summary["bytes_read"] is None else "%.1f MB" % (summary["bytes_read"] / 2 ** 20),
+        summary["peak_rss"] / 2 ** 20, summary["peak_rss_workers"] / 2 ** 20))
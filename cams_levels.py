@@ -0,0 +1,148 @@
+"""
+CAMS model level pressures
+
+Purpose : pressure of the hybrid sigma-pressure model levels of CAMS products, computed from the ECMWF L137 a/b
+    coefficients and the surface pressure as p = a + b * sp at half levels (the interfaces between model levels), full
+    level pressures being the mean of the two half levels bounding each model level. 69-level products use every other
+    L137 half level.
+
+    Coefficient tables are built once per level count and cached. Surface pressures may be given as an array of any
+    shape, eg. (time, site), so that the profiles of a whole collection are converted in one array operation; products
+    without a surface pressure field are converted at the standard surface pressure.
+
+    MR_SPECIES lists the aerosol mixing ratio variables of the model level (MR) products, shared by the tools reading or
+    writing them.
+
+v0.0.1 : an unknown level count raises ValueError instead of exiting, so that long-running callers (see
+    cams_service) can report it.
+
+v0.0.0 : initial release
+"""
+
+__author__ = "jerome.colin'at'cesbio.cnes.fr"
+__license__ = "MIT"
+__version__ = "0.0.1"
+
+import functools
+import numpy as np
+
+# Standard surface pressure (Pa)
+STANDARD_SURFACE_PRESSURE = 101325.
+
+# Surface pressure variables looked up in products, in Pa or as its natural logarithm
+SURFACE_PRESSURE_VARIABLES = ("sp", "lnsp")
+
+# Aerosol mixing ratio variables of MR products, 5-species products have no nitrate (aermr16, aermr17) and ammonium
+MR_SPECIES = ("aermr01", "aermr02", "aermr03", "aermr04", "aermr05", "aermr06", "aermr07", "aermr08", "aermr09",
+              "aermr10", "aermr11", "aermr16", "aermr17", "aermr18")
+
+# ECMWF L137 half level coefficients, from the top of the atmosphere (a in Pa, b dimensionless)
+A_137 = (
+    0.000000, 2.000365, 3.102241, 4.666084, 6.827977, 9.746966, 13.605424, 18.608931, 24.985718, 32.985710, 42.879242,
+    54.955463, 69.520576, 86.895882, 107.415741, 131.425507, 159.279404, 191.338562, 227.968948, 269.539581,
+    316.420746, 368.982361, 427.592499, 492.616028, 564.413452, 643.339905, 729.744141, 823.967834, 926.344910,
+    1037.201172, 1156.853638, 1285.610352, 1423.770142, 1571.622925, 1729.448975, 1897.519287, 2075.095947,
+    2265.431641, 2465.770508, 2677.348145, 2900.391357, 3135.119385, 3381.743652, 3640.468262, 3911.490479,
+    4194.930664, 4490.817383, 4799.149414, 5119.895020, 5452.990723, 5798.344727, 6156.074219, 6526.946777,
+    6911.870605, 7311.869141, 7727.412109, 8159.354004, 8608.525391, 9076.400391, 9562.682617, 10065.978516,
+    10584.631836, 11116.662109, 11660.067383, 12211.547852, 12766.873047, 13324.668945, 13881.331055, 14432.139648,
+    14975.615234, 15508.256836, 16026.115234, 16527.322266, 17008.789063, 17467.613281, 17901.621094, 18308.433594,
+    18685.718750, 19031.289063, 19343.511719, 19620.042969, 19859.390625, 20059.931641, 20219.664063, 20337.863281,
+    20412.308594, 20442.078125, 20425.718750, 20361.816406, 20249.511719, 20087.085938, 19874.025391, 19608.572266,
+    19290.226563, 18917.460938, 18489.707031, 18006.925781, 17471.839844, 16888.687500, 16262.046875, 15596.695313,
+    14898.453125, 14173.324219, 13427.769531, 12668.257813, 11901.339844, 11133.304688, 10370.175781, 9617.515625,
+    8880.453125, 8163.375000, 7470.343750, 6804.421875, 6168.531250, 5564.382813, 4993.796875, 4457.375000,
+    3955.960938, 3489.234375, 3057.265625, 2659.140625, 2294.242188, 1961.500000, 1659.476563, 1387.546875,
+    1143.250000, 926.507813, 734.992188, 568.062500, 424.414063, 302.476563, 202.484375, 122.101563, 62.781250,
+    22.835938, 3.757813, 0.000000, 0.000000,
+)
+
+B_137 = (
+    0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000,
+    0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000,
+    0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000,
+    0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000,
+    0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000, 0.000000,
+    0.000007, 0.000024, 0.000059, 0.000112, 0.000199, 0.000340, 0.000562, 0.000890, 0.001353, 0.001992, 0.002857,
+    0.003971, 0.005378, 0.007133, 0.009261, 0.011806, 0.014816, 0.018318, 0.022355, 0.026964, 0.032176, 0.038026,
+    0.044548, 0.051773, 0.059728, 0.068448, 0.077958, 0.088286, 0.099462, 0.111505, 0.124448, 0.138313, 0.153125,
+    0.168910, 0.185689, 0.203491, 0.222333, 0.242244, 0.263242, 0.285354, 0.308598, 0.332939, 0.358254, 0.384363,
+    0.411125, 0.438391, 0.466003, 0.493800, 0.521619, 0.549301, 0.576692, 0.603648, 0.630036, 0.655736, 0.680643,
+    0.704669, 0.727739, 0.749797, 0.770798, 0.790717, 0.809536, 0.827256, 0.843881, 0.859432, 0.873929, 0.887408,
+    0.899900, 0.911448, 0.922096, 0.931881, 0.940860, 0.949064, 0.956549, 0.963352, 0.969513, 0.975078, 0.980072,
+    0.984542, 0.988500, 0.991984, 0.995003, 0.997630, 1.000000,
+)
+
+# L137 half levels bounding the model levels of each level count, from the top of the atmosphere
+LEVEL_SETS = {
+    137: tuple(range(138)),
+    69: (0,) + tuple(range(1, 138, 2)),
+}
+
+
+@functools.lru_cache(maxsize=None)
+def get_coefficients(n_levels):
+    """
+    Return the a/b coefficients of the half levels of a product, computed once per level count
+    :param n_levels: number of model levels, one of LEVEL_SETS
+    :return: (2) a (Pa), b as read-only arrays of n_levels + 1 half levels, from the top of the atmosphere
+    """
+    if n_levels not in LEVEL_SETS:
+        raise ValueError("unknown level size %i, expected one of %s" % (n_levels, sorted(LEVEL_SETS)))
+
+    half_levels = list(LEVEL_SETS[n_levels])
+    a = np.asarray(A_137, dtype=np.float64)[half_levels]
+    b = np.asarray(B_137, dtype=np.float64)[half_levels]
+    a.flags.writeable = False
+    b.flags.writeable = False
+
+    return a, b
+
+
+def get_half_level_pressures(n_levels, surface_pressure=STANDARD_SURFACE_PRESSURE):
+    """
+    Return the pressure at the half levels of a product
+    :param n_levels: number of model levels, one of LEVEL_SETS
+    :param surface_pressure: surface pressure (Pa), scalar or array of any shape
+    :return: pressures (Pa) with a trailing axis of n_levels + 1 half levels, from the top of the atmosphere
+    """
+    a, b = get_coefficients(n_levels)
+
+    return a + b * np.asarray(surface_pressure, dtype=np.float64)[..., None]
+
+
+def get_full_level_pressures(n_levels, surface_pressure=STANDARD_SURFACE_PRESSURE):
+    """
+    Return the pressure at the full levels of a product, the mean of the two half levels bounding each model level
+    :param n_levels: number of model levels, one of LEVEL_SETS
+    :param surface_pressure: surface pressure (Pa), scalar or array of any shape
+    :return: pressures (Pa) with a trailing axis of n_levels model levels, from the top of the atmosphere
+    """
+    half = get_half_level_pressures(n_levels, surface_pressure)
+
+    return 0.5 * (half[..., :-1] + half[..., 1:])
+
+
+def get_surface_pressure_variable(variables):
+    """
+    Return the name of the surface pressure variable of a product
+    :param variables: variable names of the product
+    :return: (2) variable name, True if it holds the logarithm of the pressure, or (None, False) if there is none
+    """
+    for name in SURFACE_PRESSURE_VARIABLES:
+        if name in variables:
+            return name, name == "lnsp"
+
+    return None, False
+
+
+def to_surface_pressure(values, log=False):
+    """
+    Convert surface pressure values read from a product to Pa
+    :param values: surface pressure, in Pa or as its natural logarithm
+    :param log: True if values are logarithms
+    :return: surface pressure (Pa) as a float64 array
+    """
+    values = np.asarray(values, dtype=np.float64)
+
+    return np.exp(values) if log else values
@@ -0,0 +1,533 @@
+#! /usr/bin/env python
+
+"""
+CAMS AOD maps
+
+Purpose : render maps of the AOT products of a collection, total AOD at 550nm, the AOD of a species or its
+    contribution to the total AOD (%), over the whole grid or a bounding box, one frame per time step. Frames are
+    written as an animated GIF (Pillow), an MP4 video (ffmpeg) or a set of PNG tiles with a JSON index.
+
+    The map figure, its colorbar and the coastlines (from cartopy, if installed) are built once per process and only
+    the image data and title are updated from one frame to the next. The grid window of the bounding box is computed
+    once per grid, and only the window is read from each product. Frames can be rendered over a process pool with
+    --workers using the Agg backend, they are written in time order.
+
+v0.0.2 : GIF frames are written one at a time, instead of all being held in memory by Pillow until the end.
+
+v0.0.1 : frame batches are submitted to the process pool through a rolling window, and workers close their map
+    figures at the end of each batch. The layout of a map figure is computed once when it is built, frames rendered
+    with --workers are now identical to serial ones.
+
+v0.0.0 : initial release
+"""
+
+__author__ = "jerome.colin'at'cesbio.cnes.fr"
+__license__ = "MIT"
+__version__ = "0.0.2"
+
+import argparse, sys, os, io, shutil, subprocess, itertools
+import functools
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import xarray as xr
+import matplotlib.pyplot as pl
+from matplotlib.collections import LineCollection
+import cams_grid
+import cams_region
+import cams_catalog
+import cams_extract_aod
+import cams_instrument
+from cams_aod_timeline import SPECIES, SPECIES_LABELS
+
+try:
+    import cartopy.feature as cfeature
+except ImportError:
+    cfeature = None
+
+VARIABLES = ["aod"] + SPECIES
+
+# Grid windows, coastlines and figures reused from one frame to the next
+_windows = {}
+_coastlines = {}
+_figures = {}
+
+
+def get_window(grid_lat, grid_lon, bbox=None):
+    """
+    Return the grid indices of a bounding box, computed once per grid. Longitudes are ordered in [-180:180], or in
+    [0:360] if the bounding box crosses the antimeridian, and latitudes from north to south.
+    :param grid_lat: 1D latitude vector of the grid
+    :param grid_lon: 1D longitude vector of the grid
+    :param bbox: (4) lat_min, lat_max, lon_min, lon_max in DD, None for the whole grid
+    :return: a dict of latitude indices, longitude indices, longitudes and image extent (lon_min, lon_max, lat_min,
+        lat_max)
+    """
+    key = (cams_grid.grid_fingerprint(grid_lat, grid_lon), None if bbox is None else tuple(bbox))
+    if key in _windows:
+        return _windows[key]
+
+    grid_lat = np.asarray(grid_lat, dtype=np.float64)
+    lat_min, lat_max, lon_min, lon_max = bbox if bbox is not None else (-90., 90., -180., 180.)
+
+    if bbox is not None:
+        lon_min, lon_max = cams_region.wrap_longitude([lon_min, lon_max])
+        if lon_min == lon_max:
+            lon_min, lon_max = -180., 180.
+
+    # A bounding box crossing the antimeridian is drawn with longitudes in [0:360]
+    crossing = lon_min > lon_max
+    lon = np.mod(grid_lon, 360.) if crossing else cams_region.wrap_longitude(grid_lon)
+    if crossing:
+        lon_max += 360.
+
+    lat_idx = np.flatnonzero((grid_lat >= lat_min) & (grid_lat <= lat_max))
+    lat_idx = lat_idx[np.argsort(-grid_lat[lat_idx], kind="stable")]
+    lon_idx = np.flatnonzero((lon >= lon_min) & (lon <= lon_max))
+    lon_idx = lon_idx[np.argsort(lon[lon_idx], kind="stable")]
+
+    if len(lat_idx) == 0 or len(lon_idx) == 0:
+        print("ERROR: no grid cell in bounding box %s" % (bbox,))
+        sys.exit(1)
+
+    # Image extent from the cell edges, assuming a regular grid
+    dlat = abs(grid_lat[1] - grid_lat[0]) if len(grid_lat) > 1 else 1.
+    dlon = abs(lon[1] - lon[0]) if len(lon) > 1 else 1.
+    extent = (lon[lon_idx[0]] - dlon / 2., lon[lon_idx[-1]] + dlon / 2., grid_lat[lat_idx[-1]] - dlat / 2.,
+              grid_lat[lat_idx[0]] + dlat / 2.)
+
+    _windows[key] = {"lat_idx": lat_idx, "lon_idx": lon_idx, "lon": lon[lon_idx], "extent": extent,
+                     "crossing": crossing}
+
+    return _windows[key]
+
+
+def get_field(ds, window, variable="aod", fraction=False):
+    """
+    Read the window of an AOT field: total AOD, AOD of a species, or contribution of a species to the total AOD
+    :param ds: xarray AOT dataset
+    :param window: dict returned by get_window
+    :param variable: 'aod' or a species, one of VARIABLES
+    :param fraction: if True, contribution of the species to the total AOD (%)
+    :return: 2D float array (latitude, longitude), NaN if the species is not in the product
+    """
+    index = {'latitude': window["lat_idx"], 'longitude': window["lon_idx"]}
+    shape = (len(window["lat_idx"]), len(window["lon_idx"]))
+
+    def read(name):
+        return ds[name].isel(time=0).isel(index).values.astype(np.float64)
+
+    if variable != "aod" and variable not in ds.data_vars:
+        return np.full(shape, np.nan)
+
+    if variable != "aod" and not fraction:
+        return read(variable)
+
+    fields = {name: read(name) for name in SPECIES if name in ds.data_vars}
+    total = sum(fields.values())
+
+    if variable == "aod":
+        return total
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return 100. * fields[variable] / total
+
+
+def read_frame(filename, variable="aod", fraction=False, bbox=None):
+    """
+    Open an AOT product, read the window of its field and close the product
+    :param filename: AOT netCDF file
+    :param variable: 'aod' or a species, one of VARIABLES
+    :param fraction: if True, contribution of the species to the total AOD (%)
+    :param bbox: (4) lat_min, lat_max, lon_min, lon_max in DD, None for the whole grid
+    :return: (3) timestamp, 2D field, window
+    """
+    with cams_instrument.stage("open"):
+        ds = xr.open_dataset(filename)
+        cams_instrument.opened(filename)
+
+    with ds, cams_instrument.stage("read"):
+        window = get_window(ds['latitude'].values, ds['longitude'].values, bbox=bbox)
+        field = get_field(ds, window, variable=variable, fraction=fraction)
+
+    return cams_catalog.get_timestamp(filename), field, window
+
+
+def get_coastlines(resolution="110m"):
+    """
+    Return the coastline segments of Natural Earth, loaded once through cartopy
+    :param resolution: Natural Earth scale, '110m', '50m' or '10m'
+    :return: list of (N, 2) arrays of longitude, latitude, empty if cartopy or the Natural Earth data is unavailable
+    """
+    if resolution in _coastlines:
+        return _coastlines[resolution]
+
+    segments = []
+    if cfeature is None:
+        print("INFO: cartopy is not installed, maps are drawn without coastlines")
+    else:
+        try:
+            for geometry in cfeature.COASTLINE.with_scale(resolution).geometries():
+                for line in getattr(geometry, "geoms", [geometry]):
+                    segments.append(np.asarray(line.coords)[:, :2])
+        except Exception as e:
+            print("WARNING: coastlines could not be loaded (%s)" % e)
+            segments = []
+
+    _coastlines[resolution] = segments
+
+    return segments
+
+
+def get_label(variable="aod", fraction=False):
+    """
+    :param variable: 'aod' or a species, one of VARIABLES
+    :param fraction: if True, contribution of the species to the total AOD (%)
+    :return: label of the mapped quantity
+    """
+    if variable == "aod":
+        return "Total AOD at 550nm"
+    if fraction:
+        return "%s contribution to AOD at 550nm (%%)" % SPECIES_LABELS[variable].capitalize()
+
+    return "%s AOD at 550nm" % SPECIES_LABELS[variable].capitalize()
+
+
+def init_map_figure(window, label, vmax=1., cmap="YlOrBr", coastlines="110m"):
+    """
+    Build the map figure once: axes, empty image, colorbar, coastlines and static labels
+    :param window: dict returned by get_window
+    :param label: label of the mapped quantity
+    :param vmax: upper limit of the color scale
+    :param cmap: matplotlib colormap name
+    :param coastlines: Natural Earth scale of the coastlines, None for no coastlines
+    :return: a dict of the figure artists, updated by update_map_figure
+    """
+    lon_min, lon_max, lat_min, lat_max = window["extent"]
+    aspect = (lon_max - lon_min) / max(lat_max - lat_min, 1e-6)
+    fig, ax = pl.subplots(figsize=(min(max(4. * aspect, 6.), 14.) + 1.5, 6.), constrained_layout=True)
+    title = ax.set_title("")
+
+    im = ax.imshow(np.zeros((len(window["lat_idx"]), len(window["lon_idx"]))), extent=window["extent"],
+                   origin="upper", vmin=0., vmax=vmax, cmap=pl.colormaps[cmap].with_extremes(bad="lightgrey"),
+                   interpolation="nearest", aspect="auto")
+    fig.colorbar(im, ax=ax, label=label)
+
+    if coastlines is not None:
+        segments = get_coastlines(coastlines)
+        if window["crossing"]:
+            segments = segments + [s + [360., 0.] for s in segments]
+        ax.add_collection(LineCollection(segments, colors="black", linewidths=0.5))
+
+    ax.set_xlim(lon_min, lon_max)
+    ax.set_ylim(lat_min, lat_max)
+    ax.set_xlabel("Longitude (°E)")
+    ax.set_ylabel("Latitude (°N)")
+
+    # Constrained layout only settles after a couple of draws: lay the figure out once with a title of the final
+    # length and freeze it, so that the frames of a fresh figure match those of a reused one
+    title.set_text("%s @ 2000-01-01 00:00 UTC" % label)
+    for _ in range(2):
+        fig.draw_without_rendering()
+    fig.set_layout_engine("none")
+
+    return {"fig": fig, "ax": ax, "im": im, "title": title}
+
+
+def update_map_figure(figure, field, title):
+    """
+    Update the image data and title of a map figure built by init_map_figure
+    :param figure: dict of the figure artists
+    :param field: 2D field (latitude, longitude)
+    :param title: figure title
+    :return: None
+    """
+    figure["im"].set_data(np.ma.masked_invalid(field))
+    figure["title"].set_text(title)
+
+
+def get_map_figure(window, label, vmax=1., cmap="YlOrBr", coastlines="110m"):
+    """
+    Return the map figure of a window, building it on first use
+    :param window: dict returned by get_window
+    :param label: label of the mapped quantity
+    :param vmax: upper limit of the color scale
+    :param cmap: matplotlib colormap name
+    :param coastlines: Natural Earth scale of the coastlines, None for no coastlines
+    :return: a dict of the figure artists
+    """
+    key = (window["extent"], window["lat_idx"].shape, window["lon_idx"].shape, label, vmax, cmap, coastlines)
+    if key not in _figures:
+        _figures[key] = init_map_figure(window, label, vmax=vmax, cmap=cmap, coastlines=coastlines)
+
+    return _figures[key]
+
+
+def close_map_figures():
+    """
+    Close all the map figures kept for reuse
+    :return: None
+    """
+    for figure in _figures.values():
+        pl.close(figure["fig"])
+    _figures.clear()
+
+
+def render_frame(filename, variable="aod", fraction=False, bbox=None, vmax=1., cmap="YlOrBr", coastlines="110m",
+                 dpi=100):
+    """
+    Render the map of one product, reusing the figure of the previous product
+    :param filename: AOT netCDF file
+    :param variable: 'aod' or a species, one of VARIABLES
+    :param fraction: if True, contribution of the species to the total AOD (%)
+    :param bbox: (4) lat_min, lat_max, lon_min, lon_max in DD, None for the whole grid
+    :param vmax: upper limit of the color scale
+    :param cmap: matplotlib colormap name
+    :param coastlines: Natural Earth scale of the coastlines, None for no coastlines
+    :param dpi: resolution of the frame
+    :return: (2) timestamp, PNG content as bytes
+    """
+    ts, field, window = read_frame(filename, variable=variable, fraction=fraction, bbox=bbox)
+    label = get_label(variable, fraction)
+
+    with cams_instrument.stage("plot"):
+        figure = get_map_figure(window, label, vmax=vmax, cmap=cmap, coastlines=coastlines)
+        update_map_figure(figure, field, "%s @ %s UTC" % (label, ts.strftime("%Y-%m-%d %H:%M")))
+
+    png = io.BytesIO()
+    with cams_instrument.stage("savefig"):
+        figure["fig"].savefig(png, format="png", dpi=dpi)
+
+    return ts, png.getvalue()
+
+
+def render_batch(batch, renderer):
+    """
+    Render a batch of frames in a worker process, reusing the map figure from one frame to the next and closing it
+    once the batch is rendered
+    :param batch: list of AOT netCDF files
+    :param renderer: picklable function of a filename returning (timestamp, PNG content), eg. render_frame
+    :return: list of (timestamp, PNG content)
+    """
+    try:
+        return [renderer(filename) for filename in batch]
+    finally:
+        close_map_figures()
+
+
+def _init_render_worker():
+    pl.switch_backend("Agg")
+
+
+def render_frames(files, renderer, workers=1):
+    """
+    Render the frames of a list of products, either serially or spread over a process pool. Frames are yielded in the
+    order of files whatever the number of workers, and only a bounded number of them is held in memory.
+    :param files: list of AOT netCDF files
+    :param renderer: picklable function of a filename returning (timestamp, PNG content), eg. render_frame
+    :param workers: number of worker processes, 1 renders in the current process
+    :return: a generator of (timestamp, PNG content)
+    """
+    if workers > 1:
+        # Small batches in a rolling window bound the frames held in memory, and keep workers busy
+        size = max(1, min(16, len(files) // (workers * 4)))
+        batches = [files[i:i + size] for i in range(0, len(files), size)]
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_render_worker) as executor:
+            batch_renderer = functools.partial(render_batch, renderer=renderer)
+            for frames in cams_instrument.pool_imap(executor, batch_renderer, batches, window=workers * 2):
+                yield from frames
+    else:
+        _init_render_worker()
+        try:
+            yield from map(renderer, files)
+        finally:
+            close_map_figures()
+
+
+def write_gif(frames, output, fps=4):
+    """
+    Write frames to an animated GIF with Pillow, one frame at a time so that only the current frame is held in memory
+    whatever the number of frames. Each frame has its own palette, written as a local color table.
+    :param frames: iterator of (timestamp, PNG content)
+    :param output: GIF filename
+    :param fps: frames per second
+    :return: number of frames written
+    """
+    from PIL import Image, GifImagePlugin
+
+    images = (Image.open(io.BytesIO(png)).convert("RGB").convert("P", palette=Image.Palette.ADAPTIVE)
+              for ts, png in frames)
+    first = next(images, None)
+    if first is None:
+        return 0
+
+    duration = int(1000 / fps)
+    count = 0
+    with cams_instrument.stage("write"), open(output, "wb") as f:
+        # Image.save(save_all=True) would keep every frame until the end, to merge identical ones
+        header, used_palette_colors = GifImagePlugin.getheader(first, info={"loop": 0, "duration": duration})
+        f.write(b"".join(header))
+        for image in itertools.chain([first], images):
+            data = GifImagePlugin.getdata(image, duration=duration, include_color_table=True)
+            f.writelines(data)
+            # The list is also held by a class local to getdata, which only the cyclic garbage collector frees
+            data.clear()
+            count += 1
+        f.write(b";")
+
+    return count
+
+
+def write_mp4(frames, output, fps=4):
+    """
+    Write frames to an H.264 MP4 video, piping them to ffmpeg
+    :param frames: iterator of (timestamp, PNG content)
+    :param output: MP4 filename
+    :param fps: frames per second
+    :return: number of frames written
+    """
+    ffmpeg = shutil.which("ffmpeg")
+    if ffmpeg is None:
+        print("ERROR: ffmpeg not found, needed to write %s (write a GIF or PNG tiles instead)" % output)
+        sys.exit(1)
+
+    # yuv420p needs even frame dimensions
+    command = [ffmpeg, "-y", "-loglevel", "error", "-f", "image2pipe", "-framerate", str(fps), "-i", "-",
+               "-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2", "-c:v", "libx264", "-pix_fmt", "yuv420p", output]
+
+    count = 0
+    process = subprocess.Popen(command, stdin=subprocess.PIPE)
+    try:
+        for ts, png in frames:
+            with cams_instrument.stage("write"):
+                process.stdin.write(png)
+            count += 1
+    finally:
+        process.stdin.close()
+        process.wait()
+
+    if process.returncode != 0:
+        print("ERROR: ffmpeg failed to write %s" % output)
+        sys.exit(1)
+
+    return count
+
+
+def write_tiles(frames, output, prefix="aod"):
+    """
+    Write frames as PNG tiles, one per time step, with an 'index.json' list of timestamps and tiles
+    :param frames: iterator of (timestamp, PNG content)
+    :param output: output directory, created if needed
+    :param prefix: tile filename prefix
+    :return: number of frames written
+    """
+    os.makedirs(output, exist_ok=True)
+
+    index = []
+    for ts, png in frames:
+        tile = "%s_%s.png" % (prefix, ts.strftime("%Y%m%dT%H%M%S"))
+        with cams_instrument.stage("write"), open(os.path.join(output, tile), "wb") as f:
+            f.write(png)
+        index.append({"time": ts.isoformat(), "tile": tile})
+
+    cams_extract_aod.write_json(os.path.join(output, "index.json"), index)
+
+    return len(index)
+
+
+def render_map(path, output, variable="aod", fraction=False, bbox=None, vmax=None, cmap="YlOrBr", coastlines="110m",
+               dpi=100, fps=4, workers=1, catalog=None, start=None, end=None):
+    """
+    Render the maps of all the AOT products of a collection to a GIF, an MP4 or PNG tiles, depending on the extension
+    of output
+    :param path: path to a CAMS collection
+    :param output: '.gif' or '.mp4' filename, or directory of PNG tiles
+    :param variable: 'aod' or a species, one of VARIABLES
+    :param fraction: if True, contribution of the species to the total AOD (%)
+    :param bbox: (4) lat_min, lat_max, lon_min, lon_max in DD, None for the whole grid
+    :param vmax: upper limit of the color scale, defaults to 1 for AOD and 100 for contributions
+    :param cmap: matplotlib colormap name
+    :param coastlines: Natural Earth scale of the coastlines, None for no coastlines
+    :param dpi: resolution of the frames
+    :param fps: frames per second of GIF and MP4 outputs
+    :param workers: number of worker processes rendering frames
+    :param catalog: optional SQLite catalog of the collection, used instead of walking path
+    :param start: first product timestamp as datetime, None for no lower bound
+    :param end: last product timestamp as datetime (included), None for no upper bound
+    :return: number of frames written
+    """
+    with cams_instrument.stage("list"):
+        files = cams_extract_aod.list_products(path, catalog=catalog, start=start, end=end)
+
+    if vmax is None:
+        vmax = 100. if fraction else 1.
+
+    renderer = functools.partial(render_frame, variable=variable, fraction=fraction, bbox=bbox, vmax=vmax, cmap=cmap,
+                                 coastlines=coastlines, dpi=dpi)
+    print("INFO: rendering %i maps with %i worker(s)" % (len(files), workers))
+
+    frames = render_frames(files, renderer, workers=workers)
+    extension = os.path.splitext(output)[1].lower()
+
+    if extension == ".gif":
+        count = write_gif(frames, output, fps=fps)
+    elif extension == ".mp4":
+        count = write_mp4(frames, output, fps=fps)
+    else:
+        count = write_tiles(frames, output, prefix="%s%s" % (variable, "_fraction" if fraction else ""))
+
+    print("INFO: %i frames written to %s" % (count, output))
+
+    return count
+
+
+def main():
+    """
+    Render maps of total AOD, species AOD or species contribution to AOD for every product of a collection
+    :return: a GIF, an MP4 or a directory of PNG tiles
+    """
+    # Argument parser
+    parser = argparse.ArgumentParser()
+    parser.add_argument("directory", help="Path to a CAMS collection")
+    parser.add_argument("output", help="Animated GIF (.gif), MP4 video (.mp4, needs ffmpeg) or directory of PNG tiles")
+    parser.add_argument("--variable", help="Total AOD (default) or a species", choices=VARIABLES, default="aod")
+    parser.add_argument("--fraction", help="Map the contribution of the species to the total AOD (%%)",
+                        action="store_true")
+    parser.add_argument("--bbox", help="Map a bounding box instead of the whole grid", nargs=4, type=float,
+                        metavar=("LAT_MIN", "LAT_MAX", "LON_MIN", "LON_MAX"))
+    parser.add_argument("--vmax", help="Upper limit of the color scale, defaults to 1 (100 with --fraction)",
+                        type=float)
+    parser.add_argument("--cmap", help="Matplotlib colormap, defaults to YlOrBr", default="YlOrBr")
+    parser.add_argument("--coastlines", help="Natural Earth scale of the coastlines drawn with cartopy, defaults to "
+                                             "110m", choices=("110m", "50m", "10m", "none"), default="110m")
+    parser.add_argument("--dpi", help="Resolution of the frames, defaults to 100", type=int, default=100)
+    parser.add_argument("--fps", help="Frames per second of GIF and MP4 outputs, defaults to 4", type=float, default=4.)
+    parser.add_argument("--workers", help="Number of worker processes rendering frames, defaults to 1", type=int,
+                        default=1)
+    parser.add_argument("--catalog", help="SQLite catalog of the collection (see cams_catalog), refreshed on every run")
+    parser.add_argument("--start", help="Map products from this date (YYYY-MM-DD[THH:MM])",
+                        type=cams_catalog.parse_date)
+    parser.add_argument("--end", help="Map products up to this date (YYYY-MM-DD[THH:MM])",
+                        type=cams_catalog.parse_date)
+    parser.add_argument("--profile", help="Print stage timings, files opened, bytes read and peak memory at exit, as a "
+                                          "table (default) or JSON, 'log' also prints a JSON record per stage call",
+                        nargs="?", const="table", choices=cams_instrument.FORMATS)
+    args = parser.parse_args()
+
+    if args.fraction and args.variable == "aod":
+        parser.error("--fraction needs a species --variable")
+
+    if args.profile is not None:
+        cams_instrument.start(args.profile)
+
+    if args.bbox is not None:
+        cams_region.get_bbox_region("bbox", args.bbox)
+
+    render_map(args.directory, args.output, variable=args.variable, fraction=args.fraction, bbox=args.bbox,
+               vmax=args.vmax, cmap=args.cmap, coastlines=None if args.coastlines == "none" else args.coastlines,
+               dpi=args.dpi, fps=args.fps, workers=args.workers, catalog=args.catalog, start=args.start, end=args.end)
+
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,336 @@
+"""
+CAMS regional statistics
+
+Purpose : area statistics of the AOT fields over regions given as bounding boxes or polygons. For each region and time
+    step, the area-weighted mean, percentiles, maximum and grid cell of the maximum of every species are computed with
+    array reductions over the cells of the region. Region masks are computed once per grid, identified by its
+    cams_grid fingerprint, and reused for every product on the same grid. Only the window of the grid holding the cells
+    of the regions is read from the products.
+
+    Longitudes of bounding boxes and polygons may be given either in [0:360] or [-180:180]. Polygons must not cross the
+    antimeridian, bounding boxes may (eg. lon_min 170, lon_max -170).
+
+v0.0.1 : only the grid window covering the regions is read, instead of the global fields. Percentiles are weighted
+    by cell area like the means.
+
+v0.0.0 : initial release
+"""
+
+__author__ = "jerome.colin'at'cesbio.cnes.fr"
+__license__ = "MIT"
+__version__ = "0.0.1"
+
+import sys, json, hashlib
+import numpy as np
+import xarray as xr
+from matplotlib.path import Path
+import cams_grid
+import cams_catalog
+import cams_instrument
+
+PERCENTILES = (10, 50, 90)
+
+_mask_cache = {}
+
+
+def read_regions(filename):
+    """
+    Read a region list, either a JSON list of {"name", "bbox": [lat_min, lat_max, lon_min, lon_max]} or a GeoJSON
+    FeatureCollection of Polygon and MultiPolygon features named by their 'name' property
+    :param filename: JSON or GeoJSON file
+    :return: list of regions as dict
+    """
+    try:
+        with open(filename) as f:
+            records = json.load(f)
+    except FileNotFoundError as e:
+        print(e)
+        sys.exit(1)
+
+    if isinstance(records, dict) and records.get("type") == "FeatureCollection":
+        regions = [get_polygon_region(feature["properties"]["name"], feature["geometry"])
+                   for feature in records["features"]]
+    else:
+        regions = [get_bbox_region(r["name"], r["bbox"]) for r in records]
+
+    print("INFO: %i regions read from %s" % (len(regions), filename))
+
+    return regions
+
+
+def get_bbox_region(name, bbox):
+    """
+    Build a region from a bounding box
+    :param name: region name
+    :param bbox: (4) lat_min, lat_max, lon_min, lon_max in DD
+    :return: region as dict
+    """
+    lat_min, lat_max, lon_min, lon_max = [float(v) for v in bbox]
+    if lat_min > lat_max:
+        print("ERROR: lat_min greater than lat_max in bounding box of region %s" % name)
+        sys.exit(1)
+
+    return {"name": str(name).strip(), "bbox": (lat_min, lat_max, lon_min, lon_max)}
+
+
+def get_polygon_region(name, geometry):
+    """
+    Build a region from a GeoJSON geometry
+    :param name: region name
+    :param geometry: GeoJSON Polygon or MultiPolygon, vertices as [lon, lat]
+    :return: region as dict
+    """
+    if geometry["type"] == "Polygon":
+        polygons = [geometry["coordinates"]]
+    elif geometry["type"] == "MultiPolygon":
+        polygons = geometry["coordinates"]
+    else:
+        print("ERROR: unsupported geometry %s for region %s" % (geometry["type"], name))
+        sys.exit(1)
+
+    return {"name": str(name).strip(), "polygons": [[np.asarray(ring, dtype=np.float64)[:, :2] for ring in polygon]
+                                                    for polygon in polygons]}
+
+
+def region_key(region):
+    """
+    Return a key identifying the geometry of a region
+    :param region: region as dict
+    :return: key as an hexadecimal string
+    """
+    h = hashlib.sha1()
+    if "bbox" in region:
+        h.update(np.asarray(region["bbox"], dtype=np.float64).tobytes())
+    else:
+        for polygon in region["polygons"]:
+            for ring in polygon:
+                h.update(ring.tobytes())
+            h.update(b"|")
+
+    return h.hexdigest()[:16]
+
+
+def wrap_longitude(lon):
+    """
+    Convert longitudes to [-180:180]
+    :param lon: longitude(s) in DD
+    :return: longitude(s) in [-180:180]
+    """
+    return np.mod(np.asarray(lon, dtype=np.float64) + 180., 360.) - 180.
+
+
+def compute_mask(region, grid_lat, grid_lon):
+    """
+    Compute the mask of the grid cells whose center lies in a region
+    :param region: region as dict
+    :param grid_lat: 1D latitude vector of the grid
+    :param grid_lon: 1D longitude vector of the grid
+    :return: 2D boolean array (latitude, longitude)
+    """
+    lon2d, lat2d = np.meshgrid(wrap_longitude(grid_lon), np.asarray(grid_lat, dtype=np.float64))
+
+    if "bbox" in region:
+        lat_min, lat_max, lon_min, lon_max = region["bbox"]
+        lon_min, lon_max = wrap_longitude([lon_min, lon_max])
+        in_lat = (lat2d >= lat_min) & (lat2d <= lat_max)
+        if lon_min <= lon_max:
+            return in_lat & (lon2d >= lon_min) & (lon2d <= lon_max)
+        return in_lat & ((lon2d >= lon_min) | (lon2d <= lon_max))
+
+    points = np.column_stack([lon2d.ravel(), lat2d.ravel()])
+    mask = np.zeros(len(points), dtype=bool)
+    for polygon in region["polygons"]:
+        rings = [np.column_stack([wrap_longitude(ring[:, 0]), ring[:, 1]]) for ring in polygon]
+        inside = Path(rings[0]).contains_points(points)
+        for hole in rings[1:]:
+            inside &= ~Path(hole).contains_points(points)
+        mask |= inside
+
+    return mask.reshape(lat2d.shape)
+
+
+def get_masks(regions, grid_lat, grid_lon):
+    """
+    Return the flat indices of the grid cells of each region, reusing masks cached for this grid
+    :param regions: list of regions as dict
+    :param grid_lat: 1D latitude vector of the grid
+    :param grid_lon: 1D longitude vector of the grid
+    :return: list of 1D arrays of flat cell indices
+    """
+    fingerprint = cams_grid.grid_fingerprint(grid_lat, grid_lon)
+
+    cells = []
+    for region in regions:
+        key = (fingerprint, region_key(region))
+        if key not in _mask_cache:
+            _mask_cache[key] = np.flatnonzero(compute_mask(region, grid_lat, grid_lon))
+            if len(_mask_cache[key]) == 0:
+                print("WARNING: no grid cell center in region %s, its statistics will be NaN" % region["name"])
+        cells.append(_mask_cache[key])
+
+    return cells
+
+
+def get_window(masks, n_lon):
+    """
+    Return the smallest window of the grid holding the cells of all the regions, and the cells of each region in it.
+    Columns of a window crossing the antimeridian are not contiguous and are given as indices.
+    :param masks: list of 1D arrays of flat cell indices, see get_masks
+    :param n_lon: length of the longitude vector of the grid
+    :return: (3) latitude slice, longitude slice or 1D array of indices, list of 1D arrays of flat cell indices in the
+        window
+    """
+    cells = np.concatenate(masks)
+    if len(cells) == 0:
+        return slice(0, 0), slice(0, 0), masks
+
+    rows, columns = np.divmod(cells, n_lon)
+    lat_index = slice(int(rows.min()), int(rows.max()) + 1)
+    columns = np.unique(columns)
+    if columns[-1] - columns[0] + 1 == len(columns):
+        lon_index = slice(int(columns[0]), int(columns[-1]) + 1)
+    else:
+        lon_index = columns
+
+    window_cells = []
+    for mask in masks:
+        rows, cols = np.divmod(mask, n_lon)
+        window_cells.append((rows - lat_index.start) * len(columns) + np.searchsorted(columns, cols))
+
+    return lat_index, lon_index, window_cells
+
+
+def weighted_percentiles(values, weights, percentiles=PERCENTILES):
+    """
+    Compute percentiles along the last axis, each value counting for its weight and NaN values being ignored. Values
+    are sorted and percentiles interpolated between the midpoints of their cumulated weights, which gives the 'hazen'
+    method of np.percentile for equal weights.
+    :param values: 3D array (variable, time, cell)
+    :param weights: 1D array of cell weights
+    :param percentiles: sequence of percentiles in [0:100]
+    :return: 3D array (percentile, variable, time), NaN where all values are NaN
+    """
+    order = np.argsort(values, axis=-1)
+    sorted_values = np.take_along_axis(values, order, axis=-1)
+    valid = ~np.isnan(sorted_values)
+    w = np.where(valid, weights[order], 0.)
+    n_valid = valid.sum(axis=-1)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        position = (np.cumsum(w, axis=-1) - w / 2.) / w.sum(axis=-1, keepdims=True)
+    # NaN values are sorted last and never selected
+    position = np.where(valid, position, np.inf)
+
+    q = np.empty((len(percentiles),) + values.shape[:-1])
+    for k, p in enumerate(percentiles):
+        target = p / 100.
+        upper = np.clip((position < target).sum(axis=-1), 0, np.maximum(n_valid - 1, 0))[..., None]
+        lower = np.maximum(upper - 1, 0)
+        p0, p1 = np.take_along_axis(position, lower, axis=-1), np.take_along_axis(position, upper, axis=-1)
+        v0, v1 = np.take_along_axis(sorted_values, lower, axis=-1), np.take_along_axis(sorted_values, upper, axis=-1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            fraction = np.clip(np.where(p1 > p0, (target - p0) / (p1 - p0), 0.), 0., 1.)
+        q[k] = np.where(n_valid > 0, (v0 + fraction * (v1 - v0))[..., 0], np.nan)
+
+    return q
+
+
+def reduce_region(values, weights, percentiles=PERCENTILES):
+    """
+    Compute the statistics of the cells of a region for every variable and time step
+    :param values: 3D array (variable, time, cell)
+    :param weights: 1D array of cell area weights
+    :param percentiles: sequence of percentiles in [0:100]
+    :return: (4) mean, percentiles (percentile, variable, time), max, index of the max along the cell axis (-1 if
+        all values are NaN)
+    """
+    n_vars, n_times, n_cells = values.shape
+
+    if n_cells == 0:
+        nan = np.full((n_vars, n_times), np.nan)
+        return nan, np.full((len(percentiles), n_vars, n_times), np.nan), nan, np.full((n_vars, n_times), -1)
+
+    valid = ~np.isnan(values)
+    w = np.where(valid, weights, 0.)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.nansum(values * w, axis=-1) / w.sum(axis=-1)
+
+    filled = np.where(valid, values, -np.inf)
+    argmax = filled.argmax(axis=-1)
+    vmax = np.take_along_axis(filled, argmax[..., None], axis=-1)[..., 0]
+    all_nan = ~valid.any(axis=-1)
+    vmax = np.where(all_nan, np.nan, vmax)
+    argmax = np.where(all_nan, -1, argmax)
+
+    return mean, weighted_percentiles(values, weights, percentiles=percentiles), vmax, argmax
+
+
+def get_statistics(ds, regions, percentiles=PERCENTILES):
+    """
+    Compute the statistics of every AOT variable over each region. Means and percentiles are weighted by the cosine of
+    the latitude of the cells, which is proportional to their area on a regular latitude/longitude grid. Only the
+    window of the grid holding the cells of the regions is read.
+    :param ds: xarray AOT dataset with time, latitude and longitude dimensions
+    :param regions: list of regions as dict
+    :param percentiles: sequence of percentiles in [0:100]
+    :return: a dataset with 'time' and 'region' dimensions
+    """
+    grid_lat = ds['latitude'].values
+    grid_lon = ds['longitude'].values
+    names = [name for name, var in ds.data_vars.items() if var.dims[-2:] == ('latitude', 'longitude')]
+
+    masks = get_masks(regions, grid_lat, grid_lon)
+    lat_index, lon_index, window_cells = get_window(masks, len(grid_lon))
+
+    window = {'latitude': lat_index, 'longitude': lon_index}
+    values = np.stack([ds[name].isel(window).transpose('time', 'latitude', 'longitude').values
+                       .reshape(ds.sizes['time'], -1) for name in names])
+    weights = np.repeat(np.cos(np.deg2rad(np.asarray(grid_lat[lat_index], dtype=np.float64))),
+                        len(grid_lon[lon_index]))
+
+    stats = [reduce_region(values[:, :, cells], weights[cells], percentiles=percentiles) for cells in window_cells]
+
+    # Stack regions on the last axis, cells of the maximum being given in the full grid
+    mean = np.stack([s[0] for s in stats], axis=-1)
+    q = np.stack([s[1] for s in stats], axis=-1)
+    vmax = np.stack([s[2] for s in stats], axis=-1)
+    cell = np.stack([np.where(s[3] < 0, -1, cells[np.maximum(s[3], 0)]) if len(cells) > 0 else s[3]
+                     for s, cells in zip(stats, masks)], axis=-1)
+    cell_lat, cell_lon = np.divmod(cell, len(grid_lon))
+    cell_lat = np.where(cell < 0, -1, cell_lat)
+    cell_lon = np.where(cell < 0, -1, cell_lon)
+
+    dims = ('time', 'region')
+    data_vars = {}
+    for i, name in enumerate(names):
+        dtype = ds[name].dtype
+        long_name = ds[name].attrs.get('long_name', name)
+        data_vars["%s_mean" % name] = (dims, mean[i].astype(dtype), {'long_name': "%s, area-weighted mean" % long_name})
+        for k, p in enumerate(percentiles):
+            data_vars["%s_p%g" % (name, p)] = (dims, q[k, i].astype(dtype),
+                                               {'long_name': "%s, area-weighted percentile %g" % (long_name, p)})
+        data_vars["%s_max" % name] = (dims, vmax[i].astype(dtype), {'long_name': "%s, maximum" % long_name})
+        data_vars["%s_max_lat_idx" % name] = (dims, cell_lat[i].astype(np.int32),
+                                              {'long_name': "%s, latitude index of the maximum" % long_name})
+        data_vars["%s_max_lon_idx" % name] = (dims, cell_lon[i].astype(np.int32),
+                                              {'long_name': "%s, longitude index of the maximum" % long_name})
+
+    return xr.Dataset(data_vars, coords={'time': ds['time'].values})
+
+
+def read_product(filename, regions, percentiles=PERCENTILES):
+    """
+    Open an AOT product, compute the statistics of each region and close the product
+    :param filename: AOT netCDF file
+    :param regions: list of regions as dict
+    :param percentiles: sequence of percentiles in [0:100]
+    :return: (2) timestamp, dataset with a 'region' dimension
+    """
+    with cams_instrument.stage("open"):
+        ds_one_product = xr.open_dataset(filename)
+        cams_instrument.opened(filename)
+
+    with ds_one_product, cams_instrument.stage("reduce"):
+        ds_one_product_regions = get_statistics(ds_one_product, regions, percentiles=percentiles)
+
+    return cams_catalog.get_timestamp(filename), ds_one_product_regions
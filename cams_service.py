@@ -0,0 +1,540 @@
+#! /usr/bin/env python
+
+"""
+CAMS query service
+
+Purpose : long-running local HTTP service answering site queries on a CAMS collection, without the interpreter startup,
+    imports and collection listing paid by running cams_visu or cams_extract_aod for each query. The collection index
+    is built once (or refreshed with /reload), the grid indices of the most recently queried locations are kept in
+    memory and synthesis figures are reused from one plot to the next.
+
+    Endpoints (GET, lat/lon in DD, time as ISO date, the product closest in time is used):
+        /aod?lat=&lon=&time=[&interp=]               total AOD and species breakdown at 550nm (JSON)
+        /profile?lat=&lon=&time=[&interp=]           MR profiles on pressure levels and RH profile (JSON)
+        /plot?lat=&lon=&time=[&interp=][&site=]      cams_visu synthesis plot (PNG)
+        /products                                    collection summary (JSON)
+        /reload                                      list the collection again (JSON)
+
+    Requests hitting the same product within --batch-delay seconds are answered from a single read of the product,
+    whatever their endpoint. Products are read in a single background thread, the event loop keeps accepting requests
+    meanwhile.
+
+v0.0.2 : queries on the same product are batched whatever their endpoint, the products are opened and their grid read
+    once per batch, then each query is answered by its endpoint. Interpolation methods are those of cams_grid.
+
+v0.0.1 : grid indices of queried locations are kept in a bounded LRU cache instead of the cams_grid memory and disk
+    caches, which grew (and rewrote their JSON file) with every new location. A reader exiting no longer stops the
+    service, the request is answered with a 500. start() returns the listening server and its state.
+
+v0.0.0 : initial release
+"""
+
+__author__ = "jerome.colin'at'cesbio.cnes.fr"
+__license__ = "MIT"
+__version__ = "0.0.2"
+
+import argparse, sys, io, json, asyncio, bisect, contextlib
+import functools
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from urllib.parse import urlsplit, parse_qs
+import netCDF4 as nc
+import numpy as np
+import matplotlib.pyplot as pl
+import cams_grid
+import cams_catalog
+import cams_visu
+import cams_instrument
+
+STATUS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+          500: "Internal Server Error"}
+
+# Number of locations whose grid indices are kept, least recently queried ones are dropped first
+LOCATION_CACHE_SIZE = 4096
+
+# Latitude and longitude vectors of the grids met so far, by cams_grid fingerprint
+_grids = {}
+
+ENDPOINTS = ("/aod", "/profile", "/plot")
+
+
+def list_collection(path, catalog=None):
+    """
+    List the products of a collection, from a catalog refreshed incrementally or by walking path
+    :param path: path to a CAMS collection
+    :param catalog: optional SQLite catalog of the collection
+    :return: (2) sorted list of timestamps, list of (MR, AOT, RH) filenames in the same order
+    """
+    with cams_instrument.stage("list"):
+        if catalog is not None:
+            collection = [(c['MR'], c['AOT'], c['RH']) for c in cams_catalog.get_collection(catalog, path)]
+        else:
+            collection = [cams_visu.get_products(p) for p in cams_visu.get_collection(path)]
+
+    collection.sort(key=lambda products: cams_catalog.get_timestamp(products[1]))
+    times = [cams_catalog.get_timestamp(products[1]) for products in collection]
+    print("INFO: %i products listed in %s" % (len(collection), path))
+
+    return times, collection
+
+
+def find_product(state, ts, max_gap):
+    """
+    Return the product closest in time to a timestamp
+    :param state: service state
+    :param ts: timestamp as datetime, None for the latest product
+    :param max_gap: largest accepted time difference as timedelta
+    :return: (MR, AOT, RH) filenames, None if no product is close enough
+    """
+    times, collection = state["times"], state["collection"]
+    if len(times) == 0:
+        return None
+    if ts is None:
+        return collection[-1]
+
+    i = bisect.bisect_left(times, ts)
+    candidates = [k for k in (i - 1, i) if 0 <= k < len(times)]
+    k = min(candidates, key=lambda k: abs(times[k] - ts))
+
+    return collection[k] if abs(times[k] - ts) <= max_gap else None
+
+
+def parse_query(query):
+    """
+    Parse the parameters of a site query
+    :param query: query string of the URL
+    :return: a dict of lat, lon, time (datetime or None), interp and site
+    """
+    params = {k: v[-1] for k, v in parse_qs(query).items()}
+
+    try:
+        lat, lon = float(params["lat"]), float(params["lon"])
+    except KeyError:
+        raise ValueError("lat and lon are required")
+    except ValueError:
+        raise ValueError("lat and lon must be decimal degrees")
+    if not -90. <= lat <= 90.:
+        raise ValueError("lat must be in [-90:90]")
+
+    try:
+        ts = cams_catalog.parse_date(params["time"]) if "time" in params else None
+    except argparse.ArgumentTypeError as e:
+        raise ValueError(str(e))
+
+    interp = params.get("interp", "nearest")
+    if interp not in cams_grid.INTERPOLATIONS:
+        raise ValueError("interp must be one of %s" % ", ".join(cams_grid.INTERPOLATIONS))
+
+    return {"lat": lat, "lon": lon, "time": ts, "interp": interp, "site": params.get("site")}
+
+
+def read_grid(dataset):
+    """
+    Read the grid of a product and register it for locate
+    :param dataset: a netCDF dataset with latitude and longitude variables
+    :return: (2) cams_grid fingerprint of the grid, dict of its 'latitude' and 'longitude' vectors
+    """
+    grid = {'latitude': dataset['latitude'][:], 'longitude': dataset['longitude'][:]}
+    fingerprint = cams_grid.grid_fingerprint(grid['latitude'], grid['longitude'])
+    if fingerprint not in _grids:
+        _grids[fingerprint] = (np.asarray(grid['latitude']), np.asarray(grid['longitude']))
+
+    return fingerprint, grid
+
+
+@functools.lru_cache(maxsize=LOCATION_CACHE_SIZE)
+def locate(grid, lat, lon, interp="nearest"):
+    """
+    Compute the grid indices of a location and their weights. Queries come with arbitrary locations, results are
+    kept in a bounded memory cache rather than in the cams_grid caches, which are meant for site lists and never evict.
+    :param grid: cams_grid fingerprint of a grid in _grids
+    :param lat: latitude in DD
+    :param lon: longitude in DD
+    :param interp: 'nearest' grid point or 'bilinear' interpolation
+    :return: (4) latitude index or (2) corner indices, longitude index or (2) corner indices, None or (2, 2) weights,
+        (2) latitude and longitude of the values
+    """
+    grid_lat, grid_lon = _grids[grid]
+    grid_lon_value = cams_grid.normalize_longitude([lon], grid_lon)
+
+    if interp == "bilinear":
+        lat0, lat1, wy = cams_grid.bracket_indices([lat], grid_lat)
+        lon0, lon1, wx = cams_grid.bracket_indices(grid_lon_value, grid_lon, period=360.)
+        weights = np.outer([1. - wy[0], wy[0]], [1. - wx[0], wx[0]])
+        weights.flags.writeable = False
+        return (int(lat0[0]), int(lat1[0])), (int(lon0[0]), int(lon1[0])), weights, (lat, lon)
+
+    lat_idx = int(cams_grid.nearest_indices([lat], grid_lat)[0])
+    lon_idx = int(cams_grid.nearest_indices(grid_lon_value, grid_lon, period=360.)[0])
+
+    return lat_idx, lon_idx, None, (float(grid_lat[lat_idx]), float(grid_lon[lon_idx]))
+
+
+def read_aod(aot_dataset, fingerprint, file_aot, query):
+    """
+    Read the AOD breakdown at the location of a query
+    :param aot_dataset: netCDF dataset of AOT
+    :param fingerprint: fingerprint of the grid of the product, see read_grid
+    :param file_aot: AOT filename
+    :param query: query returned by parse_query
+    :return: JSON-serializable dict
+    """
+    lat_idx, lon_idx, weights, location = locate(fingerprint, query["lat"], query["lon"], query["interp"])
+    aot_norm, aot, aot_var_names, aot_var_longnames = cams_visu.get_aot(aot_dataset, lat_idx, lon_idx, weights=weights)
+
+    return {
+        "product_time": cams_catalog.get_timestamp(file_aot).isoformat(),
+        "lat": query["lat"], "lon": query["lon"], "interp": query["interp"],
+        "grid_lat": float(location[0]), "grid_lon": float(location[1]),
+        "aod": float(aot),
+        "species": [{"name": name, "long_name": long_name.strip(), "aod": float(ratio) * float(aot) / 100.,
+                     "ratio": float(ratio)}
+                    for name, long_name, ratio in zip(aot_var_names[3:], aot_var_longnames[3:], aot_norm)],
+    }
+
+
+def read_synthesis(datasets, fingerprint, grid, file_mixing_ratio, query):
+    """
+    Read the profiles and AOD at the location of a query with cams_visu
+    :param datasets: (3) netCDF datasets of MR, AOT and RH
+    :param fingerprint: fingerprint of the grid of the products, see read_grid
+    :param grid: dict of the 'latitude' and 'longitude' vectors of the products, see read_grid
+    :param file_mixing_ratio: MR filename
+    :param query: query returned by parse_query
+    :return: synthesis dict, see cams_visu.read_columns
+    """
+    mr_dataset, aot_dataset, rh_dataset = datasets
+    lat_idx, lon_idx = locate(fingerprint, query["lat"], query["lon"])[:2]
+    corners_lat, corners_lon, weights = None, None, None
+    if query["interp"] == "bilinear":
+        corners_lat, corners_lon, weights = locate(fingerprint, query["lat"], query["lon"], "bilinear")[:3]
+
+    return cams_visu.read_columns(mr_dataset, rh_dataset, aot_dataset, query["lat"], query["lon"],
+                                  cams_visu.get_timestamp(file_mixing_ratio)[1], lat_idx, lon_idx,
+                                  corners_lat=corners_lat, corners_lon=corners_lon, weights=weights,
+                                  site_name=query["site"], grid=grid)
+
+
+def get_profile(products, synthesis):
+    """
+    Convert a synthesis to the JSON response of /profile
+    :param products: (MR, AOT, RH) filenames
+    :param synthesis: dict returned by cams_visu.read_columns
+    :return: JSON-serializable dict
+    """
+    return {
+        "product_time": cams_catalog.get_timestamp(products[1]).isoformat(),
+        "grid_lat": synthesis["grid_lat"], "grid_lon": synthesis["grid_lon"],
+        "mr_pressure": [float(p) for p in synthesis["mr_ps_levels"]],
+        "mr": {name: [float(v) for v in profile] for name, profile in zip(synthesis["mr_names"],
+                                                                           synthesis["mr_cube"])},
+        "rh_pressure": [float(p) for p in synthesis["rh_ps_levels"]],
+        "rh": [float(v) for v in synthesis["rh_profile"]],
+    }
+
+
+def render_plot(synthesis, max_mr=2e-8):
+    """
+    Render the synthesis plot of a query, reusing the cams_visu figures of previous plots
+    :param synthesis: dict returned by cams_visu.read_columns
+    :param max_mr: upper limit of the mixing ratio axis
+    :return: PNG content as bytes
+    """
+    with cams_instrument.stage("plot"):
+        figure = cams_visu.get_synthesis_figure(synthesis, max_mr=max_mr)
+        cams_visu.update_synthesis_figure(figure, synthesis["title"], synthesis["mr_cube"], synthesis["mr_ps_levels"],
+                                          synthesis["rh_profile"], synthesis["rh_ps_levels"], synthesis["aot_norm"])
+    png = io.BytesIO()
+    with cams_instrument.stage("savefig"):
+        figure["fig"].savefig(png, format="png")
+
+    return png.getvalue()
+
+
+def read_batch(products, requests, max_mr=2e-8):
+    """
+    Answer a batch of queries on a product whatever their endpoint. The products are opened and their grid read once,
+    the values of every query are read, then each query is answered by its endpoint.
+    :param products: (MR, AOT, RH) filenames
+    :param requests: list of (endpoint, query), query as returned by parse_query
+    :param max_mr: upper limit of the mixing ratio axis of plots
+    :return: list of JSON-serializable dicts or PNG contents as bytes, or exceptions, in the order of requests
+    """
+    file_mixing_ratio, file_aot, file_relative_humidity = products
+    # MR and RH products are only read for profiles and plots
+    needed = products if any(endpoint != "/aod" for endpoint, query in requests) else (file_aot,)
+
+    values = []
+    with contextlib.ExitStack() as stack:
+        with cams_instrument.stage("open"):
+            datasets = {}
+            for filename in needed:
+                datasets[filename] = stack.enter_context(nc.Dataset(filename))
+                cams_instrument.opened(filename)
+
+        with cams_instrument.stage("read"):
+            fingerprint, grid = read_grid(datasets[file_aot])
+            for endpoint, query in requests:
+                try:
+                    if endpoint == "/aod":
+                        values.append(read_aod(datasets[file_aot], fingerprint, file_aot, query))
+                    else:
+                        values.append(read_synthesis([datasets[filename] for filename in products], fingerprint,
+                                                     grid, file_mixing_ratio, query))
+                except Exception as e:
+                    values.append(e)
+
+    results = []
+    for (endpoint, query), value in zip(requests, values):
+        try:
+            if isinstance(value, Exception) or endpoint == "/aod":
+                results.append(value)
+            elif endpoint == "/profile":
+                results.append(get_profile(products, value))
+            else:
+                results.append(render_plot(value, max_mr=max_mr))
+        except Exception as e:
+            results.append(e)
+
+    return results
+
+
+async def run_batch(state, products):
+    """
+    Wait for the batch delay, then read a product once for all the queries collected meanwhile
+    :param state: service state
+    :param products: (MR, AOT, RH) filenames of the batch
+    :return: None
+    """
+    await asyncio.sleep(state["batch_delay"])
+    batch = state["pending"].pop(products)
+
+    try:
+        results = await asyncio.get_running_loop().run_in_executor(state["executor"], state["reader"], products,
+                                                                   [(endpoint, query)
+                                                                    for endpoint, query, future in batch])
+    except Exception as e:
+        results = [e] * len(batch)
+    except SystemExit as e:
+        # Some helpers of the CLIs exit on bad input, the service must keep running
+        results = [RuntimeError("reader exited with status %s" % e.code)] * len(batch)
+
+    counts = Counter(endpoint for endpoint, query, future in batch)
+    print("INFO: %s read once for %i request(s) (%s)" % (products[1], len(batch), ", ".join(
+        "%i %s" % (count, endpoint) for endpoint, count in counts.items())))
+
+    for (endpoint, query, future), result in zip(batch, results):
+        if future.done():
+            continue
+        if isinstance(result, Exception):
+            future.set_exception(result)
+        else:
+            future.set_result(result)
+
+
+async def submit(state, endpoint, products, query):
+    """
+    Queue a query on a product, batched with the other queries on the same product whatever their endpoint
+    :param state: service state
+    :param endpoint: one of ENDPOINTS
+    :param products: (MR, AOT, RH) filenames
+    :param query: query returned by parse_query
+    :return: answer of the endpoint to this query, see read_batch
+    """
+    future = asyncio.get_running_loop().create_future()
+
+    if products not in state["pending"]:
+        state["pending"][products] = []
+        task = asyncio.create_task(run_batch(state, products))
+        state["tasks"].add(task)
+        task.add_done_callback(state["tasks"].discard)
+    state["pending"][products].append((endpoint, query, future))
+
+    return await future
+
+
+async def respond(state, method, target):
+    """
+    Answer a request
+    :param state: service state
+    :param method: HTTP method
+    :param target: request target, path and query string
+    :return: (3) status code, content type, body as bytes
+    """
+    url = urlsplit(target)
+
+    if method != "GET":
+        return 405, "application/json", json.dumps({"error": "only GET is supported"}).encode()
+
+    if url.path == "/products":
+        times = state["times"]
+        return 200, "application/json", json.dumps({
+            "products": len(times),
+            "first": times[0].isoformat() if times else None,
+            "last": times[-1].isoformat() if times else None,
+        }).encode()
+
+    if url.path == "/reload":
+        state["times"], state["collection"] = await asyncio.get_running_loop().run_in_executor(
+            state["executor"], list_collection, state["path"], state["catalog"])
+        return 200, "application/json", json.dumps({"products": len(state["times"])}).encode()
+
+    if url.path not in ENDPOINTS:
+        return 404, "application/json", json.dumps({"error": "unknown endpoint %s" % url.path}).encode()
+
+    try:
+        query = parse_query(url.query)
+    except ValueError as e:
+        return 400, "application/json", json.dumps({"error": str(e)}).encode()
+
+    products = find_product(state, query["time"], state["max_gap"])
+    if products is None:
+        return 404, "application/json", json.dumps({"error": "no product within %s of %s" % (
+            state["max_gap"], query["time"])}).encode()
+
+    try:
+        result = await submit(state, url.path, products, query)
+    except Exception as e:
+        print("ERROR: %s failed on %s (%s: %s)" % (target, products[1], type(e).__name__, e))
+        return 500, "application/json", json.dumps({"error": "%s: %s" % (type(e).__name__, e)}).encode()
+
+    if url.path == "/plot":
+        return 200, "image/png", result
+
+    return 200, "application/json", json.dumps(result).encode()
+
+
+async def handle(state, reader, writer):
+    """
+    Handle an HTTP/1.1 connection, answering a single GET request
+    :param state: service state
+    :param reader: asyncio stream reader
+    :param writer: asyncio stream writer
+    :return: None
+    """
+    try:
+        request_line = (await reader.readline()).decode("latin-1").split()
+        # Headers are read and ignored, requests have no body
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+
+        if len(request_line) < 2:
+            status, content_type, body = 400, "application/json", json.dumps({"error": "bad request"}).encode()
+        else:
+            status, content_type, body = await respond(state, request_line[0], request_line[1])
+
+        writer.write(("HTTP/1.1 %i %s\r\nContent-Type: %s\r\nContent-Length: %i\r\nConnection: close\r\n\r\n" % (
+            status, STATUS[status], content_type, len(body))).encode("latin-1") + body)
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def start(path, host="127.0.0.1", port=8080, catalog=None, max_gap=timedelta(hours=12), batch_delay=0.02,
+                max_mr=2e-8):
+    """
+    List the collection and start listening, the server is then run with serve_forever
+    :param path: path to a CAMS collection
+    :param host: address to listen on, localhost by default
+    :param port: port to listen on, 0 for any free port
+    :param catalog: optional SQLite catalog of the collection, refreshed incrementally on startup and /reload
+    :param max_gap: largest accepted time difference between a query and a product, as timedelta
+    :param batch_delay: seconds during which queries on the same product are collected into one read
+    :param max_mr: upper limit of the mixing ratio axis of plots
+    :return: (2) asyncio server, service state
+    """
+    pl.switch_backend("Agg")
+    times, collection = list_collection(path, catalog=catalog)
+
+    # netCDF and matplotlib are not thread-safe, products are read and plots rendered in a single thread
+    state = {"path": path, "catalog": catalog, "times": times, "collection": collection, "max_gap": max_gap,
+             "batch_delay": batch_delay, "executor": ThreadPoolExecutor(max_workers=1), "pending": {},
+             "tasks": set(), "reader": functools.partial(read_batch, max_mr=max_mr)}
+
+    server = await asyncio.start_server(lambda reader, writer: handle(state, reader, writer), host, port)
+    for sock in server.sockets:
+        print("INFO: serving %s on http://%s:%i" % (path, *sock.getsockname()[:2]))
+    sys.stdout.flush()
+
+    return server, state
+
+
+async def serve(path, host="127.0.0.1", port=8080, catalog=None, max_gap=timedelta(hours=12), batch_delay=0.02,
+                max_mr=2e-8):
+    """
+    Run the service until interrupted
+    :param path: path to a CAMS collection
+    :param host: address to listen on, localhost by default
+    :param port: port to listen on, 0 for any free port
+    :param catalog: optional SQLite catalog of the collection, refreshed incrementally on startup and /reload
+    :param max_gap: largest accepted time difference between a query and a product, as timedelta
+    :param batch_delay: seconds during which queries on the same product are collected into one read
+    :param max_mr: upper limit of the mixing ratio axis of plots
+    :return: None
+    """
+    server, state = await start(path, host=host, port=port, catalog=catalog, max_gap=max_gap,
+                                batch_delay=batch_delay, max_mr=max_mr)
+
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        stop(state)
+
+
+def stop(state):
+    """
+    Release the reading thread and the figures of a service
+    :param state: service state returned by start
+    :return: None
+    """
+    state["executor"].shutdown(wait=False)
+    cams_visu.close_synthesis_figures()
+
+
+def main():
+    """
+    Serve site AOD, profile and plot queries on a CAMS collection over HTTP
+
+    Usage example :
+    ./cams_service.py /path/to/cams --port 8080
+    curl "http://127.0.0.1:8080/aod?lat=50.5&lon=3.2&time=2021-03-01T12:00"
+
+    :return: None, runs until interrupted
+    """
+    # Argument parser
+    parser = argparse.ArgumentParser()
+    parser.add_argument("directory", help="Path to a CAMS collection")
+    parser.add_argument("--host", help="Address to listen on, defaults to 127.0.0.1", default="127.0.0.1")
+    parser.add_argument("--port", help="Port to listen on, defaults to 8080 (0 for any free port)", type=int,
+                        default=8080)
+    parser.add_argument("--catalog", help="SQLite catalog of the collection (see cams_catalog), refreshed on startup "
+                                          "and /reload")
+    parser.add_argument("--max-gap", help="Largest time difference in hours between a query and a product, defaults "
+                                          "to 12", type=float, default=12.)
+    parser.add_argument("--batch-delay", help="Milliseconds during which queries on the same product are collected "
+                                              "into one read, defaults to 20", type=float, default=20.)
+    parser.add_argument("--maxmr", help="Maximum MR value of plots, defaults to 2E-8", type=float, default=2e-8)
+    parser.add_argument("--profile", help="Print stage timings, files opened, bytes read and peak memory at exit, as a "
+                                          "table (default) or JSON, 'log' also prints a JSON record per stage call",
+                        nargs="?", const="table", choices=cams_instrument.FORMATS)
+    args = parser.parse_args()
+
+    if args.profile is not None:
+        cams_instrument.start(args.profile)
+
+    try:
+        asyncio.run(serve(args.directory, host=args.host, port=args.port, catalog=args.catalog,
+                          max_gap=timedelta(hours=args.max_gap), batch_delay=args.batch_delay / 1000.,
+                          max_mr=args.maxmr))
+    except KeyboardInterrupt:
+        print("INFO: interrupted")
+
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,264 @@
+#! /usr/bin/env python
+
+"""
+Synthetic CAMS collection generator
+
+Purpose : write a collection of synthetic CAMS products, laid out as StartMaja EarthExplorer '.DIR' directories each
+    holding an AOT, a MR and a RH netCDF file, with the variables, dimensions and filenames expected by the tools.
+    Products dated before the shift to 7 aerosol species have 5 AOT species, 11 MR species and 69 levels, later ones
+    7 AOT species, 14 MR species and 137 levels. Fields are smooth deterministic patterns plus seeded noise, so that a
+    collection can be regenerated identically offline, eg. for benchmarks (see cams_bench).
+
+v0.0.1 : the date of the shift to 7 species and the AOT species are those of cams_extract_aod and cams_aod_timeline
+
+v0.0.0 : initial release
+"""
+
+__author__ = "jerome.colin'at'cesbio.cnes.fr"
+__license__ = "MIT"
+__version__ = "0.0.1"
+
+import argparse, sys, os
+import netCDF4 as nc
+import numpy as np
+from datetime import timedelta
+import cams_catalog
+import cams_levels
+import cams_extract_aod
+import cams_aod_timeline
+
+TS_SEVEN_SPECIES = cams_extract_aod.TS_SEVEN_SPECIES
+
+AOT_SPECIES = cams_aod_timeline.SPECIES
+AOT_LONGNAMES = ["Dust Aerosol Optical Depth at 550nm", "Organic Matter Aerosol Optical Depth at 550nm",
+                 "Black Carbon Aerosol Optical Depth at 550nm", "Sulphate Aerosol Optical Depth at 550nm",
+                 "Sea Salt Aerosol Optical Depth at 550nm", "Nitrate Aerosol Optical Depth at 550nm",
+                 "Ammonium Aerosol Optical Depth at 550nm"]
+AOT_SCALES = [0.08, 0.05, 0.01, 0.06, 0.04, 0.02, 0.02]
+
+# Long names of cams_levels.MR_SPECIES
+MR_LONGNAMES = ["Sea Salt Aerosol (0.03 - 0.5 um) Mixing Ratio", "Sea Salt Aerosol (0.5 - 5 um) Mixing Ratio",
+                "Sea Salt Aerosol (5 - 20 um) Mixing Ratio", "Dust Aerosol (0.03 - 0.55 um) Mixing Ratio",
+                "Dust Aerosol (0.55 - 0.9 um) Mixing Ratio", "Dust Aerosol (0.9 - 20 um) Mixing Ratio",
+                "Hydrophilic Organic Matter Aerosol Mixing Ratio", "Hydrophobic Organic Matter Aerosol Mixing Ratio",
+                "Hydrophilic Black Carbon Aerosol Mixing Ratio", "Hydrophobic Black Carbon Aerosol Mixing Ratio",
+                "Sulphate Aerosol Mixing Ratio", "Nitrate fine mode aerosol mass mixing ratio",
+                "Nitrate coarse mode aerosol mass mixing ratio", "Ammonium aerosol mass mixing ratio"]
+
+RH_LEVELS = [1, 50, 100, 200, 300, 400, 500, 600, 700, 850, 925, 1000]
+
+TIME_UNITS = "hours since 1900-01-01 00:00:00.0"
+
+
+def get_grid(resolution):
+    """
+    Return the latitude and longitude vectors of a global regular grid, latitudes descending and longitudes in [0:360]
+    as in CAMS products
+    :param resolution: grid step in degrees
+    :return: (2) latitudes, longitudes
+    """
+    lat = np.linspace(90., -90., int(round(180. / resolution)) + 1)
+    lon = np.arange(int(round(360. / resolution))) * resolution
+
+    return lat, lon
+
+
+def get_pattern(lat, lon, ts, phase, rng, noise=0.1):
+    """
+    Return a smooth positive field in [0:1] moving with time, plus seeded noise
+    :param lat: latitude vector
+    :param lon: longitude vector
+    :param ts: timestamp as datetime
+    :param phase: phase of the pattern in degrees
+    :param rng: numpy random generator
+    :param noise: noise amplitude
+    :return: 2D array (latitude, longitude)
+    """
+    hours = (ts - TS_SEVEN_SPECIES).total_seconds() / 3600.
+    lat2d, lon2d = np.meshgrid(np.deg2rad(lat), np.deg2rad(lon + phase + hours * 2.), indexing="ij")
+    field = 0.5 + 0.4 * np.cos(2. * lat2d + np.deg2rad(phase)) * np.sin(lon2d)
+
+    return np.clip(field + noise * rng.standard_normal(field.shape), 0., 1.)
+
+
+def create_product(filename, ts, lat, lon, levels=None):
+    """
+    Create a netCDF product with time, level, latitude and longitude coordinates. Coordinates are created first, as
+    cams_visu expects the data variables to follow them.
+    :param filename: netCDF filename
+    :param ts: timestamp as datetime
+    :param lat: latitude vector
+    :param lon: longitude vector
+    :param levels: level values, None for a product without level
+    :return: an open netCDF dataset
+    """
+    dataset = nc.Dataset(filename, "w")
+
+    dataset.createDimension("time", 1)
+    if levels is not None:
+        dataset.createDimension("level", len(levels))
+    dataset.createDimension("latitude", len(lat))
+    dataset.createDimension("longitude", len(lon))
+
+    var = dataset.createVariable("time", "i4", ("time",))
+    var.units = TIME_UNITS
+    var.calendar = "gregorian"
+    var.long_name = "time"
+    var[:] = nc.date2num(ts, TIME_UNITS, "gregorian")
+
+    if levels is not None:
+        var = dataset.createVariable("level", "i4", ("level",))
+        var.long_name = "model_level_number" if len(levels) != len(RH_LEVELS) else "pressure_level"
+        var[:] = levels
+
+    var = dataset.createVariable("latitude", "f4", ("latitude",))
+    var.units = "degrees_north"
+    var.long_name = "latitude"
+    var[:] = lat
+
+    var = dataset.createVariable("longitude", "f4", ("longitude",))
+    var.units = "degrees_east"
+    var.long_name = "longitude"
+    var[:] = lon
+
+    return dataset
+
+
+def write_aot(filename, ts, lat, lon, n_species, rng):
+    """
+    Write a synthetic AOT product
+    :param filename: netCDF filename
+    :param ts: timestamp as datetime
+    :param lat: latitude vector
+    :param lon: longitude vector
+    :param n_species: 5 or 7
+    :param rng: numpy random generator
+    :return: None
+    """
+    with create_product(filename, ts, lat, lon) as dataset:
+        for i in range(n_species):
+            var = dataset.createVariable(AOT_SPECIES[i], "f4", ("time", "latitude", "longitude"))
+            var.units = "~"
+            var.long_name = AOT_LONGNAMES[i]
+            var[0, :, :] = AOT_SCALES[i] * (0.1 + 2. * get_pattern(lat, lon, ts, 40. * i, rng))
+
+
+def write_mr(filename, ts, lat, lon, n_species, n_levels, rng):
+    """
+    Write a synthetic MR product, mixing ratios decreasing with altitude
+    :param filename: netCDF filename
+    :param ts: timestamp as datetime
+    :param lat: latitude vector
+    :param lon: longitude vector
+    :param n_species: 11 or 14
+    :param n_levels: 69 or 137
+    :param rng: numpy random generator
+    :return: None
+    """
+    # Model levels are numbered from the top of the atmosphere
+    profile = np.exp(-np.linspace(8., 0., n_levels))[:, None, None]
+
+    with create_product(filename, ts, lat, lon, levels=np.arange(1, n_levels + 1)) as dataset:
+        for i in range(n_species):
+            var = dataset.createVariable(cams_levels.MR_SPECIES[i], "f4", ("time", "level", "latitude", "longitude"))
+            var.units = "kg kg**-1"
+            var.long_name = MR_LONGNAMES[i]
+            var[0, :, :, :] = 1e-8 * profile * get_pattern(lat, lon, ts, 25. * i, rng, noise=0.)[None, :, :]
+
+
+def write_rh(filename, ts, lat, lon, rng):
+    """
+    Write a synthetic RH product on pressure levels
+    :param filename: netCDF filename
+    :param ts: timestamp as datetime
+    :param lat: latitude vector
+    :param lon: longitude vector
+    :param rng: numpy random generator
+    :return: None
+    """
+    profile = np.linspace(0.1, 1., len(RH_LEVELS))[:, None, None]
+
+    with create_product(filename, ts, lat, lon, levels=RH_LEVELS) as dataset:
+        var = dataset.createVariable("r", "f4", ("time", "level", "latitude", "longitude"))
+        var.units = "%"
+        var.long_name = "Relative humidity"
+        var[0, :, :, :] = 100. * profile * get_pattern(lat, lon, ts, 90., rng)[None, :, :]
+
+
+def write_collection_product(root, ts, resolution=3., rng=None, mission="S2__OPER"):
+    """
+    Write the AOT, MR and RH products of a timestamp in a StartMaja '.DIR' directory
+    :param root: path to the collection
+    :param ts: timestamp as datetime
+    :param resolution: grid step in degrees
+    :param rng: numpy random generator
+    :param mission: filename prefix
+    :return: path of the '.DIR' directory
+    """
+    rng = rng if rng is not None else np.random.default_rng(0)
+    lat, lon = get_grid(resolution)
+    seven = ts >= TS_SEVEN_SPECIES
+
+    directory = os.path.join(root, "%s_EXO_CAMS_%s_21000101T000000.DBL.DIR" % (mission, ts.strftime("%Y%m%dT%H%M%S")))
+    os.makedirs(directory, exist_ok=True)
+    stamp = ts.strftime("%Y%m%dUTC%H%M%S")
+
+    write_aot(os.path.join(directory, "%s_EXO_CAMS_AOT_%s.nc" % (mission, stamp)), ts, lat, lon, 7 if seven else 5,
+              rng)
+    write_mr(os.path.join(directory, "%s_EXO_CAMS_MR_%s.nc" % (mission, stamp)), ts, lat, lon, 14 if seven else 11,
+             137 if seven else 69, rng)
+    write_rh(os.path.join(directory, "%s_EXO_CAMS_RH_%s.nc" % (mission, stamp)), ts, lat, lon, rng)
+
+    return directory
+
+
+def make_collection(root, count, start=None, step=3, resolution=3., seed=0):
+    """
+    Write a synthetic collection of count products, by default centered on the shift to 7 aerosol species
+    :param root: path to the collection, created if needed
+    :param count: number of products
+    :param start: timestamp of the first product as datetime, None to center the collection on the 7 species shift
+    :param step: hours between products
+    :param resolution: grid step in degrees
+    :param seed: seed of the noise
+    :return: list of '.DIR' directories
+    """
+    if start is None:
+        start = TS_SEVEN_SPECIES - timedelta(hours=step * (count // 2))
+
+    rng = np.random.default_rng(seed)
+    directories = [write_collection_product(root, start + timedelta(hours=step * i), resolution=resolution, rng=rng)
+                   for i in range(count)]
+
+    print("INFO: %i synthetic products written to %s (%s to %s, %g deg grid)" % (count, root, start,
+                                                                              start + timedelta(hours=step * (count - 1)),
+                                                                              resolution))
+
+    return directories
+
+
+def main():
+    """
+    Write a synthetic CAMS collection
+    :return: a directory of StartMaja '.DIR' products
+    """
+    # Argument parser
+    parser = argparse.ArgumentParser()
+    parser.add_argument("directory", help="Path to the collection to write")
+    parser.add_argument("--products", help="Number of products, defaults to 24", type=int, default=24)
+    parser.add_argument("--start", help="Timestamp of the first product (YYYY-MM-DD[THH:MM]), defaults to half the "
+                                        "collection before the shift to 7 species", type=cams_catalog.parse_date)
+    parser.add_argument("--step", help="Hours between products, defaults to 3", type=int, default=3)
+    parser.add_argument("--resolution", help="Grid step in degrees, defaults to 3 (CAMS is 0.4)", type=float,
+                        default=3.)
+    parser.add_argument("--seed", help="Seed of the noise, defaults to 0", type=int, default=0)
+    args = parser.parse_args()
+
+    make_collection(args.directory, args.products, start=args.start, step=args.step, resolution=args.resolution,
+                    seed=args.seed)
+
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
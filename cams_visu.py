@@ -5,48 +5,93 @@ Basic CAMS product viewer for MAJA AOT/MR/HR
 
 TODO: make it simpler with xarray
 
+v0.2.4 : read_columns accepts the latitude and longitude vectors already read by its caller, instead of reading them
+    again.
+
+v0.2.3 : workers render the collection in batches and close their synthesis figures at the end of each batch, as
+    the serial path does. get_pressure_levels raises ValueError on an unknown level count instead of exiting, main
+    still exits with status 2. read_columns reads a location whose grid indices are already known.
+
+v0.2.2 : MR pressure levels are computed by cams_levels from the ECMWF a/b coefficients and the surface pressure of
+    the column when the product has one ('sp' or 'lnsp'), instead of hard-coded standard atmosphere values.
+
+v0.2.1 : --profile prints the time spent listing, opening and reading products, plotting and saving figures, files
+    opened, bytes read and peak memory at exit, workers included (see cams_instrument).
+
+v0.2.0 : with --interp bilinear, MR and RH profiles and AOD are bilinearly interpolated to the location from the four
+    surrounding columns, weights are computed once per site and grid by cams_grid.
+
+v0.1.1 : each product is opened once and only the column at the location is read from MR, RH and AOT variables,
+    the resulting profile bundle is passed to the plotting code. 5-species MR products (no nitrate and ammonium) are
+    supported.
+
+v0.1.0 : batch rendering. The synthesis figure, its axes, legends and static labels are built once and only line/bar
+    data and title are updated from one product to the next. Figures are closed, and plots can be rendered over a
+    process pool with --workers using the Agg backend.
+
+v0.0.2 : products can be listed from a cams_catalog SQLite catalog (--catalog) and restricted to a time range
+
+v0.0.1 : closest grid point lookup goes through the cams_grid index cache
+
 v0.0.0 : initial release, not tested on 5-species datasets
 """
 
 __author__ = "jerome.colin'at'cesbio.cnes.fr"
 __license__ = "MIT"
-__version__ = "0.0.0"
+__version__ = "0.2.4"
 
 import netCDF4 as nc
 import numpy as np
 import matplotlib.pyplot as pl
 import argparse, sys, glob
+import functools
+from concurrent.futures import ProcessPoolExecutor
+import cams_grid
+import cams_levels
+import cams_catalog
+import cams_instrument
 
 
 def find_location_index(lat, lon, data):
     """
     Return the closest lat and lon idx from DD values
     :param lat: DD latitude [-90:90]
-    :param lon: DD longitude [0:360]
+    :param lon: DD longitude, either [0:360] or [-180:180]
     :param data: a netCDF dataset with lat and lon dimensions
     :return: latitude index, longitude index
     """
-    lat_idx = get_closest_index(lat, data['latitude'][:])
-
-    if lon < 0:
-        allround_lon = 360+lon
-        print("WARNING: longitude should be [0:360]. Set %6.4f to %6.4f" % (lon, allround_lon))
-    else:
-        allround_lon = lon
-
-    lon_idx = get_closest_index(allround_lon, data['longitude'][:])
+    lat_idx, lon_idx = cams_grid.get_grid_indices(lat, lon, data['latitude'][:], data['longitude'][:])
+    lat_idx, lon_idx = int(lat_idx[0]), int(lon_idx[0])
 
     print("INFO: location (%5.3fN, %5.3fE) has index (%i, %i)" % (lat, lon, lat_idx, lon_idx))
 
     return lat_idx, lon_idx
 
 
-def get_aot(aot_dataset, lat_idx, lon_idx):
+def read_location(variable, lat_idx, lon_idx, weights=None):
+    """
+    Read a netCDF variable at a grid point, or bilinearly interpolated from its four corners
+    :param variable: netCDF variable whose two last dimensions are latitude and longitude, the first one being time
+    :param lat_idx: latitude as index, or (2) corner latitude indices
+    :param lon_idx: longitude as index, or (2) corner longitude indices
+    :param weights: None for the grid point, or (2, 2) bilinear weights of the corners
+    :return: values at the location of the first time step
+    """
+    index = (0,) + (slice(None),) * (variable.ndim - 3)
+
+    if weights is None:
+        return variable[index + (lat_idx, lon_idx)]
+
+    return sum(weights[i, j] * variable[index + (lat_idx[i], lon_idx[j])] for i in range(2) for j in range(2))
+
+
+def get_aot(aot_dataset, lat_idx, lon_idx, weights=None):
     """
     Return species ratios to AOD (%), total AOD, aerosol short and long-names
     :param aot_dataset: netCDF dataset for AOT
-    :param lat_idx: latitude as index
-    :param lon_idx: longitude as index
+    :param lat_idx: latitude as index, or (2) corner latitude indices
+    :param lon_idx: longitude as index, or (2) corner longitude indices
+    :param weights: None for the grid point, or (2, 2) bilinear weights of the corners
     :return: (4) species ratios to AOD (%), total AOD, aerosol short and long-names
     """
     aot_var_names = []
@@ -58,7 +103,7 @@ def get_aot(aot_dataset, lat_idx, lon_idx):
     # Get AOT value per species
     aot = []
     for aer in aot_var_names[3:]:
-        aot.append(aot_dataset[aer][0, lat_idx, lon_idx])
+        aot.append(read_location(aot_dataset[aer], lat_idx, lon_idx, weights=weights))
         #print("%s : %12.8f" % (aer, aot_dataset[aer][0, lat_idx, lon_idx]))
 
     aot_norm = aot / sum(aot) * 100
@@ -73,20 +118,21 @@ def get_closest_index(target, vector):
     :param vector: an 1D array of the same type as target
     :return: an index as int
     """
-    return (np.abs(vector - target)).argmin()
+    return int(cams_grid.nearest_indices(target, vector)[0])
 
 
-def get_mr(mr_dataset, lat_idx, lon_idx):
+def get_mr(mr_dataset, lat_idx, lon_idx, weights=None):
     """
     Return a 2D cube of ('aerosol', 'MR along altitude'), plus names and display settings
+    Only the (level) column at (lat_idx, lon_idx) is read for each aerosol available in the dataset.
     :param mr_dataset: netCDF dataset of MR
-    :param lat_idx: latitude as index
-    :param lon_idx: longitude as index
+    :param lat_idx: latitude as index, or (2) corner latitude indices
+    :param lon_idx: longitude as index, or (2) corner longitude indices
+    :param weights: None for the grid point, or (2, 2) bilinear weights of the corners
     :return: (4) mr_cube, aerosols_variable_names, aerosols_variable_color, aerosols_variable_linestyle
     """
     # Define aerosol parameters
-    aerosols_variable_names = ["aermr01", "aermr02", "aermr03", "aermr04", "aermr05", "aermr06", "aermr07", "aermr08",
-                               "aermr09", "aermr10", "aermr11", "aermr16", "aermr17", "aermr18"]
+    aerosols_variable_names = list(cams_levels.MR_SPECIES)
 
     aerosols_variable_color = ['tab:blue', 'tab:blue', 'tab:blue', 'tab:orange', 'tab:orange', 'tab:orange',
                                'tab:green', 'tab:green', 'tab:grey', 'tab:grey', 'tab:red', 'tab:cyan', 'tab:cyan',
@@ -94,51 +140,43 @@ def get_mr(mr_dataset, lat_idx, lon_idx):
     aerosols_variable_linestyle = ['dotted', 'dashed', 'solid', 'dotted', 'dashed', 'solid', 'dashed', 'solid',
                                    'dashed', 'solid', 'solid', 'dashed', 'solid', 'solid']
 
+    # Keep aerosols available in the dataset (5-species products have no nitrate and ammonium)
+    available = [i for i, name in enumerate(aerosols_variable_names) if name in mr_dataset.variables]
+    aerosols_variable_names = [aerosols_variable_names[i] for i in available]
+    aerosols_variable_color = [aerosols_variable_color[i] for i in available]
+    aerosols_variable_linestyle = [aerosols_variable_linestyle[i] for i in available]
+
     # Create an array of dimensions ('aerosol species', 'mixing ratio along level')
-    mr_cube = np.zeros((len(aerosols_variable_names), len(mr_dataset['level'][:])))
+    mr_cube = np.zeros((len(aerosols_variable_names), len(mr_dataset.dimensions['level'])))
     for i in range(len(aerosols_variable_names)):
-        mr_cube[i, :] = mr_dataset[aerosols_variable_names[i]][:, :, lat_idx, lon_idx][0]
+        mr_cube[i, :] = read_location(mr_dataset[aerosols_variable_names[i]], lat_idx, lon_idx, weights=weights)
 
     return mr_cube, aerosols_variable_names, aerosols_variable_color, aerosols_variable_linestyle
 
 
-def get_pressure_levels(dataset):
+def get_pressure_levels(dataset, lat_idx=None, lon_idx=None, weights=None):
     """
-    Return pressure levels equivalent to model levels for either 137 or 69 levels products
+    Return the pressure at the bottom of the model levels of a 137 or 69 levels product, computed by cams_levels from
+    the surface pressure of the column if the product has one, otherwise from the standard surface pressure
     :param dataset: a netCDF dataset of MR
-    :return: ps_levels (vect)
+    :param lat_idx: latitude as index, or (2) corner latitude indices
+    :param lon_idx: longitude as index, or (2) corner longitude indices
+    :param weights: None for the grid point, or (2, 2) bilinear weights of the corners
+    :return: ps_levels (vect) in hPa
     """
     # Check length of 'level' dimension to define equivalent pressure level values
-    if len(dataset['level'][:]) == 137:
-        ps_levels = [0.02, 0.031, 0.0457, 0.0683, 0.0975, 0.1361, 0.1861, 0.2499, 0.3299, 0.4288, 0.5496, 0.6952,
-                     0.869, 1.0742, 1.3143, 1.5928, 1.9134, 2.2797, 2.6954, 3.1642, 3.6898, 4.2759, 4.9262, 5.6441,
-                     6.4334, 7.2974, 8.2397, 9.2634, 10.372, 11.5685, 12.8561, 14.2377, 15.7162, 17.2945, 18.9752,
-                     20.751, 22.6543, 24.6577, 26.7735, 29.0039, 31.3512, 33.8174, 36.4047, 39.1149, 41.9493,
-                     44.9082, 47.9915, 51.199, 54.5299, 57.9834, 61.5607, 65.2695, 69.1187, 73.1187, 77.281,
-                     81.6182, 86.145, 90.8774, 95.828, 101.0047, 106.4153, 112.0681, 117.9714, 124.1337, 130.5637,
-                     137.2703, 144.2624, 151.5493, 159.1403, 167.045, 175.2731, 183.8344, 192.7389, 201.9969,
-                     211.6186, 221.6146, 231.9954, 242.7719, 253.9549, 265.5556, 277.5852, 290.0548, 302.9762,
-                     316.3607, 330.2202, 344.5663, 359.4111, 374.7666, 390.645, 407.0583, 424.019, 441.5395,
-                     459.6321, 478.3096, 497.5845, 517.4198, 537.7195, 558.343, 579.1926, 600.1668, 621.1624,
-                     642.0764, 662.8084, 683.262, 703.3467, 722.9795, 742.0855, 760.5996, 778.4661, 795.6396,
-                     812.0847, 827.7756, 842.6959, 856.8376, 870.2004, 882.791, 894.6222, 905.7116, 916.0815,
-                     925.7571, 934.7666, 943.1399, 950.9082, 958.1037, 964.7584, 970.9046, 976.5737, 981.7968,
-                     986.6036, 991.023, 995.0824, 998.8081, 1002.225, 1005.3562, 1008.2239, 1010.8487, 1013.25]
-        print("INFO: mixing ratio dataset with 137 levels")
-    elif len(dataset['level'][:]) == 69:
-        ps_levels = [0.02, 0.0467, 0.0975, 0.1861, 0.3299, 0.5496, 0.869, 1.3143, 1.9134, 2.6954, 3.6898, 4.9262,
-                     6.4334, 8.2397, 10.372, 12.8561, 15.7162, 18.9752, 22.6543, 26.7735, 31.3512, 36.4047, 41.9493,
-                     47.9915, 54.5299, 61.5607, 69.1187, 77.281, 86.145, 95.828, 106.4153, 117.9714, 130.5637,
-                     144.2624, 159.1403, 175.2731, 192.7389, 211.6186, 231.9954, 253.9549, 277.5852, 302.9762,
-                     330.2202, 359.4111, 390.645, 424.019, 459.6321, 497.5845, 537.7195, 579.1926, 621.1624,
-                     662.8084, 703.3467, 742.0855, 778.4661, 812.0847, 842.6959, 870.2004, 894.6222, 916.0815,
-                     934.7666, 950.9082, 964.7584, 976.5737, 986.6036, 995.0824, 1002.225, 1008.2239, 1013.25]
-        print("INFO: mixing ratio dataset with 69 levels")
-    else:
-        print("ERROR: unknown level size")
-        sys.exit(2)
+    n_levels = len(dataset.dimensions['level'])
+    if n_levels not in cams_levels.LEVEL_SETS:
+        raise ValueError("unknown level size %i, expected one of %s" % (n_levels, sorted(cams_levels.LEVEL_SETS)))
+    print("INFO: mixing ratio dataset with %i levels" % n_levels)
 
-    return ps_levels
+    surface_pressure = cams_levels.STANDARD_SURFACE_PRESSURE
+    name, log = cams_levels.get_surface_pressure_variable(dataset.variables)
+    if name is not None and lat_idx is not None:
+        surface_pressure = cams_levels.to_surface_pressure(
+            np.squeeze(read_location(dataset[name], lat_idx, lon_idx, weights=weights)), log=log)
+
+    return cams_levels.get_half_level_pressures(n_levels, surface_pressure)[1:] / 100.
 
 
 def get_products(path):
@@ -171,101 +209,364 @@ def get_timestamp(file):
     timestamp[:4], timestamp[4:6], timestamp[6:8], timestamp[11:13], timestamp[13:15])
 
 
-def show_location(filename, lat, lon):
-    # Open netCDF datasets
-    try:
-        dataset = nc.Dataset(filename)
+def show_location(synthesis, lat, lon):
+    """
+    Print where a location falls on the grid of a product
+    :param synthesis: dict returned by read_synthesis
+    :param lat: latitude in DD asked for
+    :param lon: longitude in DD asked for
+    :return: None
+    """
+    print("DEBUG: Latitude of grid %i in netCDF is %6.4f, you asked for %6.4f" % (synthesis["lat_idx"],
+                                                                                 synthesis["grid_lat"], lat))
+    print("DEBUG: Longitude of grid %i in netCDF is %6.4f, you asked for %6.4f" % (synthesis["lon_idx"],
+                                                                                  synthesis["grid_lon"], lon))
+    print("DEBUG: Longitude ranges from %6.4f to %6.4f in netCDF" % synthesis["lon_range"])
 
-    except FileNotFoundError as e:
-        print(e)
-        sys.exit(1)
 
-    # Find location indexes (assumes same (x,y) spatial resolution for both 3 files)
-    lat_idx, lon_idx = find_location_index(lat, lon, dataset)
+def init_synthesis_figure(mr_names, mr_longnames, mr_colors, mr_linestyles, aot_longnames, max_mr=2e-8):
+    """
+    Build the three-panel synthesis figure once: axes, empty profile lines, AOD bars, legends and static labels
+    :param mr_names: aerosols mixing ratio variable names
+    :param mr_longnames: aerosols mixing ratio long names, used as legend labels
+    :param mr_colors: line color for each aerosol
+    :param mr_linestyles: line style for each aerosol
+    :param aot_longnames: AOT species long names
+    :param max_mr: upper limit of the mixing ratio axis
+    :return: a dict of the figure artists, updated by update_synthesis_figure
+    """
+    fig, axs = pl.subplots(1, 3, sharex=False, sharey=False, constrained_layout=True, figsize=(19, 8))
+    title = fig.suptitle("", fontsize='xx-large')
+
+    # MR subplot
+    axs[0].invert_yaxis()
+    axs[0].set_ylabel('Air pressure (hPa)', fontsize='x-large')
+    axs[0].set_xlim([0, max_mr])
+    mr_lines = []
+    for p in range(len(mr_names)):
+        mr_lines.append(axs[0].plot([], [], mr_colors[p], linestyle=mr_linestyles[p], label=mr_longnames[p])[0])
+
+    axs[0].legend(fontsize='large')
+
+    # RH subplot
+    axs[1].invert_yaxis()
+    axs[1].yaxis.tick_right()
+    axs[1].set_xlim([0, 100])
+    rh_line = axs[1].plot([], [], '.-', label='Relative humidity')[0]
 
-    print("DEBUG: Latitude of grid %i in netCDF is %6.4f, you asked for %6.4f" % (lat_idx, dataset['latitude'][lat_idx], lat))
-    print("DEBUG: Longitude of grid %i in netCDF is %6.4f, you asked for %6.4f" % (lon_idx, dataset['longitude'][lon_idx], lon))
-    print("DEBUG: Longitude ranges from %6.4f to %6.4f in netCDF" % (np.min(dataset['longitude'][:]), np.max(dataset['longitude'][:])))
+    # AOT subplot
+    aot_variable_color = ['tab:orange', 'tab:green', 'tab:grey', 'tab:red', 'tab:cyan', 'tab:blue', 'tab:olive']
+    bars = axs[2].barh(aot_longnames, np.zeros(len(aot_longnames)), color=aot_variable_color[:len(aot_longnames)])
+    axs[2].set_xlim([0, 100])
+    axs[2].set_xlabel('CAMS species contribution to AOD at 550nm (%)', fontsize='x-large')
+    axs[2].set_yticks(range(len(aot_longnames)))
+    axs[2].set_yticklabels(aot_longnames, horizontalalignment="left", fontsize='x-large')
+
+    return {"fig": fig, "axs": axs, "title": title, "mr_lines": mr_lines, "rh_line": rh_line, "bars": bars}
 
 
-def synthesis_plot(file_mixing_ratio, file_relative_humidity, file_aot, lat, lon, site_name=None, max_mr=2e-8):
+def update_synthesis_figure(figure, title, mr_cube, mr_ps_levels, rh_profile, rh_ps_levels, aot_norm):
     """
-    Main routine
-    :param file_mixing_ratio:
-    :param file_relative_humidity:
-    :param file_aot:
-    :param lat:
-    :param lon:
-    :param site_name:
-    :param max_mr:
-    :return:
+    Update the data of a synthesis figure built by init_synthesis_figure
+    :param figure: dict of the figure artists
+    :param title: figure title
+    :param mr_cube: 2D array of mixing ratios ('aerosol', 'level')
+    :param mr_ps_levels: pressure of MR levels (hPa)
+    :param rh_profile: relative humidity profile (%)
+    :param rh_ps_levels: pressure of RH levels (hPa)
+    :param aot_norm: species contribution to AOD (%)
+    :return: None
     """
+    axs = figure["axs"]
+    figure["title"].set_text(title)
+
+    for line, mr in zip(figure["mr_lines"], mr_cube):
+        line.set_data(mr, mr_ps_levels)
+    axs[0].set_xlabel('CAMS Aerosols mixing ratio (kg/kg), %i levels' % len(mr_ps_levels), fontsize='x-large')
+    axs[0].relim()
+    axs[0].autoscale_view(scalex=False)
+
+    figure["rh_line"].set_data(rh_profile, rh_ps_levels)
+    axs[1].set_xlabel("ECMWF relative humidity (%%), %i levels" % len(rh_ps_levels), fontsize='x-large')
+    axs[1].relim()
+    axs[1].autoscale_view(scalex=False)
 
+    for bar, value in zip(figure["bars"], aot_norm):
+        bar.set_width(value)
+
+
+def read_synthesis(file_mixing_ratio, file_relative_humidity, file_aot, lat, lon, site_name=None, interp="nearest"):
+    """
+    Read the profiles and AOD of a product for a given location. Each product is opened once and only the column at
+    the location (or the four columns around it) is read from the MR, RH and AOT variables.
+    :param file_mixing_ratio: MR netCDF file
+    :param file_relative_humidity: RH netCDF file
+    :param file_aot: AOT netCDF file
+    :param lat: latitude in DD
+    :param lon: longitude in DD
+    :param site_name: site name for plot title
+    :param interp: 'nearest' grid point or 'bilinear' interpolation to the location
+    :return: a dict of everything needed to build and update a synthesis figure
+    """
     # Open netCDF datasets
     try:
-        mr_dataset = nc.Dataset(file_mixing_ratio)
-        rh_dataset = nc.Dataset(file_relative_humidity)
-        aot_dataset = nc.Dataset(file_aot)
+        with cams_instrument.stage("open"):
+            mr_dataset = nc.Dataset(file_mixing_ratio)
+            rh_dataset = nc.Dataset(file_relative_humidity)
+            aot_dataset = nc.Dataset(file_aot)
+            for filename in (file_mixing_ratio, file_relative_humidity, file_aot):
+                cams_instrument.opened(filename)
     except FileNotFoundError as e:
         print(e)
         sys.exit(1)
 
+    with cams_instrument.stage("read"):
+        synthesis = read_datasets(mr_dataset, rh_dataset, aot_dataset, lat, lon, get_timestamp(file_mixing_ratio)[1],
+                                  site_name=site_name, interp=interp)
+
+    mr_dataset.close()
+    rh_dataset.close()
+    aot_dataset.close()
+
+    return synthesis
+
+
+def read_datasets(mr_dataset, rh_dataset, aot_dataset, lat, lon, timestamp, site_name=None, interp="nearest"):
+    """
+    Read the profiles and AOD at a location from open MR, RH and AOT datasets, see read_synthesis
+    :param mr_dataset: netCDF dataset of MR
+    :param rh_dataset: netCDF dataset of RH
+    :param aot_dataset: netCDF dataset of AOT
+    :param lat: latitude in DD
+    :param lon: longitude in DD
+    :param timestamp: nice timestamp of the product for plot title
+    :param site_name: site name for plot title
+    :param interp: 'nearest' grid point or 'bilinear' interpolation to the location
+    :return: a dict of everything needed to build and update a synthesis figure
+    """
+
     # Find location indexes (assumes same (x,y) spatial resolution for both 3 files)
-    lat_idx, lon_idx = find_location_index(lat, lon, mr_dataset)
+    grid = {'latitude': mr_dataset['latitude'][:], 'longitude': mr_dataset['longitude'][:]}
+    lat_idx, lon_idx = find_location_index(lat, lon, grid)
+
+    # Bilinear interpolation corners and weights, otherwise the closest grid point
+    corners_lat, corners_lon, weights = None, None, None
+    if interp == "bilinear":
+        corners_lat, corners_lon, lat_weights, lon_weights = cams_grid.get_bilinear_weights(lat, lon, grid['latitude'],
+                                                                                            grid['longitude'])
+        corners_lat, corners_lon = corners_lat[0], corners_lon[0]
+        weights = np.outer(lat_weights[0], lon_weights[0])
+
+    return read_columns(mr_dataset, rh_dataset, aot_dataset, lat, lon, timestamp, lat_idx, lon_idx,
+                        corners_lat=corners_lat, corners_lon=corners_lon, weights=weights, site_name=site_name,
+                        grid=grid)
+
+
+def read_columns(mr_dataset, rh_dataset, aot_dataset, lat, lon, timestamp, lat_idx, lon_idx, corners_lat=None,
+                 corners_lon=None, weights=None, site_name=None, grid=None):
+    """
+    Read the profiles and AOD at a location whose grid indices are known, see read_datasets
+    :param mr_dataset: netCDF dataset of MR
+    :param rh_dataset: netCDF dataset of RH
+    :param aot_dataset: netCDF dataset of AOT
+    :param lat: latitude in DD
+    :param lon: longitude in DD
+    :param timestamp: nice timestamp of the product for plot title
+    :param lat_idx: latitude index of the closest grid point
+    :param lon_idx: longitude index of the closest grid point
+    :param corners_lat: None for the closest grid point, or (2) corner latitude indices
+    :param corners_lon: None for the closest grid point, or (2) corner longitude indices
+    :param weights: None for the closest grid point, or (2, 2) bilinear weights of the corners
+    :param site_name: site name for plot title
+    :param grid: dict of the 'latitude' and 'longitude' vectors of the products if already read, None to read them
+    :return: a dict of everything needed to build and update a synthesis figure
+    """
+    if grid is None:
+        grid = {'latitude': mr_dataset['latitude'][:], 'longitude': mr_dataset['longitude'][:]}
+
+    if weights is not None:
+        location = (lat, lon)
+    else:
+        corners_lat, corners_lon = lat_idx, lon_idx
+        location = (grid['latitude'][lat_idx], grid['longitude'][lon_idx])
 
     # Get pressure levels from model level in dataset
-    mr_ps_levels = get_pressure_levels(mr_dataset)
+    mr_ps_levels = get_pressure_levels(mr_dataset, corners_lat, corners_lon, weights=weights)
     rh_ps_levels = rh_dataset['level'][:]
 
     # Get MR
-    mr_cube, aerosols_variable_names, aerosols_variable_color, aerosols_variable_linestyle = get_mr(mr_dataset, lat_idx,
-                                                                                                    lon_idx)
+    mr_cube, aerosols_variable_names, aerosols_variable_color, aerosols_variable_linestyle = get_mr(mr_dataset,
+                                                                                                    corners_lat,
+                                                                                                    corners_lon,
+                                                                                                    weights=weights)
 
     # Get AOT
-    aot_norm, aot, aot_var_names, aot_var_longnames = get_aot(aot_dataset, lat_idx, lon_idx)
+    aot_norm, aot, aot_var_names, aot_var_longnames = get_aot(aot_dataset, corners_lat, corners_lon, weights=weights)
+
+    synthesis = {
+        "mr_names": aerosols_variable_names,
+        "mr_longnames": [mr_dataset[v].long_name for v in aerosols_variable_names],
+        "mr_colors": aerosols_variable_color,
+        "mr_linestyles": aerosols_variable_linestyle,
+        "aot_longnames": aot_var_longnames[3:],
+        "title": "%s (%5.2f°N, %5.2f°E) @ %s, AOD(550nm) = %5.3f" % (
+            site_name, location[0], location[1], timestamp, aot),
+        "lat_idx": lat_idx,
+        "lon_idx": lon_idx,
+        "grid_lat": float(grid['latitude'][lat_idx]),
+        "grid_lon": float(grid['longitude'][lon_idx]),
+        "lon_range": (float(np.min(grid['longitude'])), float(np.max(grid['longitude']))),
+        "mr_cube": mr_cube,
+        "mr_ps_levels": mr_ps_levels,
+        "rh_profile": read_location(rh_dataset['r'], corners_lat, corners_lon, weights=weights),
+        "rh_ps_levels": rh_ps_levels,
+        "aot_norm": aot_norm,
+    }
+
+    return synthesis
+
+
+# Synthesis figures reused from one product to the next, keyed by their static content
+_figures = {}
+
+
+def get_synthesis_figure(synthesis, max_mr=2e-8):
+    """
+    Return a synthesis figure matching the species of a product, building it on first use
+    :param synthesis: dict returned by read_synthesis
+    :param max_mr: upper limit of the mixing ratio axis
+    :return: a dict of the figure artists
+    """
+    key = (tuple(synthesis["mr_names"]), tuple(synthesis["mr_longnames"]), tuple(synthesis["aot_longnames"]), max_mr)
+    if key not in _figures:
+        _figures[key] = init_synthesis_figure(synthesis["mr_names"], synthesis["mr_longnames"],
+                                              synthesis["mr_colors"], synthesis["mr_linestyles"],
+                                              synthesis["aot_longnames"], max_mr=max_mr)
 
-    # Figure settings
-    fig, axs = pl.subplots(1, 3, sharex=False, sharey=False, constrained_layout=True, figsize=(19, 8))
-    fig.suptitle(("%s (%5.2f°N, %5.2f°E) @ %s, AOD(550nm) = %5.3f" % (
-    site_name, mr_dataset['latitude'][lat_idx], mr_dataset['longitude'][lon_idx], get_timestamp(file_mixing_ratio)[1], aot)),
-                 fontsize='xx-large')
+    return _figures[key]
 
-    # MR subplot
-    axs[0].invert_yaxis()
-    axs[0].set_xlabel('CAMS Aerosols mixing ratio (kg/kg), %i levels' % len(mr_ps_levels), fontsize='x-large')
-    axs[0].set_ylabel('Air pressure (hPa)', fontsize='x-large')
-    axs[0].set_xlim([0, max_mr])
-    for p in range(len(aerosols_variable_names)):
-        axs[0].plot(mr_dataset[aerosols_variable_names[p]][:, :, lat_idx, lon_idx][0], mr_ps_levels,
-                    aerosols_variable_color[p], linestyle=aerosols_variable_linestyle[p],
-                    label=mr_dataset[aerosols_variable_names[p]].long_name)
 
-    axs[0].legend(fontsize='large')
+def close_synthesis_figures():
+    """
+    Close all the synthesis figures kept for reuse
+    :return: None
+    """
+    for figure in _figures.values():
+        pl.close(figure["fig"])
+    _figures.clear()
 
-    # RH subplot
-    axs[1].invert_yaxis()
-    axs[1].set_xlabel("ECMWF relative humidity (%%), %i levels" % len(rh_ps_levels), fontsize='x-large')
-    # axs[1].set_ylabel('Air pressure (hPa)')
-    axs[1].yaxis.tick_right()
-    axs[1].set_xlim([0, 100])
-    axs[1].plot(rh_dataset['r'][:, :, lat_idx, lon_idx][0], rh_ps_levels, '.-', label='Relative humidity')
 
-    # AOT subplot
-    aot_variable_color = ['tab:orange', 'tab:green', 'tab:grey', 'tab:red', 'tab:cyan', 'tab:blue', 'tab:olive']
-    axs[2].barh(aot_var_longnames[3:], aot_norm, color=aot_variable_color)
-    axs[2].set_xlim([0, 100])
-    axs[2].set_xlabel('CAMS species contribution to AOD at 550nm (%)', fontsize='x-large')
-    axs[2].set_yticklabels(aot_var_longnames[3:], horizontalalignment="left", fontsize='x-large')
+def render_product(products, lat, lon, site_name=None, max_mr=2e-8, interp="nearest"):
+    """
+    Render the synthesis plot of one product, reusing the figure of the previous product with the same species
+    :param products: (3) MR, AOT and RH filenames
+    :param lat: latitude in DD
+    :param lon: longitude in DD
+    :param site_name: site name for plot title
+    :param max_mr: upper limit of the mixing ratio axis
+    :param interp: 'nearest' grid point or 'bilinear' interpolation to the location
+    :return: PNG filename
+    """
+    file_mixing_ratio, file_aot, file_relative_humidity = products
+
+    synthesis = read_synthesis(file_mixing_ratio, file_relative_humidity, file_aot, lat, lon, site_name=site_name,
+                               interp=interp)
+    show_location(synthesis, lat, lon)
+    with cams_instrument.stage("plot"):
+        figure = get_synthesis_figure(synthesis, max_mr=max_mr)
+        update_synthesis_figure(figure, synthesis["title"], synthesis["mr_cube"], synthesis["mr_ps_levels"],
+                                synthesis["rh_profile"], synthesis["rh_ps_levels"], synthesis["aot_norm"])
 
     # Saving figure
-    pl.savefig("%s_%s.png" % (site_name, get_timestamp(file_mixing_ratio)[0]))
+    png = "%s_%s.png" % (site_name, get_timestamp(file_mixing_ratio)[0])
+    with cams_instrument.stage("savefig"):
+        figure["fig"].savefig(png)
+
+    return png
+
+
+def render_batch(batch, renderer):
+    """
+    Render a batch of products in a worker process, reusing the figures from one product to the next and closing them
+    once the batch is rendered
+    :param batch: list of (MR, AOT, RH) filenames
+    :param renderer: picklable function of (MR, AOT, RH) filenames returning a PNG filename, eg. render_product
+    :return: list of PNG filenames
+    """
+    try:
+        return [renderer(products) for products in batch]
+    finally:
+        close_synthesis_figures()
+
+
+def _init_render_worker():
+    pl.switch_backend("Agg")
+
+
+def render_collection(collection, lat, lon, site_name=None, max_mr=2e-8, workers=1, interp="nearest"):
+    """
+    Render synthesis plots for a whole collection. Each process builds its figures once and only updates their data
+    from one product to the next.
+    :param collection: list of (MR, AOT, RH) filenames
+    :param lat: latitude in DD
+    :param lon: longitude in DD
+    :param site_name: site name for plot title
+    :param max_mr: upper limit of the mixing ratio axis
+    :param workers: number of worker processes, 1 renders in the current process
+    :param interp: 'nearest' grid point or 'bilinear' interpolation to the location
+    :return: list of PNG filenames
+    """
+    renderer = functools.partial(render_product, lat=lat, lon=lon, site_name=site_name, max_mr=max_mr, interp=interp)
+
+    if workers > 1:
+        size = max(1, len(collection) // (workers * 4))
+        batches = [collection[i:i + size] for i in range(0, len(collection), size)]
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_render_worker) as executor:
+            batch_renderer = functools.partial(render_batch, renderer=renderer)
+            pngs = [png for batch in cams_instrument.pool_map(executor, batch_renderer, batches) for png in batch]
+    else:
+        _init_render_worker()
+        pngs = list(map(renderer, collection))
+        close_synthesis_figures()
+
+    print("INFO: %i synthesis plots rendered with %i worker(s)" % (len(pngs), workers))
+
+    return pngs
+
+
+def synthesis_plot(file_mixing_ratio, file_relative_humidity, file_aot, lat, lon, site_name=None, max_mr=2e-8,
+                   interp="nearest"):
+    """
+    Main routine
+    :param file_mixing_ratio:
+    :param file_relative_humidity:
+    :param file_aot:
+    :param lat:
+    :param lon:
+    :param site_name:
+    :param max_mr:
+    :param interp: 'nearest' grid point or 'bilinear' interpolation to the location
+    :return:
+    """
+    synthesis = read_synthesis(file_mixing_ratio, file_relative_humidity, file_aot, lat, lon, site_name=site_name,
+                               interp=interp)
+
+    figure = init_synthesis_figure(synthesis["mr_names"], synthesis["mr_longnames"], synthesis["mr_colors"],
+                                   synthesis["mr_linestyles"], synthesis["aot_longnames"], max_mr=max_mr)
+    update_synthesis_figure(figure, synthesis["title"], synthesis["mr_cube"], synthesis["mr_ps_levels"],
+                            synthesis["rh_profile"], synthesis["rh_ps_levels"], synthesis["aot_norm"])
+
+    # Saving figure
+    figure["fig"].savefig("%s_%s.png" % (site_name, get_timestamp(file_mixing_ratio)[0]))
+    pl.close(figure["fig"])
 
 
 def main():
     """
-    Produce a synthetic plot from CAMS products for a give site defined by its latitude/longitude. Be aware that the
-    profiles plotted will match the closest (lat,lon) grid of the netCDF files, values are not interpolated to the
-    exact location you give in input. Site name is not mandatory byt will make output filename nicer.
+    Produce a synthetic plot from CAMS products for a give site defined by its latitude/longitude. Be aware that by
+    default the profiles plotted will match the closest (lat,lon) grid of the netCDF files, use --interp bilinear to
+    interpolate values to the exact location you give in input. Site name is not mandatory byt will make output
+    filename nicer.
 
     Usage example :
     ~/S2__OPER_EXO_CAMS_20210301T120000_21000101T000000.DBL.DIR --lat 50.5 --lon 3.2 --site Lille
@@ -279,20 +580,40 @@ def main():
     parser.add_argument("--lon", help="Longitude in decimal degrees", type=float, required=True)
     parser.add_argument("--site", help="Site name for plot title", type=str, required=False)
     parser.add_argument("--maxmr", help="Maximum MR value, defaults to 2E-8", type=float, required=False, default=2e-8)
+    parser.add_argument("--catalog", help="SQLite catalog of the collection (see cams_catalog), refreshed on every run")
+    parser.add_argument("--start", help="Plot products from this date (YYYY-MM-DD[THH:MM])",
+                        type=cams_catalog.parse_date)
+    parser.add_argument("--end", help="Plot products up to this date (YYYY-MM-DD[THH:MM])",
+                        type=cams_catalog.parse_date)
+    parser.add_argument("--workers", help="Number of worker processes rendering plots, defaults to 1", type=int,
+                        default=1)
+    parser.add_argument("--interp", help="Profiles and AOD from the nearest grid point (default) or bilinearly "
+                                         "interpolated", choices=cams_grid.INTERPOLATIONS, default="nearest")
+    parser.add_argument("--profile", help="Print stage timings, files opened, bytes read and peak memory at exit, as a "
+                                          "table (default) or JSON, 'log' also prints a JSON record per stage call",
+                        nargs="?", const="table", choices=cams_instrument.FORMATS)
     args = parser.parse_args()
 
-    collection = get_collection(args.directory)
-
+    if args.profile is not None:
+        cams_instrument.start(args.profile)
 
+    with cams_instrument.stage("list"):
+        if args.catalog is not None:
+            collection = [(c['MR'], c['AOT'], c['RH'])
+                          for c in cams_catalog.get_collection(args.catalog, args.directory, start=args.start,
+                                                               end=args.end)]
+        else:
+            collection = [get_products(p) for p in get_collection(args.directory)]
+            collection = [c for c in collection
+                          if (args.start is None or cams_catalog.get_timestamp(c[0]) >= args.start)
+                          and (args.end is None or cams_catalog.get_timestamp(c[0]) <= args.end)]
 
-    for p in collection:
-        # Get file names:
-        file_mixing_ratio, file_aot, file_relative_humidity = get_products(p)
-
-        show_location(file_aot, args.lat, args.lon)
-
-        # Produce plot
-        synthesis_plot(file_mixing_ratio, file_relative_humidity, file_aot, args.lat, args.lon, site_name=args.site, max_mr=args.maxmr)
+    try:
+        render_collection(collection, args.lat, args.lon, site_name=args.site, max_mr=args.maxmr,
+                          workers=args.workers, interp=args.interp)
+    except ValueError as e:
+        print("ERROR: %s" % e)
+        sys.exit(2)
 
     sys.exit(0)
 
@@ -0,0 +1,166 @@
+"""
+Tests of cams_service
+
+Purpose : start the service on a free local port against a synthetic collection (see cams_synthetic), query every
+    endpoint over HTTP, check that concurrent queries on a product, whatever their endpoint, are answered from a
+    single read, and that bad queries and failing reads are answered with an error status while the service keeps
+    running.
+
+    Run with: python -m pytest test_cams_service.py (or python -m unittest test_cams_service)
+"""
+
+import asyncio, json, shutil, sys, tempfile, unittest
+from collections import Counter
+from unittest import mock
+import cams_grid
+import cams_levels
+import cams_service
+import cams_synthetic
+
+
+async def fetch(port, target, method="GET"):
+    """
+    Send a request to the service and read the whole response
+    :param port: port of the service on localhost
+    :param target: path and query string
+    :param method: HTTP method
+    :return: (3) status code, content type, body as bytes
+    """
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(("%s %s HTTP/1.1\r\nHost: localhost\r\n\r\n" % (method, target)).encode("latin-1"))
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    await writer.wait_closed()
+
+    head, body = response.split(b"\r\n\r\n", 1)
+    lines = head.decode("latin-1").split("\r\n")
+    headers = dict(line.split(": ", 1) for line in lines[1:])
+
+    return int(lines[0].split()[1]), headers["Content-Type"], body
+
+
+class ServiceTest(unittest.IsolatedAsyncioTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        # 8 products 3 hours apart, 4 before (5 species, 69 levels) and 4 after (7 species, 137 levels) the shift
+        cls.root = tempfile.mkdtemp()
+        cams_synthetic.make_collection(cls.root, 8, resolution=5.)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.root)
+
+    async def asyncSetUp(self):
+        self.server, self.state = await cams_service.start(self.root, port=0, batch_delay=0.05)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+        # Count the reads of products and the number of queries of each endpoint each one answers
+        self.reads = []
+        self.state["reader"] = self.counted(self.state["reader"])
+
+    async def asyncTearDown(self):
+        self.server.close()
+        await self.server.wait_closed()
+        cams_service.stop(self.state)
+
+    def counted(self, reader):
+        def read(products, requests):
+            self.reads.append(Counter(endpoint for endpoint, query in requests))
+            return reader(products, requests)
+        return read
+
+    def time(self, i):
+        return self.state["times"][i].isoformat()
+
+    async def get_json(self, target, expected=200):
+        status, content_type, body = await fetch(self.port, target)
+        self.assertEqual(status, expected, body)
+        self.assertEqual(content_type, "application/json")
+        return json.loads(body)
+
+    async def test_products(self):
+        products = await self.get_json("/products")
+        self.assertEqual(products["products"], 8)
+        self.assertEqual(products["first"], self.time(0))
+        self.assertEqual(products["last"], self.time(7))
+
+    async def test_aod(self):
+        for i, n_species in ((0, 5), (7, 7)):
+            aod = await self.get_json("/aod?lat=43.6&lon=1.4&time=%s" % self.time(i))
+            self.assertEqual(aod["product_time"], self.time(i))
+            self.assertEqual((aod["grid_lat"], aod["grid_lon"]), (45., 0.))
+            self.assertEqual(len(aod["species"]), n_species)
+            self.assertAlmostEqual(sum(species["aod"] for species in aod["species"]), aod["aod"], places=5)
+            self.assertAlmostEqual(sum(species["ratio"] for species in aod["species"]), 100., places=3)
+
+        bilinear = await self.get_json("/aod?lat=43.6&lon=1.4&time=%s&interp=bilinear" % self.time(7))
+        self.assertEqual(bilinear["interp"], "bilinear")
+        self.assertNotEqual(bilinear["aod"], aod["aod"])
+
+    async def test_profile(self):
+        for i, n_species, n_levels in ((0, 11, 69), (7, 14, 137)):
+            for interp in cams_grid.INTERPOLATIONS:
+                profile = await self.get_json("/profile?lat=43.6&lon=1.4&time=%s&interp=%s" % (self.time(i), interp))
+                self.assertEqual(list(profile["mr"]), list(cams_levels.MR_SPECIES[:n_species]))
+                self.assertEqual(len(profile["mr_pressure"]), n_levels)
+                self.assertTrue(all(len(mr) == n_levels for mr in profile["mr"].values()))
+                self.assertEqual(len(profile["rh"]), len(profile["rh_pressure"]))
+
+    async def test_plot(self):
+        status, content_type, body = await fetch(self.port, "/plot?lat=43.6&lon=1.4&site=Toulouse&interp=bilinear")
+        self.assertEqual((status, content_type), (200, "image/png"))
+        self.assertTrue(body.startswith(b"\x89PNG\r\n\x1a\n"))
+
+    async def test_batching(self):
+        lats = [-60. + 10. * i for i in range(12)]
+        aods, plots, profiles = await asyncio.gather(
+            asyncio.gather(*[self.get_json("/aod?lat=%g&lon=20&time=%s" % (lat, self.time(5))) for lat in lats]),
+            asyncio.gather(*[fetch(self.port, "/plot?lat=%g&lon=20&time=%s" % (lat, self.time(5)))
+                             for lat in lats[:4]]),
+            asyncio.gather(*[self.get_json("/profile?lat=%g&lon=20&time=%s" % (lat, self.time(5)))
+                             for lat in lats[:2]]))
+
+        # One read of the product answered the queries of every endpoint, each with its own location
+        self.assertEqual(self.reads, [{"/aod": len(lats), "/plot": 4, "/profile": 2}])
+        self.assertEqual([aod["lat"] for aod in aods], lats)
+        self.assertEqual(len(set(aod["aod"] for aod in aods)), len(lats))
+        self.assertTrue(all(status == 200 for status, content_type, body in plots))
+        self.assertNotEqual(profiles[0]["grid_lat"], profiles[1]["grid_lat"])
+
+        # Queries on different products are read separately
+        await asyncio.gather(self.get_json("/aod?lat=0&lon=0&time=%s" % self.time(1)),
+                             self.get_json("/aod?lat=0&lon=0&time=%s" % self.time(2)))
+        self.assertEqual(self.reads[1:], [{"/aod": 1}, {"/aod": 1}])
+
+    async def test_bad_requests(self):
+        for target, status in (("/aod?lon=1.4", 400), ("/aod?lat=north&lon=1.4", 400), ("/aod?lat=95&lon=1.4", 400),
+                               ("/aod?lat=43.6&lon=1.4&time=tomorrow", 400),
+                               ("/profile?lat=43.6&lon=1.4&interp=cubic", 400), ("/wind?lat=43.6&lon=1.4", 404),
+                               ("/aod?lat=43.6&lon=1.4&time=2000-01-01", 404)):
+            self.assertIn("error", await self.get_json(target, expected=status))
+
+        status, content_type, body = await fetch(self.port, "/aod?lat=43.6&lon=1.4", method="POST")
+        self.assertEqual(status, 405)
+        self.assertEqual(self.reads, [])
+
+    async def test_read_errors(self):
+        # Unknown level counts raise ValueError in cams_levels and cams_visu
+        with mock.patch.dict(cams_levels.LEVEL_SETS, clear=True):
+            error = await self.get_json("/profile?lat=43.6&lon=1.4", expected=500)
+        self.assertIn("ValueError", error["error"])
+
+        # A reader exiting must not stop the service
+        reader = self.state["reader"]
+        self.state["reader"] = lambda products, requests: sys.exit(2)
+        error = await self.get_json("/aod?lat=43.6&lon=1.4", expected=500)
+        self.assertIn("exited", error["error"])
+        self.state["reader"] = reader
+
+        self.assertEqual((await self.get_json("/products"))["products"], 8)
+        self.assertEqual(len((await self.get_json("/profile?lat=43.6&lon=1.4"))["mr"]), 14)
+
+
+if __name__ == "__main__":
+    unittest.main()